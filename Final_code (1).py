@@ -1,18 +1,11 @@
 # importing the necessary libraries needed 
-import os
-import requests
 import json
 import pandas as pd
-import re
 import logging
-import time
-from pypdf import PdfReader
-from pdf2image import convert_from_bytes
-import pytesseract
 import streamlit as st
-from dotenv import load_dotenv
-from PIL import Image
-from io import BytesIO
+from invoice_core import provider_configured
+from job_queue import ACTIVE, DONE, JobQueue
+from output_store import EXPORT_FORMATS, get_default_store
 
 ###########################################################################
 # 1. Configuration and Setup
@@ -25,338 +18,164 @@ logging.basicConfig(
     format='%(asctime)s:%(levelname)s:%(message)s'
 )
 
-# Loaded environment variables from .env
-load_dotenv()
-
-
-GPT4V_KEY = os.getenv("GPT4V_KEY")
-GPT4V_ENDPOINT = os.getenv("GPT4V_ENDPOINT")
-
-if not GPT4V_KEY or not GPT4V_ENDPOINT:
-    st.error("API key or endpoint not found in the environment variables.")
+# Environment variables from .env are loaded by invoice_core
+if not provider_configured():
+    st.error("API key or endpoint for the LLM provider not found in the environment variables.")
     st.stop()
 
-# Headers for the API call
-headers = {
-    "Content-Type": "application/json",
-    "api-key": GPT4V_KEY,
-}
-
-
-
-###################################################################
-# 2.  Functions
-
-# extracting text from pdf files handling regular and scanned PDFs.
-def get_pdf_text(pdf_doc):  # pdf_doc (UploadedFile): The uploaded PDF file.
-    
-    text = ""
-    try:
-        pdf_reader = PdfReader(pdf_doc)
-        num_pages = len(pdf_reader.pages)
-        for page_number, page in enumerate(pdf_reader.pages, start=1):
-            extracted_text = page.extract_text()
-            
-            if extracted_text and len(extracted_text.strip()) > 50:  # Threshold for text extraction
-                text += extracted_text + "\n"
-                logging.info(f"Text extracted from page {page_number} using PdfReader.")
-            else:
-                # If text extraction is insufficient, use OCR
-                logging.info(f"Insufficient text on page {page_number}. Applying OCR.")
-                pdf_doc.seek(0)  # Reset file pointer to read bytes
-                pdf_bytes = pdf_doc.read()
-                images = convert_from_bytes(pdf_bytes, first_page=page_number, last_page=page_number)
-                
-                for image in images:
-                    ocr_text = pytesseract.image_to_string(image, config='--psm 6')  # Assume a single uniform block of text
-                    
-                    if ocr_text and len(ocr_text.strip()) > 10:  # Threshold for OCR text
-                        text += ocr_text + "\n"
-                        logging.info(f"OCR text extracted from page {page_number}.")
-    
-    except Exception as e:
-        logging.error(f"Error extracting text from PDF: {e}")
-        st.error(f"Error extracting text from PDF: {e}")
-
-    return text  # str: The extracted text from the PDF.
-
-
-
-
-
-# Calls the OpenAI GPT-4 API to extract invoice data in JSON format.
-def call_openai_api(pages_data):  #pages_data (str): The extracted text from the PDF.
-               
-            # designing a prompt using personification
-    prompt_template = '''You are an expert and have best knowledge of invoices .Extract the following fields from the invoice data: 
-- Invoice No.
-- Quantity
-- Date
-- Amount
-- Total
-- Email
-- Address
-- Taxable Value
-- SGST Amount
-- CGST Amount
-- IGST Amount
-- SGST Rate
-- CGST Rate
-- IGST Rate
-- Tax Amount
-- Tax Rate
-- Final Amount
-- Invoice Date
-- Place of Supply
-- Place of Origin
-- GSTIN Supplier
-- GSTIN Recipient
-
-**Provide the output strictly in valid JSON format with no additional text, explanations, or comments. Ensure all keys are correctly spelled and correspond to the field names above. Do not include any trailing commas or syntax errors.**
-
-Here is the invoice data:
-{pages}
-'''
-    prompt = prompt_template.format(pages=pages_data)
-
-    data = {
-        "messages": [
-            {"role": "system", "content": "You are a helpful and accurate assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        "max_tokens": 1000,  # Increased tokens for detailed extraction
-        "temperature": 0.3    # Lower temperature for more deterministic output
-    }
-
-    try:
-        response = requests.post(GPT4V_ENDPOINT, headers=headers, json=data)
-        if response.status_code == 200:
-            response_json = response.json()
-            llm_extracted_data = response_json.get("choices", [])[0].get("message", {}).get("content", "")
-            logging.info(f"Raw API response for data extraction: {llm_extracted_data}")
-            return llm_extracted_data
-        elif response.status_code == 429:
-            # Rate limit exceeded
-            logging.warning("Rate limit exceeded!!!!!. Retrying after 10 seconds...")
-            st.warning("Rate limit exceeded !!!!!. Retrying after 10 seconds...")
-            time.sleep(10)  # Wait for 10 seconds before retrying
-            return call_openai_api(pages_data)
-        else:
-            logging.error(f"API call failed: {response.status_code} - {response.text}")
-            st.error(f"Error during API call: {response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        logging.error(f"Exception during API call: {e}")
-        st.error(f"An error occurred during API call: {e}")
-        return None     #str or None: The raw extracted data from the API if successful; otherwise, None.
-
-
-
-
-# Validates the extracted data fields using regex patterns and assigns confidence levels.
-def validate_data(field, value): # field (str): The name of the field.  value (str): The extracted value of the field.
-    
-    patterns = {
-        'Invoice No.': r'^[A-Za-z0-9\-]+$',
-        'Quantity': r'^\d+(\.\d+)?$',
-        'Date': r'^\d{2}/\d{2}/\d{4}$',
-        'Amount': r'^\d+(\.\d+)?$',
-        'Total': r'^\d+(\.\d+)?$',
-        'Email': r'^[\w\.-]+@[\w\.-]+\.\w+$',
-        'GSTIN Supplier': r'^\d{2}[A-Z]{5}\d{4}[A-Z]{1}[A-Z\d]{1}[Z]{1}[A-Z\d]{1}$',
-        'GSTIN Recipient': r'^\d{2}[A-Z]{5}\d{4}[A-Z]{1}[A-Z\d]{1}[Z]{1}[A-Z\d]{1}$',
-        # Add more patterns as needed
-    }
-
-    if field in patterns:
-        if re.match(patterns[field], str(value).strip()):
-            return True, "High Confidence"
-        else:
-            return False, "Low Confidence"
-    else:
-        # For fields without specific patterns, basic non-empty check
-        if str(value).strip():
-            return True, "Medium Confidence"
-        else:
-            return False, "Low Confidence"    
-  
-
-# Extracts the first JSON object found in the raw text.  
-def extract_json(raw_text):  # raw_text (str): The raw text containing JSON.    
-                
-    pattern = r'\{.*\}'  # Matches the first occurrence of {...}
-    match = re.search(pattern, raw_text, re.DOTALL)
-    if match:
-        return match.group(0)
-    else:
-        return None
-    # str or None: The extracted JSON string if found; otherwise, None.
-
+POLL_SECONDS = 1.0  # how often a running job's progress table is refreshed
 
 
 
 ############################################################
-# 3. Main Function to Process PDF Files
-
-# Processes multiple PDF files to extract invoice data and compile it into a DataFrame.
-def create_docs(user_pdf_list):  # user_pdf_list (list): List of uploaded PDF files.
-
-    # Initialize DataFrame with additional columns for confidence and trust
-    df = pd.DataFrame(columns=[
-        'Invoice No.', 'Quantity', 'Date', 'Amount', 'Total',
-        'Email', 'Address', 'Taxable Value', 'SGST Amount',
-        'CGST Amount', 'IGST Amount', 'SGST Rate', 'CGST Rate',
-        'IGST Rate', 'Tax Amount', 'Tax Rate', 'Final Amount',
-        'Invoice Date', 'Place of Supply', 'Place of Origin',
-        'GSTIN Supplier', 'GSTIN Recipient',
-        'Confidence', 'Trust'
-    ])
-    
-    # Metrics 
-    metrics = {
-        'total_files': 0,
-        'successful_extractions': 0,
-        'field_accuracy': {field: {'correct': 0, 'total': 0} for field in df.columns if field not in ['Confidence', 'Trust']}
-    }
-    
-    for file in user_pdf_list:
-        metrics['total_files'] += 1
-        st.write(f"### Processing `{file.name}`...")
-        try:
-            raw_data = get_pdf_text(file)
-            if not raw_data.strip():
-                st.warning(f"No text extracted from `{file.name}`. Skipping.")
-                logging.warning(f"No text extracted from {file.name}.")
-                continue
-            
-            # Display extracted text for debugging
-            with st.expander(f"🔍 Extracted Text from `{file.name}`", expanded=False):
-                st.text_area("Extracted Text:", raw_data, height=300)
-            
-            llm_extracted_data = call_openai_api(raw_data)
-            if not llm_extracted_data:
-                st.error(f"Failed to extract data from `{file.name}`.")
-                logging.error(f"API response failed for {file.name}.")
-                continue
-
-            # Log the raw extracted data
-            logging.info(f"Raw extracted data for {file.name}: {llm_extracted_data}")
-            
-            # Display raw extracted data for debugging
-            with st.expander(f" Raw Extracted Data from `{file.name}`", expanded=False):
-                st.code(llm_extracted_data, language='json')
-
-            # Extract JSON from the raw response
-            json_text = extract_json(llm_extracted_data)
-            if not json_text:
-                logging.error(f"No JSON found in the API response for {file.name}.")
-                st.error(f"Error parsing extracted data from `{file.name}`: Invalid JSON.")
-                st.write("**Please ensure that the GPT-4 API returns valid JSON.**")
-                continue
-
-            # Parse the JSON text
-            try:
-                data_dict = json.loads(json_text)
-                logging.info(f"Extracted data from {file.name}: {data_dict}")
-            except json.JSONDecodeError as e:
-                logging.error(f"JSON decoding failed for {file.name}: {e}")
-                st.error(f"Error parsing extracted data from `{file.name}`: Invalid JSON.")
-                st.write("**Please ensure that the GPT-4 API returns valid JSON.**")
-                continue
-
-            # Validate each field and assess confidence
-            confidence_list = []
-            trust_list = []
-            for field in df.columns:
-                if field in ['Confidence', 'Trust']:
-                    continue
-                value = data_dict.get(field, "")
-                is_valid, confidence = validate_data(field, value)
-                confidence_list.append(confidence)
-                trust = "Trusted" if confidence in ["High Confidence", "Medium Confidence"] else "Untrusted"
-                trust_list.append(trust)
-                
-                # Update metrics
-                metrics['field_accuracy'][field]['total'] += 1
-                if is_valid:
-                    metrics['field_accuracy'][field]['correct'] += 1
-
-            # Add confidence and trust assessment
-            data_dict['Confidence'] = "; ".join(confidence_list)
-            data_dict['Trust'] = "Trusted" if "Low Confidence" not in confidence_list else "Untrusted"
-
-            # Append the extracted data to the DataFrame
-            df = pd.concat([df, pd.DataFrame([data_dict])], ignore_index=True)
-            metrics['successful_extractions'] += 1
-            st.success(f"**Extraction successful for `{file.name}`.** ")
-            logging.info(f"Extraction successful for {file.name}.")
-
-        except Exception as e:
-            logging.error(f"An error occurred while processing {file.name}: {e}")
-            st.error(f"An error occurred while processing `{file.name}`: {e}")
-
-    # Calculate accuracy rates
-    accuracy_rates = {}
-    for field, counts in metrics['field_accuracy'].items():
-        if counts['total'] > 0:
-            accuracy = (counts['correct'] / counts['total']) * 100
-            accuracy_rates[field] = f"{accuracy:.2f}%"
-        else:
-            accuracy_rates[field] = "N/A"
-
-    # Save the DataFrame to an Excel file
-    output_excel_file = "extracted_invoice_data.xlsx"
-    try:
-        df.to_excel(output_excel_file, index=False)
-        logging.info("DataFrame successfully saved to Excel.")
-    except Exception as e:
-        logging.error(f"Failed to save DataFrame to Excel: {e}")
-        st.error(f"Failed to save extracted data to Excel: {e}")
-
-    # Display metrics
-    st.write("###  Extraction Performance Metrics")
-    st.write(f"**Total Files Processed:** {metrics['total_files']}")
-    st.write(f"**Successful Extractions:** {metrics['successful_extractions']}")
-    
-    metrics_df = pd.DataFrame.from_dict(accuracy_rates, orient='index', columns=['Accuracy Rate'])
+# 2. Background Jobs
+
+# One job queue per server, shared by every session, so concurrent users share its worker processes.
+@st.cache_resource
+def get_job_queue():
+
+    return JobQueue()  # JobQueue: The server's queue.
+
+
+# Invoice rows and line items of a finished job, including the stored rows its copies reused. Finished
+# jobs never change, so each is read from the store once.
+@st.cache_data(show_spinner=False)
+def job_results(job_id):  # job_id (str): A finished job (also its run id in the store).
+
+    return get_job_queue().results(job_id)  # tuple: (invoice DataFrame, line item DataFrame).
+
+
+# Per-file stage and outcome of a job, in upload order.
+def files_table(job_id):
+
+    files = get_job_queue().files(job_id)
+    return pd.DataFrame(files, columns=['name', 'stage', 'status', 'message']).rename(
+        columns={'name': 'File', 'stage': 'Stage', 'status': 'Outcome', 'message': 'Message'})
+
+
+# Live progress of a queued or running job. Only this fragment reruns while polling; the whole page
+# reruns once when the job has finished, to show its results.
+@st.fragment(run_every=POLL_SECONDS)
+def show_job_progress(job_id):
+
+    job = get_job_queue().job(job_id)
+    if job is None or job['status'] not in ACTIVE:
+        st.rerun()
+    if job['queue_position']:
+        st.info(f"Waiting for {job['queue_position']} earlier job(s) to finish...")
+    st.progress(job['done'] / max(job['total'], 1), text=f"{job['done']} of {job['total']} file(s) processed")
+    st.dataframe(files_table(job_id), hide_index=True)
+
+
+# Results of a finished job: the per-file outcomes, extracted rows, line items, accuracy and metrics.
+def show_job_results(job_id):
+
+    queue = get_job_queue()
+    job = queue.job(job_id)
+    if job is None:
+        return
+    if job['status'] != DONE:
+        st.error(f"Extraction did not finish: {job['error']}")
+        st.dataframe(files_table(job_id), hide_index=True)
+        return
+    st.session_state['run_id'] = job_id
+
+    st.write("### Files")
+    st.dataframe(files_table(job_id), hide_index=True)
+    # Extracted text and raw replies are loaded for one file at a time
+    names = [file['name'] for file in queue.files(job_id)]
+    position = st.selectbox("🔍 Extracted text and raw reply for", range(len(names)), format_func=lambda index: names[index])
+    if position is not None:
+        text, raw_response = queue.file_details(job_id, position)
+        with st.expander(f"Extracted Text from `{names[position]}`", expanded=False):
+            st.text_area("Extracted Text:", text or "", height=300)
+        with st.expander(f"Raw Extracted Data from `{names[position]}`", expanded=False):
+            st.code(raw_response or "", language='json')
+
+    df, items = job_results(job_id)
+    if df.empty:
+        st.warning("⚠️ No data extracted from the uploaded PDFs.")
+        return
+    st.write("### Extracted Data:")
+    st.dataframe(df)
+
+    # Line items, with the invoices whose items do not add up to the Taxable Value or Final Amount
+    if len(items):
+        with st.expander(f"🧾 Line Items ({len(items)})", expanded=False):
+            st.dataframe(items)
+        mismatched = df.loc[df['Line Items Match'].eq(False).fillna(False), 'File']
+        if len(mismatched):
+            st.warning(f"Line items do not add up to the taxable value or final amount for: {', '.join(mismatched)}")
+
+    show_run_metrics(job['metrics'], job['metrics_prom'], job['profile_path'])
+
+    metrics_df = pd.DataFrame.from_dict(job['accuracy'], orient='index', columns=['Accuracy Rate'])
     metrics_df.index.name = 'Field'
     st.write("**Per-Field Accuracy Rates:**")
     st.dataframe(metrics_df.style.highlight_max(color='lightgreen'))
 
-    # Provide download options
-    with open(output_excel_file, "rb") as f:
-        excel_data = f.read()
-    st.download_button(
-        "Download Extracted Data as Excel",
-        data=excel_data,
-        file_name=output_excel_file,
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
-    
-    # Additionally, allow downloading as CSV
-    csv = df.to_csv(index=False).encode('utf-8')
-    st.download_button(
-        "Download Extracted Data as CSV",
-        data=csv,
-        file_name="extracted_invoice_data.csv",
-        mime="text/csv"
-    )
-
-    # Display trust assessment summary
+    # Provide a summary of trust assessments
     trusted = df['Trust'].value_counts().get('Trusted', 0)
     untrusted = df['Trust'].value_counts().get('Untrusted', 0)
     st.write(f"**Trusted Data Points:** {trusted}")
     st.write(f"**Untrusted Data Points:** {untrusted}")
+    st.success("Extraction complete!")
 
-    return df     # pd.DataFrame: DataFrame containing all extracted invoice data.
 
 
+# Per-stage latency and size histograms for the run, its counters, and JSON / Prometheus downloads.
+def show_run_metrics(snapshot, prometheus, profile_path=None):  # snapshot (dict): StageMetrics.snapshot() of the job.  prometheus (str): The same in Prometheus text format.  profile_path (str): Profiler report, if one was written.
 
+    st.write("###  Extraction Performance Metrics")
+    counters = snapshot['counters']
+    st.write(f"**Run Time:** {snapshot['elapsed_seconds']:.1f}s for {counters.get('files', 0)} file(s), "
+             f"{counters.get('status_ok', 0)} extracted")
+
+    stages_df = pd.DataFrame([dict(stage=name, **summary) for name, summary in snapshot['stages'].items()])
+    if not stages_df.empty:
+        st.write("**Stage Latencies (seconds) and Token Counts:**")
+        st.dataframe(stages_df.set_index('stage').style.format(precision=3))
+
+    counters_df = pd.DataFrame(sorted(counters.items()), columns=['Counter', 'Value']).set_index('Counter')
+    st.write("**Counters:**")
+    st.dataframe(counters_df)
+
+    # API requests, retries and 429s of this job are among the counters (api_*) when the provider is Azure
+    st.download_button("Download Metrics (JSON)", data=json.dumps(snapshot, indent=2), file_name="extraction_metrics.json", mime="application/json")
+    st.download_button("Download Metrics (Prometheus)", data=prometheus, file_name="extraction_metrics.prom", mime="text/plain")
+    if profile_path:
+        st.write(f"**Profile written to:** `{profile_path}`")
+
+
+
+# Download section: the file is built from the store when the user asks for it, for this run or for
+# every invoice stored so far (amounts, rates and dates come out typed).
+def show_exports():
+
+    store = get_default_store()
+    run_id = st.session_state.get('run_id')
+    if run_id is None and store.count() == 0:
+        return
+    st.write("### Download Extracted Data")
+    scopes = (["This run"] if run_id else []) + ["All stored invoices"]
+    scope = st.radio("Rows", scopes, horizontal=True)
+    labels = {'Excel': 'xlsx', 'CSV': 'csv', 'Parquet': 'parquet'}
+    label = st.selectbox("Format", list(labels))
+    if st.button("Prepare Download"):
+        fmt = labels[label]
+        try:
+            data = store.export(fmt, run_id if scope == "This run" else None)
+        except Exception as e:
+            logging.error(f"Export to {fmt} failed: {e}")
+            st.error(f"Export failed: {e}")
+            return
+        st.download_button(f"Download Extracted Data as {label}", data=data,
+                           file_name=f"extracted_invoice_data.{fmt}", mime=EXPORT_FORMATS[fmt])
 
 
 
 #############################################################
-# 4. Streamlit Application
+# 3. Streamlit Application
 
 
 def main():
@@ -374,27 +193,25 @@ def main():
         accept_multiple_files=True
     )
 
+    force = st.checkbox("Process again even if these files were processed before")
     if st.button("Extract Data"):
         if pdf_files:
-            with st.spinner('Processing your invoices...'):
-                df = create_docs(pdf_files)
-                
-                if not df.empty:
-                    st.write("### Extracted Data:")
-                    st.dataframe(df)
-    
-                    # Provide a summary of trust assessments
-                    trusted = df['Trust'].value_counts().get('Trusted', 0)
-                    untrusted = df['Trust'].value_counts().get('Untrusted', 0)
-                    st.write(f"**Trusted Data Points:** {trusted}")
-                    st.write(f"**Untrusted Data Points:** {untrusted}")
-                    
-                    st.success("Extraction complete!")
-                else:
-                    st.warning("⚠️ No data extracted from the uploaded PDFs.")
+            # The job runs in the background; this session only keeps its id and polls it
+            st.session_state['job_id'] = get_job_queue().submit(pdf_files, force=force)
+            st.session_state.pop('run_id', None)
         else:
             st.error("Please upload at least one PDF file.")
 
+    job_id = st.session_state.get('job_id')
+    if job_id:
+        job = get_job_queue().job(job_id)
+        if job is not None and job['status'] in ACTIVE:
+            show_job_progress(job_id)
+        else:
+            show_job_results(job_id)
+
+    show_exports()
+
 
 
 
@@ -0,0 +1,274 @@
+# Reusable chat-completions client: pooled keep-alive connections, client-side rate limiting,
+# bounded retries with jittered exponential backoff, and throughput / 429 metrics.
+import os
+import json
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from stage_metrics import LLM_REQUEST, PROMPT_TOKENS, COMPLETION_TOKENS, observe
+
+###########################################################################
+# 1. Configuration
+
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# Reads a numeric setting from the environment, returning default when unset or empty.
+def _env_number(name, default, cast=float):
+
+    value = os.getenv(name)
+    return cast(value) if value not in (None, "") else default
+
+
+
+###################################################################
+# 2.  Rate Limiting
+
+# Token bucket refilled continuously at rate_per_minute, holding at most one minute of capacity.
+class TokenBucket:
+
+    def __init__(self, rate_per_minute):  # rate_per_minute (float): Sustained rate; None or 0 disables the bucket.
+        self.rate_per_second = (rate_per_minute or 0) / 60.0
+        self.capacity = float(rate_per_minute or 0)
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+
+    # Takes `amount` if available; otherwise returns how long to wait before trying again.
+    def try_take(self, amount):
+        if not self.rate_per_second:
+            return 0.0
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+        amount = min(amount, self.capacity)  # a single oversized request must still be able to go through
+        if self.available >= amount:
+            self.available -= amount
+            return 0.0
+        return (amount - self.available) / self.rate_per_second
+
+
+# Client-side limiter sized to the deployment quota: requests per minute and tokens per minute.
+class RateLimiter:
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self._lock = threading.Lock()
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    # Blocks until one request costing `tokens` fits in both buckets.
+    def acquire(self, tokens):
+        while True:
+            with self._lock:
+                wait = self.requests.try_take(1)
+                if wait == 0.0:
+                    wait = self.tokens.try_take(tokens)
+                    if wait == 0.0:
+                        return
+                    self.requests.available += 1  # give the request slot back while waiting for tokens
+            time.sleep(wait)
+
+
+
+###################################################################
+# 3.  Metrics
+
+# Thread-safe counters for tuning concurrency against the quota.
+class ApiMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.counts = {
+            'requests': 0,       # HTTP attempts, including retries
+            'successes': 0,
+            'failures': 0,       # calls that gave up
+            'retries': 0,
+            'rate_limited': 0,   # HTTP 429 responses
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+        }
+        self.latency_total = 0.0
+
+    def add(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self.counts[name] += value
+
+    def add_latency(self, seconds):
+        with self._lock:
+            self.latency_total += seconds
+
+    # Returns counters plus derived throughput and mean latency.
+    def snapshot(self):
+        with self._lock:
+            snapshot = dict(self.counts)
+            elapsed = max(time.monotonic() - self.started_at, 1e-9)
+            snapshot['requests_per_second'] = snapshot['successes'] / elapsed
+            snapshot['mean_latency_seconds'] = self.latency_total / snapshot['requests'] if snapshot['requests'] else 0.0
+        return snapshot
+
+
+
+###################################################################
+# 4.  Client
+
+# Seconds to wait according to a Retry-After (or Azure retry-after-ms) header, or None if absent.
+def retry_after_seconds(response):  # response (requests.Response): The throttled response.
+
+    retry_after_ms = response.headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+# Rough token count for rate limiting: ~4 characters per token plus the completion budget.
+def estimate_tokens(payload):  # payload (dict): The chat-completions request body.
+
+    prompt_chars = sum(len(message.get("content", "")) for message in payload.get("messages", []))
+    return prompt_chars // 4 + payload.get("max_tokens", 0)
+
+
+class ChatCompletionClient:
+
+    def __init__(self, endpoint, api_key, timeout=60.0, connect_timeout=10.0, max_retries=5,
+                 backoff_base=1.0, backoff_max=60.0, requests_per_minute=None, tokens_per_minute=None,
+                 pool_size=10):
+        self.endpoint = endpoint
+        self.timeout = (connect_timeout, timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.metrics = ApiMetrics()
+
+        # One keep-alive pool shared by every worker thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "api-key": api_key or "",
+        })
+
+    # Full-jitter exponential backoff, never shorter than the server's Retry-After.
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after) + random.uniform(0, self.backoff_base)
+        return delay
+
+    # Reads a server-sent-events completion, passing each content delta to on_delta. Reading stops early
+    # (and the connection is released) when on_delta returns True.
+    def _read_stream(self, response, on_delta=None):
+        parts = []
+        if on_delta:
+            on_delta(None)  # a retried stream starts over
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                if delta:
+                    parts.append(delta)
+                    if on_delta and on_delta(delta):
+                        break
+        finally:
+            response.close()
+        return "".join(parts)
+
+    # Posts a chat-completions payload and returns the message content, or None once retries are exhausted.
+    # With stream=True the reply is read incrementally; a stream cut off mid-way is retried like a failed request.
+    def complete(self, payload, stream=False, on_delta=None):  # payload (dict): The chat-completions request body.  on_delta (callable): Streaming only; called with each delta (None when a retry restarts the stream), return True to stop reading.
+
+        tokens = estimate_tokens(payload)
+        call_started = time.monotonic()
+        if stream:
+            payload = dict(payload, stream=True)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(tokens)
+            self.metrics.add(requests=1)
+            started = time.monotonic()
+            retry_after = None
+            try:
+                response = self.session.post(self.endpoint, json=payload, timeout=self.timeout, stream=stream)
+                if response.status_code == 200:
+                    # A malformed or empty body is retried like a failed request
+                    if stream:
+                        content, usage = self._read_stream(response, on_delta), {}  # streamed replies carry no usage block
+                    else:
+                        response_json = response.json()
+                        content = response_json["choices"][0]["message"].get("content", "")
+                        usage = response_json.get("usage") or {}
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                    ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                logging.warning(f"API request failed on attempt {attempt + 1}: {e!r}")
+                reason = repr(e)
+            else:
+                self.metrics.add_latency(time.monotonic() - started)
+                if response.status_code == 200:
+                    self.metrics.add(successes=1, prompt_tokens=usage.get("prompt_tokens", 0),
+                                     completion_tokens=usage.get("completion_tokens", 0))
+                    observe(LLM_REQUEST, time.monotonic() - call_started)
+                    if usage:
+                        observe(PROMPT_TOKENS, usage.get("prompt_tokens", 0))
+                        observe(COMPLETION_TOKENS, usage.get("completion_tokens", 0))
+                    return content
+                if response.status_code not in RETRY_STATUS_CODES:
+                    logging.error(f"API call failed: {response.status_code} - {response.text}")
+                    self.metrics.add(failures=1)
+                    response.close()
+                    return None
+                if response.status_code == 429:
+                    self.metrics.add(rate_limited=1)
+                retry_after = retry_after_seconds(response)
+                reason = f"HTTP {response.status_code}"
+                response.close()  # a streamed response holds its connection until closed
+
+            if attempt == self.max_retries:
+                break
+            delay = self._backoff(attempt, retry_after)
+            logging.warning(f"{reason}; retrying in {delay:.1f}s (attempt {attempt + 1} of {self.max_retries}).")
+            self.metrics.add(retries=1)
+            time.sleep(delay)
+
+        logging.error(f"API call gave up after {self.max_retries + 1} attempts.")
+        self.metrics.add(failures=1)
+        return None     # str or None: The message content if successful; otherwise, None.
+
+
+# Builds a client from the GPT4V_* and API_* environment settings.
+def client_from_env(endpoint, api_key):
+
+    return ChatCompletionClient(
+        endpoint, api_key,
+        timeout=_env_number("API_TIMEOUT_SECONDS", 60.0),
+        connect_timeout=_env_number("API_CONNECT_TIMEOUT_SECONDS", 10.0),
+        max_retries=_env_number("API_MAX_RETRIES", 5, int),
+        backoff_base=_env_number("API_BACKOFF_BASE_SECONDS", 1.0),
+        backoff_max=_env_number("API_BACKOFF_MAX_SECONDS", 60.0),
+        requests_per_minute=_env_number("API_REQUESTS_PER_MINUTE", None),
+        tokens_per_minute=_env_number("API_TOKENS_PER_MINUTE", None),
+        pool_size=max(_env_number("API_MAX_IN_FLIGHT", 4, int), 1),
+    )
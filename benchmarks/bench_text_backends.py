@@ -0,0 +1,48 @@
+# Compares the PDF text backends on a generated corpus of text, scanned and mixed PDFs.
+#
+#   python benchmarks/bench_text_backends.py --documents 20 --pages 10
+#   python benchmarks/bench_text_backends.py --ocr      # include OCR of scanned/mixed pages (slow)
+#   python benchmarks/bench_text_backends.py --ocr --ocr-mode roi
+import os
+import sys
+import time
+import argparse
+import fitz  # PyMuPDF, used to count pages
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from text_backends import BACKENDS, extract_text
+from corpus import make_corpus
+
+###################################################################
+# 1.  Benchmark
+
+def run(corpus, ocr):
+
+    print(f"{'backend':<10}{'corpus':<10}{'seconds':>10}{'pages/s':>10}{'chars':>10}")
+    for name, backend_class in BACKENDS.items():
+        backend = backend_class()
+        for kind, pdfs in corpus.items():
+            pages = sum(fitz.open(stream=pdf, filetype="pdf").page_count for pdf in pdfs)
+            started = time.perf_counter()
+            chars = sum(len(extract_text(pdf, backend=backend, ocr=ocr)) for pdf in pdfs)
+            elapsed = time.perf_counter() - started
+            print(f"{name:<10}{kind:<10}{elapsed:>10.3f}{pages / elapsed:>10.1f}{chars:>10}")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the PDF text backends.")
+    parser.add_argument("--documents", type=int, default=20, help="PDFs per corpus kind.")
+    parser.add_argument("--pages", default="10", help="Pages per PDF, or a min-max range such as 1-10.")
+    parser.add_argument("--ocr", action="store_true", help="Also OCR scanned and mixed pages (needs Tesseract).")
+    parser.add_argument("--ocr-mode", choices=["page", "roi"], help="Whole-page or region OCR (default: OCR_MODE).")
+    args = parser.parse_args(argv)
+    if args.ocr_mode:
+        os.environ["OCR_MODE"] = args.ocr_mode
+
+    corpus = make_corpus(args.documents, args.pages)
+    run(corpus, args.ocr)
+
+
+if __name__ == "__main__":
+    main()
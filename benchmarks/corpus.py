@@ -0,0 +1,148 @@
+# Synthetic invoice corpus for the benchmarks: text, scanned and mixed PDFs with a configurable
+# page count, generated deterministically from a seed with PyMuPDF.
+#
+#   python benchmarks/corpus.py out/ --documents 50 --pages 1-4 --kinds text scanned
+import os
+import random
+import argparse
+import fitz  # PyMuPDF
+
+###########################################################################
+# 1. Configuration
+
+
+KINDS = ("text", "scanned", "mixed")
+SUPPLIER_GSTIN = "27AAPFU0939F1ZV"
+RECIPIENT_GSTIN = "29AABCT1332L1ZA"
+ITEMS_PER_PAGE = 12
+SCAN_DPI = 100
+
+HEADER = [
+    "TAX INVOICE",
+    "Supplier: Example Traders Pvt Ltd, 12 MG Road, Pune, Maharashtra",
+    "GSTIN Supplier: {supplier}",
+    "Invoice No.: INV-{number}",
+    "Invoice Date: {day:02d}/{month:02d}/2024",
+]
+BILL_TO = [
+    "Bill To: Example Buyer LLP, 4 Residency Road, Bengaluru, Karnataka",
+    "GSTIN Recipient: {recipient}",
+    "Place of Supply: Karnataka (29)",
+]
+TOTALS = [
+    "Taxable Value: {taxable:,.2f}",
+    "CGST @ 9%: {half_tax:,.2f}",
+    "SGST @ 9%: {half_tax:,.2f}",
+    "Tax Amount: {tax:,.2f}",
+    "Final Amount: {final:,.2f}",
+]
+TERMS = [
+    "Terms and conditions",
+    "Goods once sold will not be taken back. Interest at 18% p.a. is charged on overdue bills.",
+    "Subject to Pune jurisdiction. This is a computer generated invoice.",
+]
+
+
+
+###################################################################
+# 2.  Generation
+
+# Lines of one invoice, split into pages: the header repeats on every page, line items are spread
+# over the pages, and totals and terms end the last page.
+def invoice_pages(pages, rng):  # pages (int): Page count.  rng (random.Random): Seeded source.
+
+    items = []
+    for number in range(1, pages * ITEMS_PER_PAGE - 4):
+        quantity, rate = rng.randint(1, 20), rng.randint(100, 5000)
+        items.append((f"{number:>3}  Item {rng.randint(1000, 9999)}  HSN 9983  {quantity} Nos  {rate:,.2f}  {quantity * rate:,.2f}", quantity * rate))
+    taxable = sum(amount for _, amount in items)
+    half_tax = round(taxable * 0.09, 2)
+    values = dict(supplier=SUPPLIER_GSTIN, recipient=RECIPIENT_GSTIN, number=rng.randint(1000, 9999),
+                  day=rng.randint(1, 28), month=rng.randint(1, 12),
+                  taxable=taxable, half_tax=half_tax, tax=2 * half_tax, final=taxable + 2 * half_tax)
+
+    header = [line.format(**values) for line in HEADER]
+    result = []
+    for page_number in range(pages):
+        lines = list(header)
+        if page_number == 0:
+            lines += [line.format(**values) for line in BILL_TO]
+        lines += [line for line, _ in items[page_number * ITEMS_PER_PAGE:(page_number + 1) * ITEMS_PER_PAGE]]
+        if page_number == pages - 1:
+            lines += [line.format(**values) for line in TOTALS] + TERMS
+        lines.append(f"Page {page_number + 1} of {pages}")
+        result.append("\n".join(lines))
+    return result  # list: Text per page.
+
+
+# Renders text to a grayscale pixmap, standing in for a scanned page.
+def scanned_pixmap(text):
+
+    scratch = fitz.open()
+    page = scratch.new_page()
+    page.insert_text((50, 72), text, fontsize=9)
+    pixmap = page.get_pixmap(dpi=SCAN_DPI, colorspace=fitz.csGRAY)
+    scratch.close()
+    return pixmap
+
+
+# Builds one PDF whose pages are all of the given kind: 'text', 'scanned' or 'mixed'.
+def make_pdf(kind, pages, rng):  # kind (str): Page kind.  pages (int): Page count.  rng (random.Random): Seeded source.
+
+    doc = fitz.open()
+    for text in invoice_pages(pages, rng):
+        page = doc.new_page()
+        if kind in ("text", "mixed"):
+            page.insert_text((50, 72), text, fontsize=9)
+        if kind in ("scanned", "mixed"):
+            page.insert_image(page.rect, pixmap=scanned_pixmap(text))
+    data = doc.tobytes()
+    doc.close()
+    return data  # bytes: The PDF.
+
+
+# Parses a page-count spec: "3" or a range "1-4".
+def page_range(spec):
+
+    first, _, last = str(spec).partition("-")
+    return int(first), int(last or first)  # tuple: (min pages, max pages).
+
+
+# Generates documents per kind in memory. Page counts are drawn from the range with the same seed.
+def make_corpus(documents, pages=1, kinds=KINDS, seed=0):  # pages (int or str): Pages per PDF, or a "min-max" range.
+
+    rng = random.Random(seed)
+    low, high = page_range(pages)
+    return {kind: [make_pdf(kind, rng.randint(low, high), rng) for _ in range(documents)] for kind in kinds}  # dict: kind -> PDF bytes.
+
+
+# Writes a corpus to <directory>/<kind>/invoice_<n>.pdf and returns the paths per kind.
+def write_corpus(directory, documents, pages=1, kinds=KINDS, seed=0):
+
+    paths = {}
+    for kind, pdfs in make_corpus(documents, pages, kinds, seed).items():
+        os.makedirs(os.path.join(directory, kind), exist_ok=True)
+        paths[kind] = []
+        for number, data in enumerate(pdfs):
+            path = os.path.join(directory, kind, f"invoice_{number:04d}.pdf")
+            with open(path, "wb") as f:
+                f.write(data)
+            paths[kind].append(path)
+    return paths  # dict: kind -> list of paths.
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic invoice corpus.")
+    parser.add_argument("directory", help="Output directory.")
+    parser.add_argument("--documents", type=int, default=20, help="PDFs per kind.")
+    parser.add_argument("--pages", default="1", help="Pages per PDF, or a min-max range such as 1-4.")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=list(KINDS))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    paths = write_corpus(args.directory, args.documents, args.pages, args.kinds, args.seed)
+    print(f"Wrote {sum(len(kind_paths) for kind_paths in paths.values())} PDF(s) to {args.directory}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# Local stand-in for the Azure chat-completions endpoint: configurable latency, injected HTTP 429s
+# and canned invoice JSON (an array for batched prompts, server-sent events when stream=true).
+# Deterministic for a given seed, so benchmark runs are comparable offline.
+#
+#   python benchmarks/mock_llm_server.py --port 8089 --latency 0.5 --rate-429 0.05
+#   GPT4V_ENDPOINT=http://127.0.0.1:8089/chat/completions GPT4V_KEY=mock python invoice_cli.py ...
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+###########################################################################
+# 1. Configuration
+
+
+# Arithmetically consistent, so reconciliation does not trigger extra requests
+CANNED_INVOICE = {
+    'Invoice No.': "INV-1001", 'Quantity': "1", 'Date': "16/07/2024", 'Amount': "1,000.00", 'Total': "1,180.00",
+    'Email': "accounts@example.com", 'Address': "12 MG Road, Pune, Maharashtra", 'Taxable Value': "1,000.00",
+    'SGST Amount': "90.00", 'CGST Amount': "90.00", 'IGST Amount': "", 'SGST Rate': "9%", 'CGST Rate': "9%",
+    'IGST Rate': "", 'Tax Amount': "180.00", 'Tax Rate': "18%", 'Final Amount': "1,180.00",
+    'Invoice Date': "16/07/2024", 'Place of Supply': "Karnataka (29)", 'Place of Origin': "Maharashtra",
+    'GSTIN Supplier': "27AAPFU0939F1ZV", 'GSTIN Recipient': "29AABCT1332L1ZA",
+}
+
+# Only whole delimiter lines; the prompt's instructions quote "=== INVOICE <id> START ===" mid-line
+BATCH_ID = re.compile(r'^=== INVOICE (\d+) START ===$', re.MULTILINE)
+STREAM_CHUNK_CHARS = 24
+
+
+
+###################################################################
+# 2.  Server
+
+class MockState:
+
+    def __init__(self, latency, jitter, rate_429, retry_after, seed, canned):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.canned = canned
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {'requests': 0, 'rate_limited': 0, 'completions': 0, 'streamed': 0, 'batched': 0}
+
+    # Draws (throttle?, delay) under the lock so the sequence only depends on the seed and request order.
+    def draw(self):
+        with self._lock:
+            self.counts['requests'] += 1
+            throttled = self._rng.random() < self.rate_429
+            delay = max(0.0, self._rng.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            if throttled:
+                self.counts['rate_limited'] += 1
+            return throttled, delay
+
+    def add(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+# Reply content for a prompt: one object, or an array with one object per batched invoice id.
+def canned_reply(prompt, canned):
+
+    invoice_ids = BATCH_ID.findall(prompt)
+    if invoice_ids:
+        return json.dumps([dict(canned, invoice_id=invoice_id) for invoice_id in invoice_ids])
+    return json.dumps(canned)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real endpoint
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send_json(200, self.server.state.stats())
+
+    def do_POST(self):
+        state = self.server.state
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        throttled, delay = state.draw()
+        if throttled:
+            self._send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}}, {"Retry-After": str(state.retry_after)})
+            return
+
+        time.sleep(delay)
+        prompt = "".join(message.get("content", "") for message in payload.get("messages", []))
+        content = canned_reply(prompt, state.canned)
+        state.add('batched' if BATCH_ID.search(prompt) else 'completions')
+
+        if not payload.get("stream"):
+            self._send_json(200, {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4},
+            })
+            return
+
+        # Server-sent events; the connection closes at the end instead of using chunked encoding
+        state.add('streamed')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for start in range(0, len(content), STREAM_CHUNK_CHARS):
+            chunk = {"choices": [{"index": 0, "delta": {"content": content[start:start + STREAM_CHUNK_CHARS]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output clean
+
+
+# Starts the server on a background thread. Returns (server, endpoint URL); call server.shutdown() to stop.
+def start_server(latency=0.2, jitter=0.0, rate_429=0.0, retry_after=1, seed=0, port=0, canned=None):  # latency (float): Seconds per completion.  rate_429 (float): Share of requests answered with HTTP 429.
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(latency, jitter, rate_429, retry_after, seed, canned or CANNED_INVOICE)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/openai/deployments/mock/chat/completions"
+    return server, endpoint  # tuple: (ThreadingHTTPServer, endpoint URL).
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Run a mock chat-completions endpoint.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean seconds per completion.")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Standard deviation of the latency.")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Share of requests answered with HTTP 429.")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--canned", help="JSON file with the invoice object to return.")
+    args = parser.parse_args(argv)
+
+    canned = None
+    if args.canned:
+        with open(args.canned, encoding="utf-8") as f:
+            canned = json.load(f)
+    server, endpoint = start_server(args.latency, args.jitter, args.rate_429, args.retry_after, args.seed, args.port, canned)
+    print(f"Mock endpoint: {endpoint} (GET it for request counts). Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# Offline end-to-end benchmarks: a generated corpus goes through the real pipeline
+# (iter_invoice_records) against the mock chat-completions server, one scenario per subprocess so
+# peak RSS is measured per scenario. Reports files/s, stage p50/p95, peak RSS and API calls per invoice.
+#
+#   python benchmarks/run_benchmarks.py
+#   python benchmarks/run_benchmarks.py --scenarios text text_batched --documents 40 --output bench.json
+#   python benchmarks/run_benchmarks.py --baseline bench.json --max-regression 0.2   # exit 1 on a slowdown
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.append(REPO_DIR)
+sys.path.append(BENCH_DIR)
+
+###########################################################################
+# 1. Scenarios
+
+
+# name -> corpus kind, mock server settings and pipeline environment; 'max_calls_per_invoice' fails a
+# scenario that does not stay below that many API requests per invoice
+SCENARIOS = {
+    'text': {'kind': 'text', 'env': {}},
+    'text_batched': {'kind': 'text', 'env': {'API_BATCH_PROMPTS': '1'}, 'max_calls_per_invoice': 1},
+    'text_streamed': {'kind': 'text', 'env': {'API_STREAM_RESPONSES': '1'}},
+    'text_throttled': {'kind': 'text', 'rate_429': 0.1, 'env': {}},
+    'text_rules': {'kind': 'text', 'env': {'RULE_EXTRACTOR': '1'}, 'max_calls_per_invoice': 1},
+    'scanned': {'kind': 'scanned', 'needs': 'tesseract', 'env': {}},
+    'scanned_roi': {'kind': 'scanned', 'needs': 'tesseract', 'env': {'OCR_MODE': 'roi'}},
+    'mixed': {'kind': 'mixed', 'needs': 'tesseract', 'env': {}},
+}
+
+# Every scenario runs offline and without state carried over from earlier runs
+BASE_ENV = {
+    'GPT4V_KEY': 'mock',
+    'EXTRACTION_CACHE_DISABLED': '1',
+    'RULE_EXTRACTOR': '0',
+    'DUPLICATE_INDEX': '0',
+    'API_BACKOFF_BASE_SECONDS': '0.05',
+}
+
+
+
+###################################################################
+# 2.  Child Process
+
+def _quantiles(stage):
+
+    return {'p50': round(stage['p50'], 4), 'p95': round(stage['p95'], 4)} if stage else None
+
+
+# Runs one scenario's files through the pipeline in this process and returns its measurements.
+def run_one(paths, ocr_workers, api_in_flight):  # paths (list): PDF paths.
+
+    from invoice_cli import LocalPdf
+    from invoice_pipeline import iter_invoice_records
+    from extraction_cache import ExtractionCache
+    from stage_metrics import start_run, LLM_REQUEST, TEXT_EXTRACTION
+
+    files = [LocalPdf(path) for path in paths]
+    metrics = start_run()
+    statuses = {}
+    started = time.perf_counter()
+    for record in iter_invoice_records(files, max_ocr_workers=ocr_workers, max_api_in_flight=api_in_flight,
+                                       cache=ExtractionCache(enabled=False)):
+        statuses[record.status] = statuses.get(record.status, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    stages = metrics.snapshot()['stages']
+    result = {
+        'files': len(files),
+        'statuses': statuses,
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(len(files) / elapsed, 3),
+        'llm_request_seconds': _quantiles(stages.get(LLM_REQUEST)),
+        'text_extraction_seconds': _quantiles(stages.get(TEXT_EXTRACTION)),
+    }
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux
+        result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        result['peak_child_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    return result  # dict: Measurements.
+
+
+
+###################################################################
+# 3.  Driver
+
+# Runs a scenario in a fresh interpreter against a mock server configured for it.
+def run_scenario(name, paths, args):
+
+    from mock_llm_server import start_server
+
+    scenario = SCENARIOS[name]
+    server, endpoint = start_server(latency=args.latency, jitter=args.jitter, rate_429=scenario.get('rate_429', 0.0), seed=args.seed)
+    env = {**os.environ, **BASE_ENV, **scenario['env'], 'GPT4V_ENDPOINT': endpoint}  # later settings override earlier ones
+    command = [sys.executable, os.path.abspath(__file__), "--child", json.dumps({
+        'paths': paths, 'ocr_workers': args.ocr_workers, 'api_in_flight': args.api_in_flight})]
+    try:
+        completed = subprocess.run(command, env=env, cwd=args.work_dir, capture_output=True, text=True, check=False)
+        stats = server.state.stats()
+    finally:
+        server.shutdown()
+    if completed.returncode != 0:
+        raise RuntimeError(f"Scenario {name} failed:\n{completed.stderr}")
+
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result['api_calls_per_invoice'] = round(stats['requests'] / max(result['files'], 1), 3)
+    result['rate_limited'] = stats['rate_limited']
+    if 'max_calls_per_invoice' in scenario and result['api_calls_per_invoice'] >= scenario['max_calls_per_invoice']:
+        raise RuntimeError(f"Scenario {name} made {result['api_calls_per_invoice']} API calls per invoice; "
+                           f"expected fewer than {scenario['max_calls_per_invoice']}.")
+    return result  # dict: Measurements plus mock-server counts.
+
+
+# Scenarios whose throughput dropped by more than max_regression against a previous results file.
+def regressions(results, baseline, max_regression):
+
+    found = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous and result['files_per_second'] < previous['files_per_second'] * (1 - max_regression):
+            found.append(f"{name}: {previous['files_per_second']} -> {result['files_per_second']} files/s")
+    return found  # list: Descriptions of regressed scenarios.
+
+
+def print_table(results):
+
+    print(f"{'scenario':<16}{'files':>6}{'files/s':>10}{'llm p50':>9}{'llm p95':>9}{'text p95':>9}{'rss MB':>8}{'calls/inv':>10}")
+    for name, result in results.items():
+        llm = result['llm_request_seconds'] or {'p50': 0.0, 'p95': 0.0}
+        text = result['text_extraction_seconds'] or {'p95': 0.0}
+        print(f"{name:<16}{result['files']:>6}{result['files_per_second']:>10.2f}{llm['p50']:>9.3f}{llm['p95']:>9.3f}"
+              f"{text['p95']:>9.3f}{result.get('peak_rss_mb', 0):>8.1f}{result['api_calls_per_invoice']:>10.2f}")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Run the offline pipeline benchmarks.")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), help="Default: every scenario whose tools are installed.")
+    parser.add_argument("--documents", type=int, default=20, help="PDFs per scenario.")
+    parser.add_argument("--pages", default="1-3", help="Pages per PDF, or a min-max range.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock completion latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--ocr-workers", type=int, default=2)
+    parser.add_argument("--api-in-flight", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON.")
+    parser.add_argument("--baseline", help="Previous --output file; exit 1 when a scenario got slower.")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed files/s drop against the baseline.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        options = json.loads(args.child)
+        print(json.dumps(run_one(options['paths'], options['ocr_workers'], options['api_in_flight'])))
+        return 0
+
+    from corpus import write_corpus
+
+    names = args.scenarios or [name for name, scenario in SCENARIOS.items() if not scenario.get('needs') or shutil.which(scenario['needs'])]
+    skipped = [name for name in names if SCENARIOS[name].get('needs') and not shutil.which(SCENARIOS[name]['needs'])]
+    if skipped:
+        print(f"Skipping {', '.join(skipped)}: tesseract is not installed.", file=sys.stderr)
+        names = [name for name in names if name not in skipped]
+
+    args.work_dir = tempfile.mkdtemp(prefix="invoice_bench_")
+    try:
+        kinds = sorted({SCENARIOS[name]['kind'] for name in names})
+        corpus = write_corpus(os.path.join(args.work_dir, "corpus"), args.documents, args.pages, kinds, args.seed)
+        results = {}
+        for name in names:
+            print(f"Running {name}...", file=sys.stderr)
+            results[name] = run_scenario(name, corpus[SCENARIOS[name]['kind']], args)
+    finally:
+        shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            found = regressions(results, json.load(f), args.max_regression)
+        for line in found:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
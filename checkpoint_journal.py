@@ -0,0 +1,147 @@
+# Append-only checkpoint journal (JSONL) recording per-document progress, keyed by content hash.
+# A rerun replays it to skip finished documents and to resume partial ones from their last stage.
+# Only stages and metadata stay in memory; extracted text and raw responses are read back by file offset.
+import os
+import json
+import time
+import logging
+import threading
+
+###########################################################################
+# 1. Configuration
+
+
+DEFAULT_JOURNAL_PATH = ".extraction_journal.jsonl"
+DEFAULT_FSYNC_EVERY = 50        # entries
+DEFAULT_FSYNC_INTERVAL = 2.0    # seconds
+
+# Stages in the order a document moves through them
+STAGE_TEXT = 'text'       # text extracted; payload: text
+STAGE_DONE = 'done'       # parsed record; payload: raw_response, data
+STAGE_FAILED = 'failed'   # payload: status, error
+
+# Large payloads are not kept in memory: the journal remembers where the latest value is and reads it on demand
+LAZY_KEYS = ('text', 'raw_response')
+
+
+
+###################################################################
+# 2.  Journal
+
+class CheckpointJournal:
+
+    def __init__(self, path=None, fsync_every=DEFAULT_FSYNC_EVERY, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        self.path = path or os.getenv("CHECKPOINT_JOURNAL_PATH", DEFAULT_JOURNAL_PATH)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self.states = {}    # doc_hash -> latest stage and metadata, without the LAZY_KEYS payloads
+        self._offsets = {}  # doc_hash -> {lazy key: byte offset of the line holding its latest value}
+        self._replay()
+        self._file = open(self.path, "ab")
+        if self._file.tell() and not self._ends_with_newline():
+            self._file.write(b"\n")  # finish a line cut off by a crash, so the next entry starts cleanly
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def _ends_with_newline(self):
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    # Merges one entry into the state of its document; lazy payloads are only remembered by offset.
+    def _fold(self, entry, offset):
+        state = self.states.setdefault(entry['doc_hash'], {})
+        if entry['stage'] == STAGE_FAILED:
+            state.pop('data', None)  # a later failure supersedes an earlier result
+        offsets = self._offsets.setdefault(entry['doc_hash'], {})
+        for key, value in entry.items():
+            if key in LAZY_KEYS:
+                offsets[key] = offset
+            else:
+                state[key] = value
+
+    # Folds the existing journal into the latest state per document hash.
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                line_offset, offset = offset, offset + len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut off by a crash
+                self._fold(entry, line_offset)
+        logging.info(f"Replayed checkpoint journal {self.path}: {len(self.states)} document(s).")
+
+    # Appends one entry. Writes are buffered and fsynced every fsync_every entries or fsync_interval seconds.
+    def write(self, doc_hash, name, stage, **payload):  # stage (str): One of STAGE_TEXT, STAGE_DONE, STAGE_FAILED.
+        entry = dict(payload, doc_hash=doc_hash, name=name, stage=stage, at=time.time())
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(line)
+            self._fold(entry, offset)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._synced_at >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    # The lazy payloads of a document, read back from the journal file. Called with the lock held.
+    def _payloads(self, doc_hash):
+        offsets = self._offsets.get(doc_hash)
+        if not offsets:
+            return {}
+        self._file.flush()
+        payloads = {}
+        with open(self.path, "rb") as f:
+            for key, offset in offsets.items():
+                f.seek(offset)
+                payloads[key] = json.loads(f.readline()).get(key)
+        return payloads
+
+    # Latest known state for a document (its text and raw response read from disk), or an empty dict.
+    def state(self, doc_hash):
+        with self._lock:
+            return dict(self.states.get(doc_hash, {}), **self._payloads(doc_hash))
+
+    def is_done(self, doc_hash):
+        with self._lock:
+            return self.states.get(doc_hash, {}).get('stage') == STAGE_DONE
+
+    # Rewrites the journal with one entry per document, dropping superseded lines.
+    def compact(self):
+        with self._lock:
+            self._sync()
+            tmp_path = self.path + ".tmp"
+            offsets = {}
+            with open(tmp_path, "wb") as f:
+                for doc_hash, state in self.states.items():
+                    entry = dict(state, **self._payloads(doc_hash))
+                    offsets[doc_hash] = {key: f.tell() for key in self._offsets.get(doc_hash, {})}
+                    f.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._offsets = offsets
+            self._file = open(self.path, "ab")
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
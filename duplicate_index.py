@@ -0,0 +1,263 @@
+# Local index of processed invoices for catching re-sent copies (SQLite). Three checks, cheapest first:
+# exact content hash, near-duplicate text (SimHash over word shingles, looked up through banded columns so
+# a query touches a handful of rows even with hundreds of thousands stored), and the business key
+# (GSTIN Supplier, Invoice No., Final Amount) once fields are extracted. Near-duplicate text alone is not
+# enough to reuse a result: monthly invoices from one supplier differ in little more than number and date.
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from datetime import datetime
+from contextlib import contextmanager
+from invoice_validation import DATE_FORMATS
+
+###########################################################################
+# 1. Configuration
+
+
+DEFAULT_INDEX_PATH = ".duplicate_index.sqlite"
+DEFAULT_MAX_DISTANCE = 5     # differing SimHash bits still counted as the same document
+SHINGLE_WORDS = 3
+SIMHASH_BITS = 64
+BANDS = 6                    # 10-11 bit bands: any two hashes within 5 bits share at least one band exactly
+# (offset, width) of each band
+BAND_LAYOUT = [(sum(SIMHASH_BITS // BANDS + (index < SIMHASH_BITS % BANDS) for index in range(band)),
+                SIMHASH_BITS // BANDS + (band < SIMHASH_BITS % BANDS)) for band in range(BANDS)]
+MIN_AMOUNT_OVERLAP = 0.8     # near-duplicates must also share most of their amounts (guards against one
+                             # supplier's template matching with different numbers)
+
+# exact / near: the same invoice, stored result reused; key: same business key, flagged;
+# similar: near-duplicate text of a different invoice (e.g. next month's), extracted normally
+DUPLICATE_EXACT, DUPLICATE_NEAR, DUPLICATE_KEY, DUPLICATE_SIMILAR = 'exact', 'near', 'key', 'similar'
+
+WORD = re.compile(r'\w+')
+AMOUNT = re.compile(r'\d[\d,]*\.\d{2}\b')
+DATE = re.compile(r'\b(?:\d{1,2}[-/. ](?:\d{1,2}|[A-Za-z]{3})[-/. ]\d{2,4}|\d{4}-\d{2}-\d{2})\b')
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS documents (
+    doc_hash TEXT PRIMARY KEY,
+    name TEXT,
+    simhash INTEGER,
+    {", ".join(f"band{band} INTEGER" for band in range(BANDS))},
+    amounts TEXT,
+    gstin_supplier TEXT,
+    invoice_no TEXT,
+    final_amount INTEGER,
+    raw_response TEXT,
+    data TEXT,
+    indexed_at REAL NOT NULL
+);
+{"".join(f"CREATE INDEX IF NOT EXISTS documents_band{band} ON documents (band{band});" for band in range(BANDS))}
+CREATE INDEX IF NOT EXISTS documents_business_key ON documents (gstin_supplier, invoice_no, final_amount);
+'''
+
+
+# Index settings, read lazily so a .env loaded after import still applies.
+def duplicate_settings():
+
+    return {
+        'enabled': os.getenv("DUPLICATE_INDEX", "1").lower() in ("1", "true", "yes"),
+        'max_distance': int(os.getenv("DUPLICATE_MAX_DISTANCE", DEFAULT_MAX_DISTANCE)),
+    }  # dict: Duplicate detection settings.
+
+
+
+###################################################################
+# 2.  Fingerprints
+
+# 64-bit SimHash of the text's word shingles. Re-scans and re-exports of one invoice differ in a few
+# OCR'd words, which moves only a few bits (more on short invoices, where each word is a larger share).
+def simhash(text):  # text (str): Extracted invoice text.
+
+    words = WORD.findall(text.lower())
+    shingles = {" ".join(words[start:start + SHINGLE_WORDS]) for start in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)  # int: Unsigned 64-bit fingerprint.
+
+
+def _signed(value):
+
+    return value - (1 << SIMHASH_BITS) if value >= 1 << (SIMHASH_BITS - 1) else value  # SQLite integers are signed
+
+
+def bands(fingerprint):
+
+    return [fingerprint >> offset & ((1 << width) - 1) for offset, width in BAND_LAYOUT]
+
+
+def hamming(first, second):
+
+    return bin((first ^ second) & ((1 << SIMHASH_BITS) - 1)).count("1")
+
+
+# Amounts written in the text ("1,18,000.00" -> "118000.00"), compared alongside the SimHash.
+def amounts(text):
+
+    return {value.replace(",", "") for value in AMOUNT.findall(text)}  # set: Normalised amount strings.
+
+
+# (GSTIN Supplier, Invoice No., Final Amount in paise) with spelling normalised, or None if any part is missing.
+def business_key(data):  # data (dict): Extracted fields.
+
+    gstin = str(data.get('GSTIN Supplier') or "").strip().upper()
+    invoice_no = re.sub(r'[^0-9A-Z]', '', str(data.get('Invoice No.') or "").upper())
+    try:
+        final_amount = round(float(re.sub(r'[^\d.]', '', str(data.get('Final Amount') or ""))) * 100)
+    except ValueError:
+        return None
+    if not gstin or not invoice_no:
+        return None
+    return gstin, invoice_no, final_amount  # tuple or None: The business key.
+
+
+def _parse_date(text):
+
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _compact(text):
+
+    return re.sub(r'[^0-9A-Z]', '', text.upper())
+
+
+# Whether text belongs to the same invoice as stored fields: the stored supplier GSTIN, invoice number
+# and invoice date all appear in it. Without all three stored, nothing can be confirmed.
+def same_invoice(data, text):  # data (dict): Stored extracted fields.  text (str): Extracted text of the new document.
+
+    data = data or {}
+    gstin = _compact(str(data.get('GSTIN Supplier') or ""))
+    invoice_no = _compact(str(data.get('Invoice No.') or ""))
+    invoice_date = _parse_date(str(data.get('Invoice Date') or data.get('Date') or ""))
+    if not gstin or not invoice_no or invoice_date is None:
+        return False
+    words = [_compact(word) for word in text.split()]
+    # Invoice numbers are matched as whole words (or two adjacent words, "INV 1501"), not inside amounts
+    numbers = set(words) | {first + second for first, second in zip(words, words[1:])}
+    dates = {_parse_date(value) for value in DATE.findall(text)}
+    return gstin in _compact(text) and invoice_no in numbers and invoice_date in dates  # bool: Same invoice.
+
+
+
+###################################################################
+# 3.  Index
+
+class DuplicateIndex:
+
+    def __init__(self, path=None, max_distance=None):
+        self.path = path or os.getenv("DUPLICATE_INDEX_PATH", DEFAULT_INDEX_PATH)
+        self.max_distance = duplicate_settings()['max_distance'] if max_distance is None else max_distance
+        if self.max_distance >= BANDS:
+            logging.warning(f"DUPLICATE_MAX_DISTANCE={self.max_distance}: only near-duplicates sharing one of {BANDS} SimHash bands are found.")
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    # Opens a short-lived connection that commits on success and is always closed.
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _match(row, kind):
+        doc_hash, name, raw_response, data = row
+        return {'kind': kind, 'doc_hash': doc_hash, 'name': name, 'raw_response': raw_response,
+                'data': json.loads(data) if data else None}
+
+    # The stored result for identical document bytes, or None.
+    def find_exact(self, doc_hash):
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT doc_hash, name, raw_response, data FROM documents WHERE doc_hash = ?", (doc_hash,)).fetchone()
+        return self._match(row, DUPLICATE_EXACT) if row else None  # dict or None: kind, doc_hash, name, raw_response, data.
+
+    # The closest stored document whose text is a near-duplicate: SimHash within max_distance bits and
+    # at least MIN_AMOUNT_OVERLAP of the amounts in common. Its kind is 'near' only when it is the same
+    # invoice (see same_invoice), else 'similar'; a same-invoice candidate wins over a closer similar one.
+    def find_near(self, text, exclude_hash=None):  # text (str): Extracted text.  exclude_hash (str): The document itself.
+
+        fingerprint = simhash(text)
+        found = amounts(text)
+        conditions = " OR ".join(f"band{band} = ?" for band in range(BANDS))
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT doc_hash, name, raw_response, data, simhash, amounts FROM documents WHERE {conditions}",
+                                bands(fingerprint)).fetchall()
+        best = None
+        for doc_hash, name, raw_response, data, stored, stored_amounts in rows:
+            if doc_hash == exclude_hash or data is None:
+                continue
+            distance = hamming(fingerprint, stored)
+            if distance > self.max_distance:
+                continue
+            stored_amounts = set(json.loads(stored_amounts or "[]"))
+            union = found | stored_amounts
+            if union and len(found & stored_amounts) / len(union) < MIN_AMOUNT_OVERLAP:
+                continue
+            kind = DUPLICATE_NEAR if same_invoice(json.loads(data), text) else DUPLICATE_SIMILAR
+            rank = (kind != DUPLICATE_NEAR, distance)
+            if best is None or rank < best[0]:
+                best = (rank, kind, (doc_hash, name, raw_response, data))
+        return self._match(best[2], best[1]) if best else None  # dict or None: As find_exact, kind 'near' or 'similar'.
+
+    # A stored document with the same business key (a different file claiming the same invoice), or None.
+    def find_key(self, data, exclude_hash=None):  # data (dict): Extracted fields.
+
+        key = business_key(data or {})
+        if key is None:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT doc_hash, name, raw_response, data FROM documents"
+                " WHERE gstin_supplier = ? AND invoice_no = ? AND final_amount = ? AND doc_hash != ? LIMIT 1",
+                key + (exclude_hash or "",),
+            ).fetchone()
+        return self._match(row, DUPLICATE_KEY) if row else None  # dict or None: As find_exact.
+
+    # Records a processed document. Re-adding a document replaces its entry.
+    def add(self, doc_hash, name, text, raw_response=None, data=None):
+
+        fingerprint = simhash(text)
+        key = business_key(data or {}) or (None, None, None)
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO documents (doc_hash, name, simhash, {', '.join(f'band{band}' for band in range(BANDS))},"
+                " amounts, gstin_supplier, invoice_no, final_amount, raw_response, data, indexed_at)"
+                f" VALUES ({', '.join('?' * (BANDS + 10))})",
+                (doc_hash, name, _signed(fingerprint), *bands(fingerprint), json.dumps(sorted(amounts(text))),
+                 *key, raw_response, json.dumps(data, ensure_ascii=False) if data is not None else None, time.time()),
+            )
+
+    def count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+
+_default_index = None
+
+
+# Shared index at DUPLICATE_INDEX_PATH, or None when DUPLICATE_INDEX=0.
+def get_default_index():
+
+    global _default_index
+    if not duplicate_settings()['enabled']:
+        return None
+    if _default_index is None:
+        _default_index = DuplicateIndex()
+    return _default_index  # DuplicateIndex or None: The process-wide index.
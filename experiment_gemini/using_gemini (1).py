@@ -6,50 +6,39 @@ import streamlit as st
 import os
 import pandas as pd
 from PIL import Image
-import pytesseract
-import fitz  # PyMuPDF for PDF handling
-import google.generativeai as genai
+import sys
 import json  # Import the json module for safe parsing
 
+# Share the PDF text backends and LLM providers with the main app. Streamlit re-runs this script on every
+# interaction, so the repository is put on the path once (and ahead of anything with the same module names).
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+from text_backends import get_backend
+from llm_providers import chat_payload, document_parts, get_provider, image_part
+
 
 ##########################################################
 # Load environment variables
-load_dotenv()  # take environment variables from .env
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+load_dotenv()  # take environment variables from .env (GOOGLE_API_KEY, GEMINI_MODEL)
 
 
 ############################################################ 
-#To extract text from image or PDF
-def extract_text_from_file(uploaded_file):
+# To build the model input for an image or PDF: one kind of content per page type
+# (text layer for digital pages, the picture for scanned pages and images), never both copies
+def file_parts(uploaded_file):
     if uploaded_file.type in ["image/jpeg", "image/png"]:
-        image = Image.open(uploaded_file)
-        text = pytesseract.image_to_string(image)
+        parts = [image_part(Image.open(uploaded_file))]
     elif uploaded_file.type == "application/pdf":
-        pdf_document = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-        text = ""
-        for page in pdf_document:
-            text += page.get_text()
+        parts = document_parts(uploaded_file.getvalue(), backend=get_backend('pymupdf'))
     else:
         raise ValueError("Unsupported file type.")
-    return text
-
-#  To generate a response from the Gemini model
-def get_gemini_response(input_text, image_data, prompt):
-    model = genai.GenerativeModel('gemini-1.5-pro')
-    response = model.generate_content([input_text, image_data[0], prompt])
-    return response.text
-
-#  To setup the uploaded image for processing
-def input_image_setup(uploaded_file):
-    if uploaded_file is not None:
-        bytes_data = uploaded_file.getvalue()
-        image_parts = [{
-            "mime_type": uploaded_file.type,
-            "data": bytes_data
-        }]
-        return image_parts
-    else:
-        raise FileNotFoundError("No file uploaded")
+    return parts
+
+#  To generate responses from the Gemini model for several files at once; the model is created once and reused
+def get_gemini_responses(files_parts, prompt):
+    payloads = [chat_payload(prompt, parts) for parts in files_parts]
+    return get_provider('gemini').complete_many(payloads)
 
 
 ##############################################################################################
@@ -79,13 +68,24 @@ if uploaded_files:
     extracted_results = []
     accuracy_details = []
 
+    # Build every file's input first, then send the requests concurrently
+    files_parts = []
     for uploaded_file in uploaded_files:
         try:
-            text = extract_text_from_file(uploaded_file)
-            image_data = input_image_setup(uploaded_file)
+            files_parts.append(file_parts(uploaded_file))
+        except Exception as e:
+            st.error(f"Error reading {uploaded_file.name}: {e}")
+            files_parts.append(None)
+    responses = get_gemini_responses([parts for parts in files_parts if parts is not None], input_prompt)
+    responses = iter(responses)
 
-            # Generate response from the model
-            response = get_gemini_response(text, image_data, input_prompt)
+    for uploaded_file, parts in zip(uploaded_files, files_parts):
+        try:
+            if parts is None:
+                raise ValueError("the file could not be read")
+            response = next(responses)
+            if response is None:
+                raise ValueError("no response from the model")
             st.subheader(f"Response for {uploaded_file.name}:")
             st.write(response)
 
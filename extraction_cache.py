@@ -0,0 +1,179 @@
+# Persistent, content-addressed cache for extracted PDF text and raw LLM responses (SQLite).
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+###########################################################################
+# 1. Configuration
+
+
+DEFAULT_CACHE_PATH = ".extraction_cache.sqlite"
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+EVICT_EVERY_N_WRITES = 50
+
+LAYERS = ('text', 'response')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS text_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS text_cache_accessed ON text_cache (accessed_at);
+CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed_at);
+'''
+
+
+
+###################################################################
+# 2.  Keys
+
+# SHA-256 of the raw document bytes; identical uploads share an entry whatever their file name.
+def document_hash(pdf_bytes):  # pdf_bytes (bytes): The PDF content.
+
+    return hashlib.sha256(pdf_bytes).hexdigest()  # str: Hex digest.
+
+
+# Hash of everything that determines the model output: input text, prompt template and request parameters.
+def response_key(text, prompt_template, model_params):  # model_params (dict): Model/deployment settings sent with the request.
+
+    payload = json.dumps([text, prompt_template, model_params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()  # str: Hex digest.
+
+
+
+###################################################################
+# 3.  Cache
+
+# Two-layer cache: document hash -> extracted text, and request hash -> raw LLM response.
+# Every call opens its own connection, so one instance can be shared by worker threads.
+class ExtractionCache:
+
+    def __init__(self, path=None, max_age_days=None, max_bytes=None, enabled=True):
+        self.path = path or os.getenv("EXTRACTION_CACHE_PATH", DEFAULT_CACHE_PATH)
+        self.max_age_days = float(max_age_days if max_age_days is not None else os.getenv("EXTRACTION_CACHE_MAX_AGE_DAYS", DEFAULT_MAX_AGE_DAYS))
+        self.max_bytes = int(max_bytes if max_bytes is not None else os.getenv("EXTRACTION_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.counters = {layer: {'hits': 0, 'misses': 0} for layer in LAYERS}
+        if self.enabled:
+            with self._connect() as conn:
+                conn.executescript(SCHEMA)
+            self.evict()
+
+    # Opens a short-lived connection that commits on success and is always closed.
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _count(self, layer, outcome):
+        with self._lock:
+            self.counters[layer][outcome] += 1
+
+    def _get(self, layer, key):
+        if not self.enabled:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT value FROM {layer}_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute(f"UPDATE {layer}_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        self._count(layer, 'hits' if row is not None else 'misses')
+        return row[0] if row is not None else None
+
+    def _put(self, layer, key, value):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {layer}_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode('utf-8')), now, now)
+            )
+        with self._lock:
+            self._writes += 1
+            evict_now = self._writes % EVICT_EVERY_N_WRITES == 0
+        if evict_now:
+            self.evict()
+
+    # Returns the cached text for a document hash, or None.
+    def get_text(self, doc_hash):
+        return self._get('text', doc_hash)
+
+    def put_text(self, doc_hash, text):
+        self._put('text', doc_hash, text)
+
+    # Returns the cached raw response for a request key, or None.
+    def get_response(self, key):
+        return self._get('response', key)
+
+    def put_response(self, key, response):
+        self._put('response', key, response)
+
+    # Drops entries older than max_age_days, then least recently used entries until under max_bytes.
+    def evict(self):
+        if not self.enabled:
+            return
+        cutoff = time.time() - self.max_age_days * 86400
+        with self._connect() as conn:
+            removed = 0
+            for layer in LAYERS:
+                removed += conn.execute(f"DELETE FROM {layer}_cache WHERE created_at < ?", (cutoff,)).rowcount
+
+            total = sum(conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {layer}_cache").fetchone()[0] for layer in LAYERS)
+            while total > self.max_bytes:
+                oldest = conn.execute(
+                    "SELECT layer, key, size FROM ("
+                    " SELECT 'text' AS layer, key, size, accessed_at FROM text_cache"
+                    " UNION ALL SELECT 'response', key, size, accessed_at FROM response_cache"
+                    ") ORDER BY accessed_at LIMIT 100"
+                ).fetchall()
+                if not oldest:
+                    break
+                for layer, key, size in oldest:
+                    conn.execute(f"DELETE FROM {layer}_cache WHERE key = ?", (key,))
+                    total -= size
+                    removed += 1
+                    if total <= self.max_bytes:
+                        break
+        if removed:
+            logging.info(f"Extraction cache evicted {removed} entries.")
+
+    # Returns a copy of the hit/miss counters for both layers.
+    def stats(self):
+        with self._lock:
+            return {layer: dict(counts) for layer, counts in self.counters.items()}
+
+
+_default_cache = None
+
+
+# Shared cache instance configured from the environment. EXTRACTION_CACHE_DISABLED=1 bypasses it.
+def get_default_cache():
+
+    global _default_cache
+    if _default_cache is None:
+        enabled = os.getenv("EXTRACTION_CACHE_DISABLED", "0").lower() not in ("1", "true", "yes")
+        _default_cache = ExtractionCache(enabled=enabled)
+    return _default_cache  # ExtractionCache: The process-wide cache.
@@ -0,0 +1,317 @@
+# Headless batch entry point: runs the get_pdf_text -> call_openai_api -> validation pipeline
+# over a directory or glob of PDFs without a browser session (and without importing Streamlit).
+#
+#   python invoice_cli.py invoices/ --output results.csv
+#   python invoice_cli.py "scans/2024-*/*.pdf" --output results.jsonl --resume
+#   python invoice_cli.py invoices/ --output invoices.sqlite     # typed store that grows across runs
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import logging
+import argparse
+from invoice_core import INVOICE_FIELDS, OUTPUT_COLUMNS, provider_configured
+from invoice_pipeline import PipelineProgress, RecordBuffer, iter_invoice_records, reconcile_and_reextract
+from duplicate_index import DUPLICATE_SIMILAR
+from extraction_cache import ExtractionCache, document_hash, get_default_cache
+from checkpoint_journal import CheckpointJournal
+from stage_metrics import VALIDATION_FRAME, profiler_from_env, profiling, start_run
+
+###########################################################################
+# 1. Inputs
+
+
+# A PDF on disk that looks enough like an UploadedFile for the pipeline; bytes are read only when needed.
+class LocalPdf:
+
+    def __init__(self, path):
+        self.path = path
+        self.name = path
+
+    def seek(self, offset):
+        pass
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+# Expands directories (recursively) and glob patterns into a sorted, de-duplicated list of PDF paths.
+def find_pdfs(inputs):  # inputs (list): Directories, files or glob patterns.
+
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, "**", "*")
+            matches = glob.glob(pattern, recursive=True)
+        else:
+            matches = glob.glob(item, recursive=True)
+        paths.update(path for path in matches if os.path.isfile(path) and path.lower().endswith(".pdf"))
+    return sorted(paths)  # list: PDF paths.
+
+
+
+###################################################################
+# 2.  Output Sinks
+
+EXTRA_COLUMNS = ['File', 'Document Hash']
+RECONCILE_COLUMNS = ['Reconciled', 'Reconciliation Issues']
+FLUSH_ROWS = 200  # successful records validated and written together (one transaction for a sqlite store)
+
+
+# Output format from an explicit choice or the file extension.
+def output_format(path, fmt=None):
+
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    fmt = "sqlite" if fmt in ("db", "sqlite3") else fmt
+    if fmt not in ("csv", "jsonl", "parquet", "sqlite"):
+        raise ValueError(f"Unsupported output format '{fmt}'. Use csv, jsonl, parquet or sqlite.")
+    return fmt
+
+
+# Reconciles a buffer of successful records (re-extracting rows whose amounts do not add up), validates
+# them column-wise and returns their output rows, with the file and hash used for resuming, in upload order.
+def output_frame(buffer, run_metrics, max_api_in_flight=None):  # buffer (RecordBuffer): Records finished since the last flush.  run_metrics (StageMetrics): The run's metrics.
+
+    from invoice_validation import apply_validation
+    df, reextracted = reconcile_and_reextract(buffer.to_dataframe(), buffer.sorted_texts(), max_api_in_flight=max_api_in_flight)
+    run_metrics.count('reextracted', reextracted)
+    run_metrics.count('still_inconsistent', int((~df['Reconciled']).sum()))
+    with run_metrics.timer(VALIDATION_FRAME):
+        df, _ = apply_validation(df, INVOICE_FIELDS)
+    df.insert(0, 'File', buffer.sorted_names())
+    df.insert(1, 'Document Hash', buffer.sorted_hashes())
+    return df  # pd.DataFrame: Rows keyed by EXTRA_COLUMNS + OUTPUT_COLUMNS + RECONCILE_COLUMNS.
+
+
+# Reconciles, validates and writes the buffered records to the sink. Returns an empty buffer for the next flush.
+def flush_records(sink, buffer, run_metrics, max_api_in_flight=None):  # buffer (RecordBuffer): Records finished since the last flush.
+
+    if len(buffer):
+        sink.write(output_frame(buffer, run_metrics, max_api_in_flight), buffer.sorted_line_items())
+    return RecordBuffer()  # RecordBuffer: Empty.
+
+
+# Document hashes already present in an existing output file.
+def completed_hashes(path, fmt):
+
+    if not os.path.exists(path):
+        return set()
+    if fmt == "csv":
+        with open(path, newline="", encoding="utf-8") as f:
+            return {row['Document Hash'] for row in csv.DictReader(f) if row.get('Document Hash')}
+    if fmt == "jsonl":
+        hashes = set()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    hashes.add(json.loads(line)['Document Hash'])
+                except (ValueError, KeyError):
+                    continue  # a truncated last line from an interrupted run
+        return hashes
+    if fmt == "sqlite":
+        from output_store import InvoiceStore
+        return InvoiceStore(path).doc_hashes()
+    import pandas as pd
+    return set(pd.read_parquet(path, columns=['Document Hash'])['Document Hash'])
+
+
+# Appends rows to a CSV or JSONL file one flush at a time, so an interrupted run keeps its flushed rows
+# (the journal replays the rest). JSONL rows carry their line items as a nested list; CSV rows have one
+# row per invoice only.
+class StreamingSink:
+
+    def __init__(self, path, fmt, append):
+        self.append = append
+        exists = append and os.path.exists(path) and os.path.getsize(path) > 0
+        self.fmt = fmt
+        if exists:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                truncated = f.read(1) != b"\n"
+        self.file = open(path, "a" if append else "w", newline="", encoding="utf-8")
+        if exists and truncated:
+            self.file.write("\n")  # finish a row cut off by an interrupted run
+        if fmt == "csv":
+            self.writer = csv.DictWriter(self.file, fieldnames=EXTRA_COLUMNS + OUTPUT_COLUMNS + RECONCILE_COLUMNS)
+            if not exists:
+                self.writer.writeheader()
+
+    # A new file gets every successful record; an appended one already holds the rows copies reuse.
+    def wants(self, record):  # record (InvoiceRecord): A successful record.
+        return record.is_new_row or not self.append
+
+    def write(self, df, line_items):  # df (pd.DataFrame): From output_frame.  line_items (list): Row dict lists aligned with df.
+        for row, items in zip(df.to_dict('records'), line_items):
+            if self.fmt == "csv":
+                self.writer.writerow(row)
+            else:
+                self.file.write(json.dumps(dict(row, **{'Line Items': list(items)}), ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Parquet has no cheap append, so flushed frames are kept and written (merged with any previous run) at the end.
+class ParquetSink:
+
+    def __init__(self, path, append):
+        self.path = path
+        self.append = append
+        self.frames = []
+
+    def wants(self, record):
+        return record.is_new_row or not self.append
+
+    def write(self, df, line_items):
+        self.frames.append(df)
+
+    def close(self):
+        import pandas as pd
+        df = pd.concat(self.frames, ignore_index=True) if self.frames else pd.DataFrame(columns=EXTRA_COLUMNS + OUTPUT_COLUMNS + RECONCILE_COLUMNS)
+        if self.append and os.path.exists(self.path):
+            df = pd.concat([pd.read_parquet(self.path), df], ignore_index=True)
+        df.to_parquet(self.path, index=False)
+
+
+# Appends typed rows to an output_store.InvoiceStore one flush per transaction (one run id per CLI run), with
+# their line items checked per flush. The store always grows: earlier runs are kept whether or not --resume is given.
+class StoreSink:
+
+    def __init__(self, path):
+        from output_store import InvoiceStore  # pandas is only needed for this format
+        self.store = InvoiceStore(path)
+        self.stored = self.store.doc_hashes()
+        self.run_id = None
+
+    # Copies, and documents stored by an earlier run (replayed from the journal on a rerun), are not added again.
+    def wants(self, record):
+        return record.is_new_row and record.doc_hash not in self.stored
+
+    def write(self, df, line_items):
+        from line_items import check_line_items, line_items_frame
+        items = line_items_frame(line_items)
+        self.run_id = self.store.append(check_line_items(df, items), run_id=self.run_id, line_items=items)
+        self.stored.update(df['Document Hash'])
+
+    def close(self):
+        pass
+
+
+
+###################################################################
+# 3.  Command
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description="Extract invoice data from PDFs without the Streamlit UI.")
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories (searched recursively) or glob patterns.")
+    parser.add_argument("-o", "--output", required=True, help="Output file (.csv, .jsonl, .parquet or .sqlite for the typed store).")
+    parser.add_argument("--format", choices=["csv", "jsonl", "parquet", "sqlite"], help="Output format if it cannot be taken from the extension.")
+    parser.add_argument("--ocr-workers", type=int, help="Processes used for text extraction/OCR (default: OCR_MAX_WORKERS).")
+    parser.add_argument("--api-in-flight", type=int, help="Concurrent API requests (default: API_MAX_IN_FLIGHT).")
+    parser.add_argument("--batch-prompts", action="store_true", help="Pack several invoices into one API request.")
+    parser.add_argument("--resume", action="store_true", help="Append to the output and skip files already in it; files the journal has finished are replayed without OCR or API calls.")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the extraction cache.")
+    parser.add_argument("--journal", help="Checkpoint journal (default: <output>.journal.jsonl). Interrupted runs resume from it.")
+    parser.add_argument("--log-file", default="invoice_extraction.log", help="Where detailed logs go.")
+    parser.add_argument("--metrics-json", help="Write per-stage histograms and counters for the run as JSON.")
+    parser.add_argument("--metrics-prom", help="Write the run's metrics in Prometheus text format.")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"], default=profiler_from_env(), help="Profile the run (default: EXTRACTION_PROFILE). cprofile includes the API worker threads, pyinstrument only the main thread; neither includes the text extraction/OCR processes.")
+    parser.add_argument("--profile-output", help="Where the profile goes (default: extraction_profile_<time>.prof/.html).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    args = parse_args(argv)
+    logging.basicConfig(
+        filename=args.log_file,
+        level=logging.INFO,
+        format='%(asctime)s:%(levelname)s:%(message)s'
+    )
+    if not provider_configured():
+        print("API key or endpoint for the LLM provider not found in the environment variables.", file=sys.stderr)
+        return 2
+
+    fmt = output_format(args.output, args.format)
+    paths = find_pdfs(args.inputs)
+    if args.resume:
+        done = completed_hashes(args.output, fmt)
+        before = len(paths)
+        paths = [path for path in paths if document_hash(LocalPdf(path).read()) not in done]
+        print(f"Resuming: {before - len(paths)} file(s) already in {args.output}.", file=sys.stderr)
+    if not paths:
+        print("No PDF files to process.", file=sys.stderr)
+        return 0
+
+    files = [LocalPdf(path) for path in paths]
+    cache = ExtractionCache(enabled=False) if args.no_cache else get_default_cache()
+    if fmt == "sqlite":
+        sink = StoreSink(args.output)
+    elif fmt == "parquet":
+        sink = ParquetSink(args.output, args.resume)
+    else:
+        sink = StreamingSink(args.output, fmt, args.resume)
+    journal = CheckpointJournal(args.journal or args.output + ".journal.jsonl")
+
+    run_metrics = start_run()
+    started = time.monotonic()
+    counts = {}
+    buffer = RecordBuffer()
+    with profiling(args.profile, args.profile_output) as profile_path:
+        try:
+            for record in iter_invoice_records(
+                files,
+                max_ocr_workers=args.ocr_workers,
+                max_api_in_flight=args.api_in_flight,
+                batch_prompts=args.batch_prompts or None,
+                progress=PipelineProgress([file.name for file in files]),
+                cache=cache,
+                journal=journal,
+            ):
+                counts[record.status] = counts.get(record.status, 0) + 1
+                if record.duplicate_kind and record.duplicate_kind != DUPLICATE_SIMILAR:
+                    print(f"DUPLICATE ({record.duplicate_kind}) {record.name} of {record.duplicate_of}", file=sys.stderr)
+                if record.ok:
+                    if sink.wants(record):
+                        buffer.append(record)
+                    if len(buffer) >= FLUSH_ROWS:
+                        buffer = flush_records(sink, buffer, run_metrics, args.api_in_flight)
+                else:
+                    print(f"FAILED ({record.status}) {record.name}", file=sys.stderr)
+                done_count = sum(counts.values())
+                if done_count % 50 == 0 or done_count == len(files):
+                    elapsed = time.monotonic() - started
+                    print(f"{done_count}/{len(files)} files, {done_count / elapsed:.2f} files/s", file=sys.stderr)
+        finally:
+            flush_records(sink, buffer, run_metrics, args.api_in_flight)
+            sink.close()
+            journal.close()
+
+    counters = run_metrics.snapshot()['counters']
+    print(f"Done: {counts.get('ok', 0)} extracted, {len(files) - counts.get('ok', 0)} failed -> {args.output}", file=sys.stderr)
+    print(f"{counters.get('rule_based', 0)} file(s) extracted locally without an API call.", file=sys.stderr)
+    print(f"{counters.get('line_items', 0)} line item(s) read from item tables.", file=sys.stderr)
+    print(f"{counters.get('reextracted', 0)} inconsistent row(s) re-extracted; {counters.get('still_inconsistent', 0)} still do not add up.", file=sys.stderr)
+    copies = counters.get('duplicate_exact', 0) + counters.get('duplicate_near', 0)
+    print(f"{copies} file(s) were copies of earlier invoices (stored result reused); {counters.get('duplicate_key', 0)} flagged as the same invoice as an earlier file.", file=sys.stderr)
+    print(f"Text compaction saved {counters.get('prompt_tokens_saved', 0)} of {counters.get('prompt_tokens_before_compaction', 0)} prompt tokens.", file=sys.stderr)
+    for stage in run_metrics.table():
+        print(f"  {stage['stage']:<28} n={stage['count']:<6} mean={stage['mean']:.3f} p95={stage['p95']:.3f} max={stage['max']:.3f}", file=sys.stderr)
+    if args.metrics_json:
+        with open(args.metrics_json, "w", encoding="utf-8") as f:
+            f.write(run_metrics.to_json())
+    if args.metrics_prom:
+        with open(args.metrics_prom, "w", encoding="utf-8") as f:
+            f.write(run_metrics.to_prometheus())
+    if profile_path:
+        print(f"Profile written to {profile_path}.", file=sys.stderr)
+    return 0 if counts.get('ok', 0) == len(files) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
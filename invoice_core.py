@@ -0,0 +1,214 @@
+# Core invoice extraction steps shared by the Streamlit app and the batch tools.
+# Nothing in here imports Streamlit, so it is safe to call from worker threads and processes.
+import os
+import json
+import logging
+from io import BytesIO
+from dotenv import load_dotenv
+from text_backends import extract_text
+from llm_providers import get_provider, provider_name
+from invoice_validation import validate_value
+from llm_json import JsonStreamScanner, parse_object
+from stage_metrics import JSON_PARSE, TEXT_EXTRACTION, timer
+
+###########################################################################
+# 1. Configuration and Setup
+
+
+# Loaded environment variables from .env
+load_dotenv()
+
+
+GPT4V_KEY = os.getenv("GPT4V_KEY")
+GPT4V_ENDPOINT = os.getenv("GPT4V_ENDPOINT")
+
+# Fields requested from the model, in output column order
+INVOICE_FIELDS = [
+    'Invoice No.', 'Quantity', 'Date', 'Amount', 'Total',
+    'Email', 'Address', 'Taxable Value', 'SGST Amount',
+    'CGST Amount', 'IGST Amount', 'SGST Rate', 'CGST Rate',
+    'IGST Rate', 'Tax Amount', 'Tax Rate', 'Final Amount',
+    'Invoice Date', 'Place of Supply', 'Place of Origin',
+    'GSTIN Supplier', 'GSTIN Recipient',
+]
+OUTPUT_COLUMNS = INVOICE_FIELDS + ['Confidence', 'Trust']
+
+# designing a prompt using personification
+PROMPT_TEMPLATE = '''You are an expert and have best knowledge of invoices .Extract the following fields from the invoice data: 
+- Invoice No.
+- Quantity
+- Date
+- Amount
+- Total
+- Email
+- Address
+- Taxable Value
+- SGST Amount
+- CGST Amount
+- IGST Amount
+- SGST Rate
+- CGST Rate
+- IGST Rate
+- Tax Amount
+- Tax Rate
+- Final Amount
+- Invoice Date
+- Place of Supply
+- Place of Origin
+- GSTIN Supplier
+- GSTIN Recipient
+
+**Provide the output strictly in valid JSON format with no additional text, explanations, or comments. Ensure all keys are correctly spelled and correspond to the field names above. Do not include any trailing commas or syntax errors.**
+
+Here is the invoice data:
+{pages}
+'''
+
+# Follow-up prompt for invoices whose numeric fields do not add up
+RECONCILE_PROMPT_TEMPLATE = '''You are an expert and have best knowledge of invoices .The values below were extracted from the invoice data, but they are arithmetically inconsistent:
+{issues}
+
+Previously extracted values:
+{values}
+
+Re-read the invoice data carefully and return corrected values for these fields only:
+{fields}
+
+**Provide the output strictly in valid JSON format with no additional text, explanations, or comments. Use exactly the field names above. Do not include any trailing commas or syntax errors.**
+
+Here is the invoice data:
+{pages}
+'''
+
+SYSTEM_MESSAGE = "You are a helpful and accurate assistant."
+
+MODEL_PARAMS = {
+    "max_tokens": 1000,  # Increased tokens for detailed extraction
+    "temperature": 0.3    # Lower temperature for more deterministic output
+}
+
+
+
+###################################################################
+# 2.  Functions
+
+# Whether call_openai_api streams the completion (API_STREAM_RESPONSES), read lazily like the other settings.
+def stream_responses():
+
+    return os.getenv("API_STREAM_RESPONSES", "0").lower() in ("1", "true", "yes")  # bool: Streaming enabled.
+
+
+# Returns the process-wide Azure API client (keep-alive pool, rate limiter, retries), shared with the azure provider.
+def get_api_client():
+
+    return get_provider('azure').client  # ChatCompletionClient: The shared client.
+
+
+# Whether the configured LLM provider (LLM_PROVIDER) has its credentials.
+def provider_configured():
+
+    name = provider_name()
+    if name == 'azure':
+        return bool(GPT4V_KEY and GPT4V_ENDPOINT)
+    if name == 'gemini':
+        return bool(os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY"))
+    return True  # bool: False when requests would fail for lack of a key or endpoint.
+
+
+# extracting text from pdf files handling regular and scanned PDFs.
+# Pages are routed by the text backend (PDF_TEXT_BACKEND): text pages use the text layer, scanned and
+# mixed pages are rendered and OCR'd.
+def get_pdf_text(pdf_doc, ocr_workers=None, backend=None):  # pdf_doc (UploadedFile): The uploaded PDF file.  ocr_workers (int): OCR processes, defaults to the OCR_MAX_WORKERS setting.  backend (TextBackend): Defaults to get_backend().
+    
+    text = ""
+    try:
+        # Read the bytes once; the text layer and the OCR fallback both work from this copy
+        pdf_doc.seek(0)
+        pdf_bytes = pdf_doc.read()
+        with timer(TEXT_EXTRACTION):
+            text = extract_text(pdf_bytes, backend=backend, ocr_workers=ocr_workers)
+    
+    except Exception as e:
+        logging.error(f"Error extracting text from PDF: {e}")
+
+    return text  # str: The extracted text from the PDF, in page order.
+
+
+
+
+
+# Calls the OpenAI GPT-4 API to extract invoice data in JSON format.
+# Requests go through the configured provider (LLM_PROVIDER): Azure GPT-4 by default, or Gemini / the fake provider.
+def call_openai_api(pages_data):  #pages_data (str): The extracted text from the PDF.
+
+    prompt = PROMPT_TEMPLATE.format(pages=pages_data)
+
+    data = {
+        "messages": [
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            {"role": "user", "content": prompt}
+        ],
+        **MODEL_PARAMS
+    }
+
+    try:
+        if stream_responses():
+            # Stop reading as soon as the JSON object is complete; anything after it is commentary
+            scanner = JsonStreamScanner()
+            llm_extracted_data = get_provider().complete(
+                data, stream=True, on_delta=lambda delta: scanner.feed(delta) and scanner.first_object() is not None)
+        else:
+            llm_extracted_data = get_provider().complete(data)
+        if llm_extracted_data is not None:
+            logging.debug(f"Raw API response for data extraction: {llm_extracted_data}")
+        return llm_extracted_data
+    except Exception as e:
+        logging.error(f"Exception during API call: {e}")
+        return None     #str or None: The raw extracted data from the API if successful; otherwise, None.
+
+
+
+
+# Asks the API to re-read only the given fields of an invoice whose values failed reconciliation.
+def call_openai_api_reconcile(pages_data, values, issues):  # values (dict): Current field values.  issues (str): Failed checks.
+
+    prompt = RECONCILE_PROMPT_TEMPLATE.format(
+        issues=issues,
+        values=json.dumps(values, indent=2, ensure_ascii=False),
+        fields="\n".join(f"- {field}" for field in values),
+        pages=pages_data,
+    )
+    data = {
+        "messages": [
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            {"role": "user", "content": prompt}
+        ],
+        **dict(MODEL_PARAMS, temperature=0.0)
+    }
+    try:
+        return get_provider().complete(data)
+    except Exception as e:
+        logging.error(f"Exception during reconciliation API call: {e}")
+        return None     # str or None: The raw corrected values if successful; otherwise, None.
+
+
+# Validates the extracted data fields and assigns confidence levels.
+# Rules are compiled once in invoice_validation, which also validates whole columns for finished batches.
+def validate_data(field, value): # field (str): The name of the field.  value (str): The extracted value of the field.
+    
+    return validate_value(field, value)  # tuple: (is_valid, confidence label).
+  
+
+# Extracts text from raw PDF bytes. Module level so it can run inside a worker process.
+def extract_text_from_bytes(pdf_bytes, ocr_workers=1):  # pdf_bytes (bytes): The PDF content.
+
+    return get_pdf_text(BytesIO(pdf_bytes), ocr_workers=ocr_workers)  # str: The extracted text.
+
+
+# Pulls the JSON object out of a raw model response and decodes it.
+def parse_llm_response(llm_extracted_data):  # llm_extracted_data (str): The raw API response content.
+
+    # Tolerates fences, prose, trailing commas, single quotes and a reply cut off by max_tokens;
+    # keys are mapped to the INVOICE_FIELDS spellings
+    with timer(JSON_PARSE):
+        return parse_object(llm_extracted_data, INVOICE_FIELDS)     # dict or None: The decoded fields if the response held a JSON object; otherwise, None.
@@ -0,0 +1,257 @@
+# OCR engine for scanned pages: rasterize once, run tesseract across a process pool.
+# In 'roi' mode only detected text regions are OCR'd, at a low DPI first and re-rendered from the PDF at a
+# high DPI where confidence is low.
+import os
+import re
+import time
+import logging
+import threading
+from functools import partial
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageFilter
+from stage_metrics import OCR_PAGE, observe
+
+###########################################################################
+# 1. Configuration
+
+
+OCR_CONFIG = '--psm 6'  # Assume a single uniform block of text
+PAGE_DPI = 200          # whole-page mode
+
+# Region-of-interest mode
+ROI_ANALYSIS_WIDTH = 600     # pixels; layout analysis runs on a downscaled copy of the page
+ROI_INK_THRESHOLD = 200      # grey levels below this count as ink (downscaling lightens thin strokes)
+ROI_MIN_ROW_INK = 4          # mean ink (0-255) a row needs to count; keeps specks from forming bands
+ROI_MERGE_GAP = 0.015        # bands closer than this fraction of the page height form one region
+ROI_MIN_HEIGHT = 3           # analysis pixels; shorter bands are rules or noise
+ROI_PADDING = 4              # analysis pixels added around each region
+
+# Labels whose presence means a page already holds the fields the prompt needs most
+REQUIRED_FIELD_MARKERS = {
+    'Invoice No.': re.compile(r'invoice\s*(?:no|number|#)', re.IGNORECASE),
+    'Date': re.compile(r'\b\d{1,2}[/.\-](?:\d{1,2}|[A-Za-z]{3})[/.\-]\d{2,4}\b'),
+    'GSTIN': re.compile(r'\b\d{2}[A-Z]{5}\d{4}[A-Z][A-Z0-9]Z[A-Z0-9]\b'),
+    'Total': re.compile(r'\btotal\b[^\n]*?\d[\d,]*\.\d{2}', re.IGNORECASE),  # a total with an amount, not a table header
+}
+
+_pools = {}  # max_workers -> ProcessPoolExecutor; a pool is never shut down while another thread may use it
+_pools_lock = threading.Lock()
+
+
+# A page that can be rendered again: a one-page PDF, the 0-based page index in it and the DPI its
+# first-pass image was rendered at. Small enough to send to OCR worker processes with the image.
+PageSource = namedtuple('PageSource', ['pdf_bytes', 'page_index', 'dpi'])
+
+
+###################################################################
+# 2.  Functions
+
+# Groups sorted page numbers into contiguous (first, last) runs so poppler is invoked once per run.
+def page_runs(page_numbers):  # page_numbers (list): 1-based page numbers.
+
+    runs = []
+    for page_number in sorted(set(page_numbers)):
+        if runs and page_number == runs[-1][1] + 1:
+            runs[-1][1] = page_number
+        else:
+            runs.append([page_number, page_number])
+    return [tuple(run) for run in runs]  # list: (first_page, last_page) tuples.
+
+
+# Rasterizes only the requested pages through poppler, in grayscale (a third of the memory of RGB).
+# Pass a file path when rasterizing one document in several calls; bytes are copied to a temporary file on every call.
+def rasterize_pages(pdf_source, page_numbers, dpi=PAGE_DPI):  # pdf_source (bytes or str): The whole PDF, or a path to it.
+
+    from pdf2image import convert_from_bytes, convert_from_path  # only the pypdf backend needs poppler
+    convert = convert_from_path if isinstance(pdf_source, str) else convert_from_bytes
+    images = {}
+    for first, last in page_runs(page_numbers):
+        run_images = convert(pdf_source, dpi=dpi, first_page=first, last_page=last, grayscale=True)
+        for page_number, image in zip(range(first, last + 1), run_images):
+            images[page_number] = image
+    logging.info(f"Rasterized {len(images)} page(s) for OCR.")
+    return [images.get(page_number) for page_number in page_numbers]  # list: PIL images in the requested order.
+
+
+# Runs tesseract on a single page image. Module level so it can be pickled into worker processes.
+def ocr_image(image):  # image (PIL.Image): The rasterized page.
+
+    if image is None:
+        return ""
+    import pytesseract  # imported where it runs: it pulls in pandas, which the parent process does not need
+    return pytesseract.image_to_string(image, config=OCR_CONFIG)
+
+
+# Number of OCR processes, read lazily so a .env loaded after import still applies.
+def default_ocr_workers():
+
+    return int(os.getenv("OCR_MAX_WORKERS", os.cpu_count() or 1))  # int: Configured OCR worker count.
+
+
+# OCR mode: 'page' OCRs whole pages, 'roi' only the detected text regions.
+def ocr_mode():
+
+    mode = os.getenv("OCR_MODE", "page").lower()
+    if mode not in ("page", "roi"):
+        raise ValueError(f"Unknown OCR_MODE '{mode}'. Use page or roi.")
+    return mode  # str: 'page' or 'roi'.
+
+
+# Region OCR settings, read lazily (worker processes inherit the environment).
+def roi_settings():
+
+    return {
+        'dpi': int(os.getenv("OCR_ROI_DPI", 150)),                              # first-pass render DPI
+        'high_dpi': int(os.getenv("OCR_ROI_HIGH_DPI", 300)),                    # re-render DPI for low-confidence regions
+        'min_confidence': float(os.getenv("OCR_ROI_MIN_CONFIDENCE", 70)),       # mean tesseract word confidence
+        'early_stop': os.getenv("OCR_ROI_EARLY_STOP", "0").lower() in ("1", "true", "yes"),
+    }  # dict: Region OCR settings.
+
+
+# Render DPI for pages that will be OCR'd in the current mode.
+def ocr_dpi():
+
+    return roi_settings()['dpi'] if ocr_mode() == "roi" else PAGE_DPI  # int: DPI.
+
+
+# Returns the shared process pool of the requested size, creating it on first use.
+def _get_pool(max_workers):
+
+    with _pools_lock:
+        pool = _pools.get(max_workers)
+        if pool is None:
+            pool = _pools[max_workers] = ProcessPoolExecutor(max_workers=max_workers)
+    return pool  # ProcessPoolExecutor: The pool for this size.
+
+
+# Runs ocr_page on one image and returns (text, seconds), so worker processes can report timings.
+def _timed_ocr(ocr_page, image, source=None):
+
+    started = time.perf_counter()
+    text = ocr_page(image) if source is None else ocr_page(image, source)
+    return text, time.perf_counter() - started
+
+
+# OCRs already rendered page images, in parallel when more than one worker is configured.
+def ocr_images(images, max_workers=None, sources=None):  # images (list): PIL images, one per page.  sources (list): Optional PageSource per image, so 'roi' mode can re-render low-confidence regions.
+
+    if not images:
+        return []
+    sources = sources or [None] * len(images)
+    timed_ocr = partial(_timed_ocr, ocr_image_regions if ocr_mode() == "roi" else ocr_image)
+    max_workers = max_workers or default_ocr_workers()
+    if max_workers <= 1 or len(images) == 1:
+        results = [timed_ocr(image, source) for image, source in zip(images, sources)]
+    else:
+        # map() yields results in submission order, so page order stays deterministic
+        results = list(_get_pool(max_workers).map(timed_ocr, images, sources))
+
+    for _, seconds in results:
+        observe(OCR_PAGE, seconds)
+    return [text for text, _ in results]  # list: OCR text per image, in input order.
+
+
+# OCRs the given pages of a PDF, rasterizing them through poppler first.
+def ocr_pdf_pages(pdf_source, page_numbers, max_workers=None, dpi=None):  # pdf_source (bytes or str): The PDF, or a path to it.  page_numbers (list): 1-based pages needing OCR.
+
+    if not page_numbers:
+        return []
+    images = rasterize_pages(pdf_source, page_numbers, dpi=dpi or ocr_dpi())
+    return ocr_images(images, max_workers=max_workers)  # list: OCR text per page, aligned with page_numbers.
+
+
+
+###################################################################
+# 3.  Region-of-Interest OCR
+
+# Finds text regions with a projection profile on a downscaled, dilated ink mask: rows with ink form bands,
+# nearby bands merge into regions, and each region is trimmed to its ink. Regions are returned top to bottom.
+def find_text_regions(image):  # image (PIL.Image): The rasterized page.
+
+    gray = image.convert("L")
+    scale = min(1.0, ROI_ANALYSIS_WIDTH / gray.width)
+    small = gray.resize((max(1, int(gray.width * scale)), max(1, int(gray.height * scale))), Image.BOX)
+    # Ink becomes white; dilation joins characters into solid lines
+    ink = small.point(lambda value: 255 if value < ROI_INK_THRESHOLD else 0).filter(ImageFilter.MaxFilter(5))
+
+    # Mean ink per row in one C call: squash the mask to a single column
+    row_ink = list(ink.resize((1, ink.height), Image.BOX).getdata())
+    bands = []
+    for y, value in enumerate(row_ink):
+        if value < ROI_MIN_ROW_INK:
+            continue
+        if bands and y - bands[-1][1] <= max(1, int(ROI_MERGE_GAP * ink.height)):
+            bands[-1][1] = y
+        else:
+            bands.append([y, y])
+
+    regions = []
+    for top, bottom in bands:
+        if bottom - top + 1 < ROI_MIN_HEIGHT:
+            continue
+        bbox = ink.crop((0, top, ink.width, bottom + 1)).getbbox()
+        if bbox is None:
+            continue
+        left, right = bbox[0], bbox[2]
+        box = (max(0, left - ROI_PADDING), max(0, top - ROI_PADDING), min(ink.width, right + ROI_PADDING), min(ink.height, bottom + 1 + ROI_PADDING))
+        regions.append(tuple(int(round(coordinate / scale)) for coordinate in box))
+    return regions  # list: (left, top, right, bottom) boxes in page pixels.
+
+
+# Runs tesseract on one region and returns its text with the mean word confidence (0-100).
+def _ocr_with_confidence(image):
+
+    import pytesseract
+    data = pytesseract.image_to_data(image, config=OCR_CONFIG, output_type=pytesseract.Output.DICT)
+    lines, confidences = {}, []
+    for word, confidence, block, paragraph, line in zip(data['text'], data['conf'], data['block_num'], data['par_num'], data['line_num']):
+        if not word.strip() or float(confidence) < 0:
+            continue
+        lines.setdefault((block, paragraph, line), []).append(word)
+        confidences.append(float(confidence))
+    text = "\n".join(" ".join(words) for words in lines.values())
+    return text, (sum(confidences) / len(confidences) if confidences else 0.0)
+
+
+# Renders one region of a page from its PDF at a higher DPI: real detail for tesseract, unlike resizing
+# the first-pass bitmap. box is in pixels of the page rendered at source.dpi.
+def render_region(source, box, dpi):  # source (PageSource): The page.  box (tuple): (left, top, right, bottom).  dpi (int): Target DPI.
+
+    import fitz  # PyMuPDF; PageSource is only built by its backend
+    scale = 72 / source.dpi  # page pixels -> PDF points
+    doc = fitz.open(stream=source.pdf_bytes, filetype="pdf")
+    try:
+        clip = fitz.Rect(*(coordinate * scale for coordinate in box))
+        pixmap = doc.load_page(source.page_index).get_pixmap(clip=clip, dpi=dpi, colorspace=fitz.csGRAY)
+        return Image.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples)  # PIL.Image: The region.
+    finally:
+        doc.close()
+
+
+# OCRs only the text regions of a page. Regions below the confidence threshold are re-rendered from the PDF
+# at the high DPI and re-read (when the page's source is known); with early stop (off by default), reading
+# ends once every REQUIRED_FIELD_MARKERS label has been seen, which skips trailing terms-and-conditions
+# boilerplate but may also skip fields printed below them. Module level so it can be pickled into workers.
+def ocr_image_regions(image, source=None):  # image (PIL.Image): The page, rendered at the first-pass DPI.  source (PageSource): The page's PDF, for re-rendering.
+
+    if image is None:
+        return ""
+    settings = roi_settings()
+    regions = find_text_regions(image)
+    texts, found = [], set()
+    for position, box in enumerate(regions):
+        text, confidence = _ocr_with_confidence(image.crop(box))
+        if confidence < settings['min_confidence'] and source is not None and settings['high_dpi'] > source.dpi:
+            sharp_text, sharp_confidence = _ocr_with_confidence(render_region(source, box, settings['high_dpi']))
+            if sharp_confidence > confidence:
+                text = sharp_text
+        if text.strip():
+            texts.append(text)
+
+        if settings['early_stop']:
+            found.update(field for field, marker in REQUIRED_FIELD_MARKERS.items() if marker.search(text))
+            if len(found) == len(REQUIRED_FIELD_MARKERS):
+                logging.info(f"Required fields found after {position + 1} of {len(regions)} region(s); skipping the rest of the page.")
+                break
+    return "\n".join(texts)  # str: OCR text of the regions read, top to bottom.
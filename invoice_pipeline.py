@@ -0,0 +1,545 @@
+# Concurrent multi-invoice pipeline: text extraction in a process pool, LLM calls in a bounded thread pool.
+# Finished invoices are streamed back as typed records.
+import os
+import json
+import logging
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from invoice_core import (
+    PROMPT_TEMPLATE, SYSTEM_MESSAGE, MODEL_PARAMS, INVOICE_FIELDS, OUTPUT_COLUMNS,
+    extract_text_from_bytes, call_openai_api, call_openai_api_reconcile, parse_llm_response,
+)
+from invoice_validation import RECONCILED_FIELDS, reconcile_amounts, describe_issues
+from extraction_cache import document_hash, response_key, get_default_cache
+from prompt_batching import BATCH_PROMPT_TEMPLATE, batch_settings, pack_batches, call_openai_api_batch
+from checkpoint_journal import STAGE_TEXT, STAGE_DONE, STAGE_FAILED
+from invoice_ocr import default_ocr_workers
+from text_compaction import prompt_text
+from rule_extractor import rules_enabled, try_rules
+from llm_providers import get_provider
+from duplicate_index import DUPLICATE_EXACT, DUPLICATE_KEY, DUPLICATE_NEAR, DUPLICATE_SIMILAR, get_default_index
+from line_items import line_items_enabled, parse_line_items
+from stage_metrics import COMPACTION, RULES, RECONCILIATION, LINE_ITEMS, capture, get_metrics, timer
+
+###########################################################################
+# 1. Configuration
+
+
+# Number of chat-completion requests allowed in flight at once.
+def default_api_in_flight():
+
+    return int(os.getenv("API_MAX_IN_FLIGHT", 4))  # int: Configured API concurrency.
+
+
+
+###################################################################
+# 2.  Progress Reporting
+
+# Thread-safe record of the stage each file has reached. Safe to call from any worker thread.
+class PipelineProgress:
+
+    def __init__(self, file_names):  # file_names (list): Names of the files, in input order.
+        self._lock = threading.Lock()
+        self.file_names = list(file_names)
+        self.stages = ['queued'] * len(self.file_names)
+
+    def __call__(self, index, name, stage):  # index (int): Input position.  stage (str): The stage just reached.
+        with self._lock:
+            self.stages[index] = stage
+        logging.info(f"{name}: {stage}")
+
+    # Returns a copy of (file name, stage) pairs in input order.
+    def snapshot(self):
+        with self._lock:
+            return list(zip(self.file_names, self.stages))
+
+
+
+###################################################################
+# 3.  Pipeline
+
+# Reads an uploaded file (or any binary file object) into bytes so it can be sent to a worker process.
+def read_upload(file):  # file (UploadedFile): The uploaded PDF file.
+
+    file.seek(0)
+    return file.read()  # bytes: The file content.
+
+
+# Extracts text in a worker and returns it with the stage timings recorded there, for the parent to merge.
+def _extract_text_worker(pdf_bytes):  # pdf_bytes (bytes): The PDF content.
+
+    with capture() as captured:
+        text = extract_text_from_bytes(pdf_bytes, 1)
+    return text, captured.export()  # tuple: (extracted text, exported stage metrics).
+
+
+# Cache key for a chat-completion request built from this text with the current prompt and model settings.
+# Results split out of a batched reply come from a different prompt, so they are kept under their own key.
+def llm_cache_key(text, batched=False):  # text (str): The extracted invoice text.  batched (bool): Key for a result from a batched request.
+
+    # The provider's identity (the Azure endpoint, or the Gemini model) keeps providers' replies apart
+    model_params = dict(MODEL_PARAMS, system=SYSTEM_MESSAGE, endpoint=get_provider().identity)
+    if batched:
+        return response_key(text, BATCH_PROMPT_TEMPLATE, dict(model_params, batched=True))
+    return response_key(text, PROMPT_TEMPLATE, model_params)  # str: Hex digest.
+
+
+# Parses a raw reply into the result and caches it if it came from the API. Runs on the API thread pool.
+def _finish_result(index, result, llm_extracted_data, key, notify, cache):
+
+    if not llm_extracted_data:
+        result['status'] = 'api_failed'
+        notify(index, result['name'], 'failed')
+        return
+
+    result['raw_response'] = llm_extracted_data
+    data_dict = parse_llm_response(llm_extracted_data)
+    if data_dict is None:
+        result['status'] = 'invalid_json'
+        notify(index, result['name'], 'failed')
+        return
+
+    # Only responses that parsed are worth replaying
+    if not result['response_cached']:
+        cache.put_response(key, llm_extracted_data)
+
+    result['data'] = data_dict
+    result['status'] = 'ok'
+    notify(index, result['name'], 'done')
+
+
+# Calls the API for one document (or reuses a cached reply) and parses it. Runs on the API thread pool.
+def _extract_fields(index, result, notify, cache, force=False):  # force (bool): Call the API even when a reply is cached.
+
+    key = llm_cache_key(result['prompt_text'])
+    llm_extracted_data = None if force else cache.get_response(key)
+    if llm_extracted_data is None:
+        notify(index, result['name'], 'calling_api')
+        llm_extracted_data = call_openai_api(result['prompt_text'])
+    else:
+        result['response_cached'] = True
+    _finish_result(index, result, llm_extracted_data, key, notify, cache)
+
+
+# Extracts a group of documents with one batched request; cached documents are left out of the prompt.
+# A cached single-prompt reply is used too; new results are cached under the batched key.
+def _extract_fields_batch(batch, notify, cache, force=False):  # batch (list): (index, result) pairs.  force (bool): Send every document, cached or not.
+
+    keys = {index: llm_cache_key(result['prompt_text'], batched=True) for index, result in batch}
+    to_send = []
+    for index, result in batch:
+        llm_extracted_data = None
+        if not force:
+            llm_extracted_data = cache.get_response(llm_cache_key(result['prompt_text'])) or cache.get_response(keys[index])
+        if llm_extracted_data is not None:
+            result['response_cached'] = True
+            _finish_result(index, result, llm_extracted_data, keys[index], notify, cache)
+        else:
+            notify(index, result['name'], 'calling_api')
+            to_send.append((index, result))
+
+    if not to_send:
+        return
+    responses = call_openai_api_batch([(str(index), result['prompt_text']) for index, result in to_send])
+    for index, result in to_send:
+        _finish_result(index, result, responses.get(str(index)), keys[index], notify, cache)
+
+
+# Runs text extraction and LLM extraction for many files concurrently, yielding (index, result)
+# for each file as soon as it finishes. Extraction of later files overlaps with API calls for earlier ones.
+# With batch_prompts, several documents share one request under the API_BATCH_* limits.
+# Copies of documents seen in earlier runs get the stored result instead of OCR and API calls (see duplicate_index),
+# unless force is set, which processes every document again without the duplicate index or cache lookups.
+def iter_pipeline(user_pdf_list, max_ocr_workers=None, max_api_in_flight=None, progress=None, cache=None, batch_prompts=None, max_pending_documents=None, journal=None, duplicates=None, force=False):  # user_pdf_list (list): Uploaded PDF files.  progress (callable): Called as progress(index, name, stage) from worker threads.  cache (ExtractionCache): Defaults to the shared on-disk cache.  batch_prompts (bool): Defaults to the API_BATCH_PROMPTS setting.  max_pending_documents (int): Documents read ahead of extraction, defaults to twice the OCR workers.  journal (CheckpointJournal): Optional; finished documents are replayed from it and progress is recorded to it.  duplicates (DuplicateIndex): Defaults to the shared index (None when DUPLICATE_INDEX=0).  force (bool): Ignore earlier results; fresh results are still cached and indexed.
+
+    max_ocr_workers = max_ocr_workers or default_ocr_workers()
+    max_api_in_flight = max_api_in_flight or default_api_in_flight()
+    notify = progress or (lambda index, name, stage: None)
+    cache = cache or get_default_cache()
+    duplicates = duplicates or get_default_index()
+    if batch_prompts is None:
+        batch_prompts = os.getenv("API_BATCH_PROMPTS", "0").lower() in ("1", "true", "yes")
+    use_rules = rules_enabled()
+    limits = batch_settings()
+    metrics = get_metrics()
+    max_pending_documents = max_pending_documents or max_ocr_workers * 2
+
+    results = [
+        {'name': file.name, 'doc_hash': None, 'text': "", 'raw_response': None, 'data': None, 'status': 'pending', 'error': None,
+         'text_cached': False, 'response_cached': False, 'resumed': False,
+         'prompt_text': "", 'tokens_before': 0, 'tokens_saved': 0, 'rule_based': False,
+         'duplicate_of': None, 'duplicate_kind': None, 'duplicate_hash': None}
+        for file in user_pdf_list
+    ]
+
+    # A single worker stays in-process; otherwise each document is extracted in its own process
+    if max_ocr_workers > 1:
+        text_executor = ProcessPoolExecutor(max_workers=max_ocr_workers)
+    else:
+        text_executor = ThreadPoolExecutor(max_workers=1)
+
+    with text_executor, ThreadPoolExecutor(max_workers=max_api_in_flight) as api_executor:
+        text_futures = {}
+        api_futures = {}
+        finished = []  # indices that are done but not yet yielded
+        pending = []   # documents waiting to fill a batch
+
+        def submit_batch(batch):
+            api_futures[api_executor.submit(_extract_fields_batch, batch, notify, cache, force)] = [index for index, _ in batch]
+
+        def flush_batch():
+            if pending:
+                submit_batch(list(pending))
+                pending.clear()
+
+        # Finishes a document with the stored result of an earlier copy
+        def reuse(index, match):
+            result = results[index]
+            result.update(data=match['data'], raw_response=match['raw_response'], status='ok',
+                          duplicate_of=match['name'], duplicate_kind=match['kind'], duplicate_hash=match['doc_hash'])
+            logging.info(f"{result['name']} is a copy ({match['kind']}) of {match['name']}; reusing its result.")
+            notify(index, result['name'], 'done')
+            finished.append(index)
+
+        # Hands a document's text to the API pool, or records why it cannot go there
+        def text_ready(index, text):
+            result = results[index]
+            result['text'] = text
+            if not text.strip():
+                result['status'] = 'no_text'
+                notify(index, result['name'], 'failed')
+                finished.append(index)
+                return
+            notify(index, result['name'], 'text_extracted')
+            # A re-scan or re-export of an invoice already processed needs no API call; a different invoice
+            # with near-identical text (a supplier's next monthly invoice) is extracted and only noted
+            match = duplicates.find_near(text, exclude_hash=result['doc_hash']) if duplicates and not force else None
+            if match is not None and match['kind'] == DUPLICATE_NEAR:
+                reuse(index, match)
+                return
+            if match is not None:
+                result['duplicate_of'], result['duplicate_kind'] = match['name'], DUPLICATE_SIMILAR
+            # Known layouts are read locally; the API is only needed when the rules come up short
+            data = None
+            if use_rules:
+                with timer(RULES):
+                    data = try_rules(text, result['name'])
+            if data is not None:
+                result.update(data=data, raw_response=json.dumps(data, ensure_ascii=False), status='ok', rule_based=True)
+                notify(index, result['name'], 'done')
+                finished.append(index)
+                return
+            # The prompt gets compacted text; the journal and cache keep the full text
+            with timer(COMPACTION):
+                result['prompt_text'], stats = prompt_text(text, result['name'])
+            result['tokens_before'], result['tokens_saved'] = stats['tokens_before'], stats['tokens_saved']
+            if not batch_prompts:
+                api_futures[api_executor.submit(_extract_fields, index, result, notify, cache, force)] = [index]
+                return
+            # Batches are packed as documents arrive; every batch but the one still filling is sent
+            pending.append((index, result))
+            by_index = dict(pending)
+            batches = pack_batches([(position, item['prompt_text']) for position, item in pending], limits['token_budget'], limits['max_invoices'])
+            if len(batches[-1]) >= limits['max_invoices']:
+                batches.append([])
+            for batch in batches[:-1]:
+                submit_batch([(position, by_index[position]) for position, _ in batch])
+            pending[:] = [(position, by_index[position]) for position, _ in batches[-1]]
+
+        # Documents seen before skip extraction entirely. Only a window of documents is read and queued
+        # at a time, so directory-scale runs do not hold every file in memory.
+        # Pages are already spread across processes at the document level, so OCR inside a worker stays serial
+        file_iter = enumerate(user_pdf_list)
+        exhausted = [False]
+
+        def submit_more():
+            while not exhausted[0] and len(text_futures) < max_pending_documents:
+                item = next(file_iter, None)
+                if item is None:
+                    exhausted[0] = True
+                    return
+                index, file = item
+                result = results[index]
+                pdf_bytes = read_upload(file)
+                result['doc_hash'] = document_hash(pdf_bytes)
+
+                # Resume from the journal: finished documents are replayed, extracted text is reused
+                state = journal.state(result['doc_hash']) if journal else {}
+                if state.get('stage') == STAGE_DONE:
+                    result.update(text=state.get('text', ""), raw_response=state.get('raw_response'),
+                                  data=state.get('data'), status='ok', resumed=True)
+                    notify(index, result['name'], 'done')
+                    finished.append(index)
+                    continue
+                if state.get('text'):
+                    result['resumed'] = True
+                    text_ready(index, state['text'])
+                    continue
+
+                # The same bytes processed in an earlier run
+                match = duplicates.find_exact(result['doc_hash']) if duplicates and not force else None
+                if match is not None and match['data'] is not None:
+                    result['text'] = cache.get_text(result['doc_hash']) or ""
+                    reuse(index, match)
+                    continue
+
+                cached_text = None if force else cache.get_text(result['doc_hash'])
+                if cached_text is not None:
+                    results[index]['text_cached'] = True
+                    text_ready(index, cached_text)
+                else:
+                    text_futures[text_executor.submit(_extract_text_worker, pdf_bytes)] = index
+
+        submit_more()
+        while True:
+            if exhausted[0] and not text_futures:
+                flush_batch()  # no more text is coming, so a partial batch will not fill up
+            for index in finished:
+                result = results[index]
+                if duplicates and result['status'] == 'ok' and result['duplicate_kind'] != DUPLICATE_EXACT:
+                    # A different file claiming an invoice that is already stored is flagged, not dropped
+                    if result['duplicate_kind'] in (None, DUPLICATE_SIMILAR):
+                        match = duplicates.find_key(result['data'], exclude_hash=result['doc_hash'])
+                        if match is not None:
+                            result['duplicate_of'], result['duplicate_kind'] = match['name'], DUPLICATE_KEY
+                    if result['text']:
+                        duplicates.add(result['doc_hash'], result['name'], result['text'], result['raw_response'], result['data'])
+                if journal and not (result['resumed'] and result['status'] == 'ok'):
+                    if result['status'] == 'ok':
+                        journal.write(result['doc_hash'], result['name'], STAGE_DONE,
+                                      raw_response=result['raw_response'], data=result['data'])
+                    else:
+                        journal.write(result['doc_hash'], result['name'], STAGE_FAILED,
+                                      status=result['status'], error=result['error'])
+                yield index, result
+                results[index] = None  # the caller owns it now; do not keep every document's text alive
+            finished.clear()
+            if not (text_futures or api_futures):
+                if exhausted[0]:
+                    break
+                submit_more()
+                continue
+
+            done, _ = wait(list(text_futures) + list(api_futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in text_futures:
+                    index = text_futures.pop(future)
+                    result = results[index]
+                    try:
+                        text, exported = future.result()
+                        metrics.merge(exported)
+                    except Exception as e:
+                        logging.error(f"Text extraction failed for {result['name']}: {e}")
+                        result['status'], result['error'] = 'error', str(e)
+                        notify(index, result['name'], 'failed')
+                        finished.append(index)
+                        continue
+                    if text.strip():
+                        cache.put_text(result['doc_hash'], text)
+                        if journal:
+                            journal.write(result['doc_hash'], result['name'], STAGE_TEXT, text=text)
+                    text_ready(index, text)
+                else:
+                    indices = api_futures.pop(future)
+                    if future.exception() is not None:
+                        for index in indices:
+                            logging.error(f"API stage failed for {results[index]['name']}: {future.exception()}")
+                            results[index]['status'], results[index]['error'] = 'error', str(future.exception())
+                            notify(index, results[index]['name'], 'failed')
+                    finished.extend(indices)
+            submit_more()
+
+
+# Runs the whole pipeline and returns every result, in input order.
+def run_pipeline(user_pdf_list, **options):  # options: Passed through to iter_pipeline.
+
+    results = [None] * len(user_pdf_list)
+    for index, result in iter_pipeline(user_pdf_list, **options):
+        results[index] = result
+    return results  # list: One result dict per input file, in input order.
+
+
+
+###################################################################
+# 4.  Records
+
+# One finished invoice: pipeline outcome plus extracted fields. Validation runs column-wise over a
+# RecordBuffer of records (invoice_validation.apply_validation), not per record.
+@dataclass
+class InvoiceRecord:
+    index: int
+    name: str
+    doc_hash: str
+    status: str
+    text: str = ""
+    raw_response: str = None
+    data: dict = None
+    error: str = None
+    text_cached: bool = False
+    response_cached: bool = False
+    resumed: bool = False                            # replayed or continued from a checkpoint journal
+    tokens_before: int = 0                           # prompt tokens of the full text
+    tokens_saved: int = 0                            # prompt tokens removed by text compaction
+    rule_based: bool = False                         # extracted by rule_extractor without an API call
+    duplicate_of: str = None                         # name of the earlier file this one duplicates
+    duplicate_kind: str = None                       # 'exact' / 'near' (stored result reused), 'key' (same invoice, flagged) or 'similar' (noted only)
+    duplicate_hash: str = None                       # document hash of the earlier file whose result a copy reuses
+    line_items: list = field(default_factory=list)   # item rows parsed from the text (see line_items)
+
+    @property
+    def is_copy(self):
+        return self.duplicate_kind in (DUPLICATE_EXACT, DUPLICATE_NEAR)
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+    # Whether the record adds a row to outputs that grow across runs (the output store, appended files).
+    # A copy's result is already there from its earlier file, so it is not added again.
+    @property
+    def is_new_row(self):
+        return self.ok and not self.is_copy
+
+
+# Turns a pipeline result into a record, parsing the item table when extraction succeeded.
+def build_record(index, result):  # result (dict): A result yielded by iter_pipeline.
+
+    record = InvoiceRecord(
+        index=index, name=result['name'], doc_hash=result['doc_hash'], status=result['status'],
+        text=result['text'], raw_response=result['raw_response'], data=result['data'], error=result['error'],
+        text_cached=result['text_cached'], response_cached=result['response_cached'], resumed=result['resumed'],
+        tokens_before=result['tokens_before'], tokens_saved=result['tokens_saved'], rule_based=result['rule_based'],
+        duplicate_of=result['duplicate_of'], duplicate_kind=result['duplicate_kind'], duplicate_hash=result['duplicate_hash'],
+    )
+    if record.ok and line_items_enabled() and not record.is_copy:
+        with timer(LINE_ITEMS):
+            record.line_items = parse_line_items(record.text)
+    return record  # InvoiceRecord: The finished invoice.
+
+
+# Adds a finished record to the run counters.
+def count_record(record, metrics=None):  # metrics (StageMetrics): Defaults to the current run.
+
+    metrics = metrics or get_metrics()
+    metrics.count('files')
+    metrics.count(f'status_{record.status}')
+    metrics.count('text_cache_hits', record.text_cached)
+    metrics.count('response_cache_hits', record.response_cached)
+    metrics.count('resumed', record.resumed)
+    metrics.count('rule_based', record.rule_based)
+    metrics.count('line_items', len(record.line_items))
+    if record.duplicate_kind:
+        metrics.count(f'duplicate_{record.duplicate_kind}')
+    metrics.count('prompt_tokens_before_compaction', record.tokens_before)
+    metrics.count('prompt_tokens_saved', record.tokens_saved)
+
+
+# Yields one InvoiceRecord per file as soon as it finishes (completion order, see record.index).
+def iter_invoice_records(user_pdf_list, **options):  # options: Passed through to iter_pipeline.
+
+    for index, result in iter_pipeline(user_pdf_list, **options):
+        record = build_record(index, result)
+        count_record(record)
+        yield record
+
+
+# Column buffers for successful records; the DataFrame is built once at the end instead of per row.
+# Confidence and Trust are left to invoice_validation.apply_validation, which computes them per column.
+class RecordBuffer:
+
+    def __init__(self):
+        self.indices = []
+        self.texts = []   # kept for targeted re-extraction of inconsistent rows
+        self.names = []
+        self.doc_hashes = []
+        self.line_items = []
+        self.columns = {column: [] for column in INVOICE_FIELDS}
+
+    def append(self, record):  # record (InvoiceRecord): A successful record.
+        self.indices.append(record.index)
+        self.texts.append(record.text)
+        self.names.append(record.name)
+        self.doc_hashes.append(record.doc_hash)
+        self.line_items.append(record.line_items)
+        for column, values in self.columns.items():
+            values.append(record.data.get(column, ""))
+
+    def __len__(self):
+        return len(self.indices)
+
+    # Builds the field DataFrame in upload order.
+    def to_dataframe(self):
+        import pandas as pd  # imported here so batch runs that never build a DataFrame start faster
+        df = pd.DataFrame(self.columns, index=self.indices, columns=INVOICE_FIELDS)
+        return df.sort_index().reset_index(drop=True)  # pd.DataFrame: One row per successful invoice.
+
+    # Values aligned with the rows of to_dataframe().
+    def _sorted(self, values):
+        return [value for _, value in sorted(zip(self.indices, values), key=lambda pair: pair[0])]
+
+    def sorted_texts(self):
+        return self._sorted(self.texts)
+
+    def sorted_names(self):
+        return self._sorted(self.names)
+
+    def sorted_hashes(self):
+        return self._sorted(self.doc_hashes)
+
+    def sorted_line_items(self):
+        return self._sorted(self.line_items)
+
+
+
+###################################################################
+# 5.  Reconciliation
+
+# Re-reads the numeric GST fields of one inconsistent row. Runs on a thread pool.
+def _reextract_row(text, values, issues):
+
+    llm_extracted_data = call_openai_api_reconcile(prompt_text(text)[0], values, issues)
+    corrected = parse_llm_response(llm_extracted_data) if llm_extracted_data else None
+    return {field: corrected[field] for field in values if field in corrected} if corrected else {}
+
+
+# Flags rows whose GST arithmetic does not add up and sends only those rows for a targeted
+# re-extraction of the numeric fields. Adds 'Reconciled' and 'Reconciliation Issues' columns.
+# Rows without text (copies whose text was not cached) stay flagged but are not re-extracted.
+def reconcile_and_reextract(df, texts, max_api_in_flight=None, reextract=True):  # df (pd.DataFrame): Extracted fields.  texts (list): Extracted text per row.
+
+    with timer(RECONCILIATION):
+        df = df.copy()
+        issues = describe_issues(reconcile_amounts(df))
+        flagged = [position for position, issue in enumerate(issues) if issue and texts[position]]
+        reextracted = 0
+
+        if reextract and flagged:
+            logging.info(f"Re-extracting numeric fields for {len(flagged)} inconsistent row(s).")
+            numeric_fields = [field for field in RECONCILED_FIELDS if field in df]
+            with ThreadPoolExecutor(max_workers=max_api_in_flight or default_api_in_flight()) as executor:
+                futures = {
+                    position: executor.submit(
+                        _reextract_row, texts[position],
+                        {field: df.iat[position, df.columns.get_loc(field)] for field in numeric_fields},
+                        issues.iat[position],
+                    )
+                    for position in flagged
+                }
+                for position, future in futures.items():
+                    try:
+                        corrected = future.result()
+                    except Exception as e:
+                        logging.error(f"Re-extraction failed for row {position}: {e}")
+                        continue
+                    for field, value in corrected.items():
+                        df.iat[position, df.columns.get_loc(field)] = value
+                    reextracted += bool(corrected)
+
+            # Only the re-extracted rows need checking again
+            rows = df.index[flagged]
+            issues.loc[rows] = describe_issues(reconcile_amounts(df.loc[rows]))
+
+        df['Reconciled'] = issues == ""
+        df['Reconciliation Issues'] = issues
+    return df, reextracted  # tuple: (DataFrame with reconciliation columns, number of rows re-extracted).
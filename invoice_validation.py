@@ -0,0 +1,249 @@
+# Validation engine: rules are compiled once at import and applied to whole columns with pandas string ops.
+# A scalar path with the same rules serves single values (the rule extractor's checks). pandas and numpy
+# are imported inside the column functions, so importing this module (as the CLI and workers do) stays cheap.
+import re
+from datetime import datetime
+
+###########################################################################
+# 1. Rules
+
+
+# Plain numbers, western grouping (1,000,000.00) and Indian grouping (2,00,000.00), optional currency prefix
+AMOUNT_PATTERN = r'^(?:₹|Rs\.?|INR)?\s*(?:\d{1,3}(?:,\d{2})*,\d{3}|\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?$'
+RATE_PATTERN = r'^\d+(?:\.\d+)?\s*%?$'
+GSTIN_PATTERN = r'^[0-9]{2}[A-Z]{5}[0-9]{4}[A-Z]{1}[A-Z0-9]{1}[Z]{1}[A-Z0-9]{1}$'  # ASCII digits only, for the checksum
+DATE_FORMATS = ['%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%d-%b-%Y', '%d %b %Y', '%d-%b-%y', '%Y-%m-%d']
+
+GSTIN_CHARSET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# field -> (kind, pattern); kinds without a pattern use a typed check
+RULES = {
+    'Invoice No.': ('pattern', r'^[A-Za-z0-9\-]+$'),
+    'Quantity': ('amount', AMOUNT_PATTERN),
+    'Date': ('date', None),
+    'Amount': ('amount', AMOUNT_PATTERN),
+    'Total': ('amount', AMOUNT_PATTERN),
+    'Email': ('pattern', r'^[\w\.-]+@[\w\.-]+\.\w+$'),
+    'Taxable Value': ('amount', AMOUNT_PATTERN),
+    'SGST Amount': ('amount', AMOUNT_PATTERN),
+    'CGST Amount': ('amount', AMOUNT_PATTERN),
+    'IGST Amount': ('amount', AMOUNT_PATTERN),
+    'SGST Rate': ('pattern', RATE_PATTERN),
+    'CGST Rate': ('pattern', RATE_PATTERN),
+    'IGST Rate': ('pattern', RATE_PATTERN),
+    'Tax Amount': ('amount', AMOUNT_PATTERN),
+    'Tax Rate': ('pattern', RATE_PATTERN),
+    'Final Amount': ('amount', AMOUNT_PATTERN),
+    'Invoice Date': ('date', None),
+    'GSTIN Supplier': ('gstin', GSTIN_PATTERN),
+    'GSTIN Recipient': ('gstin', GSTIN_PATTERN),
+}
+
+COMPILED_RULES = {field: (kind, re.compile(pattern) if pattern else None) for field, (kind, pattern) in RULES.items()}
+
+HIGH, MEDIUM, LOW = "High Confidence", "Medium Confidence", "Low Confidence"
+
+
+
+###################################################################
+# 2.  Typed Parsing
+
+# Converts amount strings ("15,000.00", "₹ 2,00,000") to floats; unparseable values become NaN.
+def parse_amounts(values):  # values (pd.Series): Raw extracted values.
+
+    import pandas as pd
+    cleaned = values.fillna("").astype(str).str.strip().str.replace(r'^(?:₹|Rs\.?|INR)\s*', '', regex=True).str.replace(",", "", regex=False)
+    return pd.to_numeric(cleaned, errors='coerce')  # pd.Series: float64.
+
+
+# Converts rate strings ("9%", "18") to floats; unparseable values become NaN.
+def parse_rates(values):  # values (pd.Series): Raw extracted values.
+
+    import pandas as pd
+    cleaned = values.fillna("").astype(str).str.strip().str.rstrip("%").str.strip()
+    return pd.to_numeric(cleaned, errors='coerce')  # pd.Series: float64.
+
+
+# Parses dates in any of DATE_FORMATS (day first); unparseable values become NaT.
+def parse_dates(values):  # values (pd.Series): Raw extracted values.
+
+    import pandas as pd
+    text = values.fillna("").astype(str).str.strip()
+    parsed = pd.Series(pd.NaT, index=text.index, dtype='datetime64[ns]')
+    for fmt in DATE_FORMATS:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(text[missing], format=fmt, errors='coerce')
+    return parsed  # pd.Series: datetime64.
+
+
+# Vectorized GSTIN check digit (mod-36 Luhn variant) for strings already known to match GSTIN_PATTERN.
+def gstin_checksum_ok(values):  # values (pd.Series): 15-character upper-case GSTINs.
+
+    import numpy as np
+    import pandas as pd
+    if values.empty:
+        return pd.Series(False, index=values.index)
+    raw = np.frombuffer("".join(values).encode('ascii'), dtype=np.uint8).reshape(-1, 15)
+    # Map '0'-'9' -> 0-9 and 'A'-'Z' -> 10-35
+    codes = np.where(raw <= ord('9'), raw - ord('0'), raw - ord('A') + 10).astype(np.int64)
+    factors = np.tile([1, 2], 7)
+    products = codes[:, :14] * factors
+    total = (products // 36 + products % 36).sum(axis=1)
+    check = (36 - total % 36) % 36
+    return pd.Series(check == codes[:, 14], index=values.index)  # pd.Series: bool.
+
+
+# Scalar form of gstin_checksum_ok.
+def gstin_checksum_ok_scalar(gstin):  # gstin (str): A 15-character upper-case GSTIN.
+
+    total = 0
+    for position, char in enumerate(gstin[:14]):
+        product = GSTIN_CHARSET.index(char) * (1 if position % 2 == 0 else 2)
+        total += product // 36 + product % 36
+    return GSTIN_CHARSET[(36 - total % 36) % 36] == gstin[14]
+
+
+
+###################################################################
+# 3.  Column Validation
+
+# Validity mask for one column under its rule. Fields without a rule only need a non-empty value.
+def validate_column(field, values):  # field (str): Field name.  values (pd.Series): Raw extracted values.
+
+    text = values.fillna("").astype(str).str.strip()
+    if field not in COMPILED_RULES:
+        return text != ""
+    kind, pattern = COMPILED_RULES[field]
+    if kind == 'date':
+        return parse_dates(text).notna()
+    valid = text.str.match(pattern)
+    if kind == 'gstin' and valid.any():
+        valid[valid] = gstin_checksum_ok(text[valid])
+    return valid.astype(bool)  # pd.Series: bool.
+
+
+# Validates every field column at once. Returns (valid, confidence) frames aligned with df.
+def validate_frame(df, fields):  # df (pd.DataFrame): Extracted rows.  fields (list): Field columns to check.
+
+    import numpy as np
+    import pandas as pd
+    valid = pd.DataFrame({field: validate_column(field, df[field] if field in df else pd.Series("", index=df.index)) for field in fields}, index=df.index)
+    ruled = np.array([field in COMPILED_RULES for field in fields])
+    labels = np.where(valid.to_numpy(), np.where(ruled, HIGH, MEDIUM), LOW)
+    confidence = pd.DataFrame(labels, index=df.index, columns=fields)
+    return valid, confidence  # tuple: (bool DataFrame, label DataFrame).
+
+
+# Adds the 'Confidence' and 'Trust' columns using column operations.
+def apply_validation(df, fields):  # df (pd.DataFrame): Extracted rows.  fields (list): Field columns to check.
+
+    import numpy as np
+    valid, confidence = validate_frame(df, fields)
+    df = df.copy()
+    df['Confidence'] = confidence[fields[0]].str.cat([confidence[field] for field in fields[1:]], sep="; ")
+    df['Trust'] = np.where((confidence == LOW).any(axis=1), "Untrusted", "Trusted")
+    return df, valid  # tuple: (DataFrame with Confidence/Trust, bool validity frame).
+
+
+# Percentage of valid values per field, formatted like the Streamlit metrics table.
+def field_accuracy(valid):  # valid (pd.DataFrame): Validity frame from validate_frame.
+
+    import pandas as pd
+    if valid.empty:
+        return pd.Series("N/A", index=valid.columns)
+    return (valid.mean() * 100).map(lambda accuracy: f"{accuracy:.2f}%")  # pd.Series: field -> "NN.NN%".
+
+
+
+###################################################################
+# 4.  Cross-Field Reconciliation
+
+RECONCILE_TOLERANCE = 1.0  # rupees; invoices round to the nearest rupee
+
+# Numeric GST fields that the reconciliation checks read (and a targeted re-extraction may correct)
+RECONCILED_FIELDS = [
+    'Taxable Value', 'SGST Amount', 'CGST Amount', 'IGST Amount',
+    'SGST Rate', 'CGST Rate', 'IGST Rate', 'Tax Amount', 'Tax Rate', 'Final Amount',
+]
+
+
+# True where two amounts differ by more than the tolerance; rows missing either side are not flagged.
+def _mismatch(actual, expected, tolerance):
+
+    return ((actual - expected).abs() > tolerance).fillna(False)
+
+
+# Arithmetic consistency checks across the GST fields, one boolean column per check (True = inconsistent).
+# A check only runs on rows where all of its operands were extracted and parse as numbers.
+def reconcile_amounts(df, tolerance=RECONCILE_TOLERANCE):  # df (pd.DataFrame): Extracted rows.  tolerance (float): Allowed rounding difference.
+
+    import numpy as np
+    import pandas as pd
+    def amounts(field):
+        return parse_amounts(df[field]) if field in df else pd.Series(np.nan, index=df.index)
+
+    def rates(field):
+        return parse_rates(df[field]) if field in df else pd.Series(np.nan, index=df.index)
+
+    taxable, tax, final = amounts('Taxable Value'), amounts('Tax Amount'), amounts('Final Amount')
+    sgst, cgst, igst = amounts('SGST Amount'), amounts('CGST Amount'), amounts('IGST Amount')
+    sgst_rate, cgst_rate, tax_rate = rates('SGST Rate'), rates('CGST Rate'), rates('Tax Rate')
+
+    has_component = sgst.notna() | cgst.notna() | igst.notna()
+    components = sgst.fillna(0) + cgst.fillna(0) + igst.fillna(0)
+    # Rate-derived amounts get an extra half percent for rates rounded on the invoice
+    rate_tolerance = tolerance + 0.005 * tax.abs()
+
+    issues = pd.DataFrame({
+        'SGST + CGST + IGST != Tax Amount': _mismatch(components.where(has_component), tax, tolerance),
+        'Taxable Value + Tax Amount != Final Amount': _mismatch(taxable + tax, final, tolerance),
+        'Taxable Value x Tax Rate != Tax Amount': _mismatch(taxable * tax_rate / 100, tax, rate_tolerance),
+        'SGST != CGST': _mismatch(sgst, cgst, tolerance),
+        'SGST Rate + CGST Rate != Tax Rate': _mismatch(sgst_rate + cgst_rate, tax_rate, 0.01),
+    }, index=df.index)
+    return issues  # pd.DataFrame: bool, one column per check.
+
+
+# Joins the names of the failed checks per row ("" when the row is consistent).
+def describe_issues(issues):  # issues (pd.DataFrame): Output of reconcile_amounts.
+
+    import numpy as np
+    import pandas as pd
+    if issues.empty:
+        return pd.Series("", index=issues.index, dtype=object)
+    labels = [pd.Series(np.where(issues[check], check, ""), index=issues.index) for check in issues.columns]
+    joined = labels[0].str.cat(labels[1:], sep="; ")
+    return joined.str.replace(r'(?:; )+', '; ', regex=True).str.strip("; ")  # pd.Series: str.
+
+
+
+###################################################################
+# 5.  Scalar Validation
+
+# Validates one value with the same compiled rules; used per record while results stream in.
+def validate_value(field, value):  # field (str): The name of the field.  value (str): The extracted value of the field.
+
+    text = "" if value is None else str(value).strip()
+    if field not in COMPILED_RULES:
+        # For fields without specific rules, basic non-empty check
+        return (True, MEDIUM) if text else (False, LOW)
+
+    kind, pattern = COMPILED_RULES[field]
+    if kind == 'date':
+        is_valid = any(_strptime_ok(text, fmt) for fmt in DATE_FORMATS)
+    else:
+        is_valid = bool(pattern.match(text))
+        if is_valid and kind == 'gstin':
+            is_valid = gstin_checksum_ok_scalar(text)
+    return (True, HIGH) if is_valid else (False, LOW)  # tuple: (is_valid, confidence label).
+
+
+def _strptime_ok(text, fmt):
+
+    try:
+        datetime.strptime(text, fmt)
+        return True
+    except ValueError:
+        return False
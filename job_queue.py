@@ -0,0 +1,443 @@
+# Background job queue for the web app (SQLite job state + a shared pool of job processes). Uploads are
+# spooled to disk and processed in a job process; browser sessions only submit jobs and poll their state,
+# so a long batch never blocks a session's script thread, and all sessions of a server share the same
+# workers instead of each running its own pipeline. Submitting files that are already queued, running or
+# done returns that job, so reruns and other users reuse its results. Finished jobs are deleted after
+# JOB_RETENTION_DAYS, and a done job's extracted text and replies are read from the extraction cache.
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import logging
+import multiprocessing
+import pandas as pd
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from invoice_core import INVOICE_FIELDS
+from invoice_ocr import default_ocr_workers
+from invoice_pipeline import RecordBuffer, default_api_in_flight, iter_invoice_records, llm_cache_key, read_upload, reconcile_and_reextract
+from invoice_validation import apply_validation, field_accuracy
+from line_items import check_line_items, line_items_frame
+from output_store import get_default_store
+from extraction_cache import document_hash, get_default_cache
+from checkpoint_journal import CheckpointJournal
+from text_compaction import prompt_text
+from llm_providers import get_provider, provider_name
+from stage_metrics import VALIDATION_FRAME, profiler_from_env, profiling, start_run
+
+###########################################################################
+# 1. Configuration
+
+
+DEFAULT_JOBS_PATH = ".extraction_jobs.sqlite"
+DEFAULT_SPOOL_DIR = ".extraction_jobs"
+DEFAULT_MAX_RUNNING = 2  # jobs processed at once; each gets an equal share of the OCR workers and API slots
+DEFAULT_RETENTION_DAYS = 7
+LOG_FILE = 'invoice_extraction.log'
+
+QUEUED, RUNNING, DONE, FAILED, INTERRUPTED = 'queued', 'running', 'done', 'failed', 'interrupted'
+ACTIVE = (QUEUED, RUNNING)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    files_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    server_pid INTEGER,
+    error TEXT,
+    reextracted INTEGER,
+    accuracy TEXT,
+    metrics TEXT,
+    metrics_prom TEXT,
+    profile_path TEXT,
+    force INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_files_key ON jobs (files_key, created_at);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    doc_hash TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT,
+    message TEXT,
+    text TEXT,
+    raw_response TEXT,
+    reused_hash TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, position)
+);
+'''
+
+# Columns added after the first release: (table, column) -> SQL type
+ADDED_COLUMNS = {
+    ('jobs', 'force'): 'INTEGER NOT NULL DEFAULT 0',  # the files are processed again, ignoring earlier results
+    ('job_files', 'reused_hash'): 'TEXT',             # a copy's source document, whose stored row is shown for it
+}
+
+# At most one queued or running job per set of files, so concurrent submits cannot start the same work twice
+ACTIVE_KEY_INDEX = f'''
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_files_key ON jobs (files_key) WHERE status IN ('{QUEUED}', '{RUNNING}')
+'''
+
+
+# Queue settings, read lazily so a .env loaded after import still applies.
+def job_settings():
+
+    return {
+        'path': os.getenv("JOB_QUEUE_PATH", DEFAULT_JOBS_PATH),
+        'spool_dir': os.getenv("JOB_SPOOL_DIR", DEFAULT_SPOOL_DIR),
+        'max_running': int(os.getenv("JOB_MAX_RUNNING", DEFAULT_MAX_RUNNING)),
+        'retention_days': float(os.getenv("JOB_RETENTION_DAYS", DEFAULT_RETENTION_DAYS)),  # finished jobs older than this are deleted
+    }  # dict: Job queue settings.
+
+
+# Identifies a set of uploads by content, whatever their names or order.
+def files_key(doc_hashes):  # doc_hashes (list): Document hash per file.
+
+    return hashlib.sha256("\n".join(sorted(doc_hashes)).encode("ascii")).hexdigest()  # str: Hex digest.
+
+
+def _pid_alive(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+
+###################################################################
+# 2.  Job State
+
+class JobQueue:
+
+    def __init__(self, path=None, spool_dir=None, max_running=None, retention_days=None):
+        settings = job_settings()
+        self.path = path or settings['path']
+        self.spool_dir = spool_dir or settings['spool_dir']
+        self.max_running = max_running or settings['max_running']
+        self.retention_days = settings['retention_days'] if retention_days is None else retention_days
+        self._executor = None
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            self._add_missing_columns(conn)
+            # Jobs left queued or running by a server that is gone will never finish; resubmitting resumes them
+            for job_id, server_pid in conn.execute("SELECT job_id, server_pid FROM jobs WHERE status IN (?, ?)", ACTIVE).fetchall():
+                if server_pid != os.getpid() and not _pid_alive(server_pid):
+                    conn.execute("UPDATE jobs SET status = ?, error = ? WHERE job_id = ?",
+                                 (INTERRUPTED, "The server stopped before the job finished. Submit the files again to resume.", job_id))
+        try:
+            with self._connect() as conn:
+                conn.execute(ACTIVE_KEY_INDEX)
+        except sqlite3.IntegrityError:
+            logging.warning(f"{self.path} holds several active jobs for the same files; concurrent submits are not deduplicated until they finish.")
+        self.purge()
+
+    # Job databases created before a column was added get it with its default.
+    @staticmethod
+    def _add_missing_columns(conn):
+        for (table, column), sql_type in ADDED_COLUMNS.items():
+            if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {sql_type}")
+
+    # Opens a short-lived connection that commits on success and is always closed.
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def job_dir(self, job_id):
+        return os.path.join(self.spool_dir, job_id)
+
+    def spool_path(self, job_id, position):
+        return os.path.join(self.job_dir(job_id), f"{position:05d}.pdf")
+
+    # Worker processes are spawned (not forked) because the Streamlit server runs many threads.
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_running, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_init_worker)
+        return self._executor
+
+    def _start(self, job_id):
+        args = (run_job, job_id, self.path, self.spool_dir,
+                max(1, default_ocr_workers() // self.max_running), max(1, default_api_in_flight() // self.max_running))
+        try:
+            future = self._pool().submit(*args)
+        except BrokenProcessPool:
+            self._executor = None  # a job process died; later jobs get a fresh pool
+            future = self._pool().submit(*args)
+        future.add_done_callback(lambda done: self._job_exited(job_id, done))
+
+    # A job process that died (rather than raising) leaves the job running; mark it failed instead.
+    def _job_exited(self, job_id, future):
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            logging.error(f"Job {job_id} failed: {error}")
+            self._update_job(job_id, status=FAILED, finished_at=time.time(), error=str(error) or type(error).__name__)
+
+    # The queued or running job for a set of files, or None.
+    def _active_job(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT job_id FROM jobs WHERE files_key = ? AND status IN (?, ?)", (key, *ACTIVE)).fetchone()
+        return row['job_id'] if row else None
+
+    # Spools the uploads and queues a job for them, returning its id. The same files (by content) already
+    # queued, running or done return that job; an interrupted or failed job for them is resumed. The job
+    # is claimed in the database before anything is spooled or started, so of several concurrent submits
+    # of the same files only one starts a job and the others return it.
+    def submit(self, files, force=False):  # files (list): Uploaded PDF files.  force (bool): Start a new job unless one is queued or running, processing the files again without the duplicate index or cache.
+
+        contents = [read_upload(file) for file in files]
+        doc_hashes = [document_hash(data) for data in contents]
+        key = files_key(doc_hashes)
+        with self._connect() as conn:
+            previous = conn.execute("SELECT job_id, status FROM jobs WHERE files_key = ? ORDER BY created_at DESC LIMIT 1", (key,)).fetchone()
+        if previous and (previous['status'] in ACTIVE or (not force and previous['status'] == DONE)):
+            logging.info(f"Reusing job {previous['job_id']} ({previous['status']}) for {len(files)} file(s).")
+            return previous['job_id']  # str: The job id.
+
+        resume = previous is not None and not force
+        job_id = previous['job_id'] if resume else uuid.uuid4().hex
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                if resume:
+                    claimed = conn.execute("UPDATE jobs SET status = ?, error = NULL, server_pid = ?, created_at = ? WHERE job_id = ? AND status NOT IN (?, ?)",
+                                           (QUEUED, os.getpid(), now, job_id, *ACTIVE)).rowcount
+                    if claimed:
+                        conn.execute("UPDATE job_files SET stage = 'queued', status = NULL, message = NULL, updated_at = ? WHERE job_id = ?", (now, job_id))
+                else:
+                    claimed = conn.execute("INSERT INTO jobs (job_id, files_key, status, total, created_at, server_pid, force) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+                                           (job_id, key, QUEUED, len(files), now, os.getpid(), int(force))).rowcount
+                    if claimed:
+                        conn.executemany(
+                            "INSERT INTO job_files (job_id, position, name, doc_hash, stage, updated_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                            [(job_id, position, file.name, doc_hash, now) for position, (file, doc_hash) in enumerate(zip(files, doc_hashes))],
+                        )
+        except sqlite3.IntegrityError:
+            claimed = 0  # another submit queued a different job for these files first
+        if not claimed:
+            active = self._active_job(key) or job_id
+            logging.info(f"Job {active} for these {len(files)} file(s) was queued by a concurrent submit; reusing it.")
+            return active
+
+        # A resumed job keeps its file positions (and so its journal), whatever the upload order now
+        positions = {file['doc_hash']: file['position'] for file in self.files(job_id)} if resume else {}
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        for position, (data, doc_hash) in enumerate(zip(contents, doc_hashes)):
+            with open(self.spool_path(job_id, positions.get(doc_hash, position)), "wb") as f:
+                f.write(data)
+        self._start(job_id)
+        logging.info(f"{'Resumed' if resume else 'Queued'} job {job_id} with {len(files)} file(s).")
+        self.purge()
+        return job_id
+
+    # Deletes jobs that finished (or failed or were interrupted) more than retention_days ago, with their
+    # per-file rows and spooled uploads. Their invoices stay in the output store.
+    def purge(self):
+
+        cutoff = time.time() - self.retention_days * 86400
+        with self._connect() as conn:
+            expired = [row['job_id'] for row in conn.execute(
+                "SELECT job_id FROM jobs WHERE status NOT IN (?, ?) AND COALESCE(finished_at, created_at) < ?", (*ACTIVE, cutoff))]
+            conn.executemany("DELETE FROM job_files WHERE job_id = ?", [(job_id,) for job_id in expired])
+            conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(job_id,) for job_id in expired])
+        for job_id in expired:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        if expired:
+            logging.info(f"Deleted {len(expired)} job(s) finished more than {self.retention_days:g} day(s) ago.")
+        return len(expired)  # int: Jobs deleted.
+
+    # The job's row as a dict (accuracy and metrics decoded), or None.
+    def job(self, job_id):
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            job['done'] = conn.execute("SELECT COUNT(*) FROM job_files WHERE job_id = ? AND status IS NOT NULL", (job_id,)).fetchone()[0]
+            job['queue_position'] = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?",
+                                                 (QUEUED, job['created_at'])).fetchone()[0] if job['status'] == QUEUED else 0
+        job['accuracy'] = json.loads(job['accuracy']) if job['accuracy'] else {}
+        job['metrics'] = json.loads(job['metrics']) if job['metrics'] else None
+        return job  # dict or None: Job state.
+
+    # Per-file state in upload order (without the extracted text and raw reply, see file_details).
+    def files(self, job_id):
+
+        with self._connect() as conn:
+            rows = conn.execute("SELECT position, name, doc_hash, stage, status, message FROM job_files WHERE job_id = ? ORDER BY position",
+                                (job_id,)).fetchall()
+        return [dict(row) for row in rows]  # list: One dict per file.
+
+    # Invoice rows and line items of a finished job: the rows it stored, then the stored rows its copies
+    # reused (copies are not stored again). Returns (invoice DataFrame, line item DataFrame).
+    def results(self, job_id):
+
+        store = get_default_store()
+        df, items = store.run(job_id), store.line_items(job_id)
+        with self._connect() as conn:
+            reused = [row[0] for row in conn.execute("SELECT DISTINCT reused_hash FROM job_files WHERE job_id = ? AND reused_hash IS NOT NULL",
+                                                     (job_id,))]
+        if reused:
+            df = pd.concat([df, store.latest(reused)], ignore_index=True)
+            items = pd.concat([items, store.line_items(doc_hashes=reused)], ignore_index=True)
+        return df, items  # tuple: (pd.DataFrame, pd.DataFrame).
+
+    # Extracted text and raw reply of one file: (text, raw_response). They are kept in the job only until
+    # its results are stored; after that they come from the extraction cache while it still holds them.
+    def file_details(self, job_id, position):
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT doc_hash, text, raw_response FROM job_files WHERE job_id = ? AND position = ?", (job_id, position)).fetchone()
+        if row is None:
+            return None, None
+        text, raw_response = row['text'], row['raw_response']
+        if text is None:
+            cache = get_default_cache()
+            text = cache.get_text(row['doc_hash'])
+            if text:
+                compacted = prompt_text(text)[0]
+                raw_response = cache.get_response(llm_cache_key(compacted)) or cache.get_response(llm_cache_key(compacted, batched=True))
+        return text, raw_response  # tuple: (str or None, str or None).
+
+    def _update_job(self, job_id, **fields):
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def _update_file(self, job_id, position, **fields):
+        fields['updated_at'] = time.time()
+        with self._connect() as conn:
+            conn.execute(f"UPDATE job_files SET {', '.join(f'{name} = ?' for name in fields)} WHERE job_id = ? AND position = ?",
+                         (*fields.values(), job_id, position))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+
+###################################################################
+# 3.  Job Process
+
+# A spooled upload as the pipeline expects it (name, seek, read).
+class SpooledPdf:
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def seek(self, offset):
+        pass
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def _init_worker():
+    logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+
+
+# Outcome shown in the progress table for a finished record: (status, message).
+def describe_record(record):  # record (InvoiceRecord): A finished invoice.
+
+    if record.status == 'error':
+        return 'error', f"An error occurred: {record.error}"
+    if record.status == 'no_text':
+        return 'skipped', "No text extracted."
+    if record.status == 'api_failed':
+        return 'failed', "Failed to extract data."
+    if record.status == 'invalid_json':
+        return 'failed', "Invalid JSON in the API response."
+    if record.is_copy:
+        return 'copy', f"Copy of {record.duplicate_of}, which was already processed; its stored result was reused and it is not added again."
+    if record.duplicate_kind == 'key':
+        return 'warning', f"Same supplier GSTIN, invoice number and final amount as {record.duplicate_of}. Check that it is not a duplicate."
+    if record.duplicate_kind == 'similar':
+        return 'ok', f"Extraction successful. The text is close to {record.duplicate_of}, but it is a different invoice."
+    return 'ok', "Extraction successful."  # tuple: (status, message).
+
+
+# API client counters of this process (cumulative), for per-job deltas.
+def _api_counters():
+
+    if provider_name() != 'azure':
+        return {}
+    snapshot = get_provider().client.metrics.snapshot()
+    return {name: snapshot[name] for name in ('requests', 'retries', 'rate_limited')}
+
+
+# Runs one job in a job process: the pipeline over its spooled files, then reconciliation, validation and
+# line-item checks for the whole batch, and the rows appended to the output store under the job id.
+def run_job(job_id, path=None, spool_dir=None, ocr_workers=None, api_in_flight=None):  # job_id (str): The job.  ocr_workers (int): This job's share of the OCR processes.  api_in_flight (int): This job's share of the API slots.
+
+    queue = JobQueue(path, spool_dir)
+    force = bool(queue.job(job_id)['force'])
+    queue._update_job(job_id, status=RUNNING, started_at=time.time(), error=None)
+    files = queue.files(job_id)
+    pdfs = [SpooledPdf(file['name'], queue.spool_path(job_id, file['position'])) for file in files]
+    buffer = RecordBuffer()
+    run_metrics = start_run()
+    api_before = _api_counters()
+
+    def progress(index, name, stage):
+        queue._update_file(job_id, index, stage=stage)
+
+    try:
+        with profiling(profiler_from_env()) as profile_path:
+            # The job's journal lets a resumed job skip files that finished before an interruption
+            with CheckpointJournal(os.path.join(queue.job_dir(job_id), "journal.jsonl")) as journal:
+                for record in iter_invoice_records(pdfs, max_ocr_workers=ocr_workers, max_api_in_flight=api_in_flight,
+                                                   progress=progress, journal=journal, force=force):
+                    status, message = describe_record(record)
+                    if record.is_new_row:
+                        buffer.append(record)
+                    queue._update_file(job_id, record.index, status=status, message=message, text=record.text,
+                                       raw_response=record.raw_response, reused_hash=record.duplicate_hash if record.is_copy else None)
+
+            df, reextracted = reconcile_and_reextract(buffer.to_dataframe(), buffer.sorted_texts(), max_api_in_flight=api_in_flight)
+            with run_metrics.timer(VALIDATION_FRAME):
+                df, valid = apply_validation(df, INVOICE_FIELDS)
+                items = line_items_frame(buffer.sorted_line_items())
+                df = check_line_items(df, items)
+            accuracy = field_accuracy(valid).to_dict()
+
+        get_default_store().append(df, files=buffer.sorted_names(), doc_hashes=buffer.sorted_hashes(), run_id=job_id, line_items=items)
+        run_metrics.count('reextracted', reextracted)
+        run_metrics.count('still_inconsistent', int((~df['Reconciled']).sum()))
+        run_metrics.count('line_items_mismatch', int(df['Line Items Match'].eq(False).sum()))
+        for name, value in _api_counters().items():
+            run_metrics.count(f'api_{name}', value - api_before.get(name, 0))
+        queue._update_job(job_id, status=DONE, finished_at=time.time(), reextracted=reextracted, accuracy=json.dumps(accuracy),
+                          metrics=run_metrics.to_json(), metrics_prom=run_metrics.to_prometheus(), profile_path=profile_path)
+    except Exception as e:
+        logging.exception(f"Job {job_id} failed.")
+        queue._update_job(job_id, status=FAILED, finished_at=time.time(), error=str(e))
+        return
+    # Results are in the store now; the spooled uploads, text and replies are no longer needed here
+    with queue._connect() as conn:
+        conn.execute("UPDATE job_files SET text = NULL, raw_response = NULL WHERE job_id = ?", (job_id,))
+    shutil.rmtree(queue.job_dir(job_id), ignore_errors=True)
+    logging.info(f"Job {job_id} finished: {len(df)} invoice(s) stored.")
@@ -0,0 +1,189 @@
+# Line-item stage: finds the item table in the extracted text and parses its rows locally, so long item
+# lists cost no LLM output tokens. Rows are parsed per document while results stream in; the arithmetic
+# checks (quantity x rate = amount, items summing to the Taxable Value or Final Amount) run column-wise
+# over the whole run, like invoice_validation (and, like it, import pandas only there).
+import os
+import re
+from text_backends import PAGE_BREAK
+from invoice_validation import RECONCILE_TOLERANCE, parse_amounts
+
+###########################################################################
+# 1. Configuration
+
+
+LINE_ITEM_COLUMNS = ['Line', 'Description', 'HSN', 'Quantity', 'Unit', 'Rate', 'Amount']
+
+# Table header: a description column plus at least two of quantity / rate / amount
+HEADER_DESCRIPTION = re.compile(r'\b(?:description|particulars|item|product|goods|services?)\b', re.IGNORECASE)
+HEADER_NUMBERS = [re.compile(pattern, re.IGNORECASE) for pattern in (r'\b(?:qty|quantity)\b', r'\b(?:rate|price)\b', r'\b(?:amount|value|total)\b')]
+# Lines that end the table
+TABLE_END = re.compile(r'^\s*(?:sub\s*-?\s*total|taxable\s*(?:value|amount)|total|grand\s+total|[cis]gst|amount\s+in\s+words|tax\s+amount)\b', re.IGNORECASE)
+
+NUMBER = re.compile(r'^(?:₹|Rs\.?)?(\d{1,3}(?:,\d{2,3})+(?:\.\d+)?|\d+(?:\.\d+)?)$')
+UNITS = {'nos', 'no', 'pcs', 'pc', 'kg', 'kgs', 'g', 'ltr', 'l', 'mtr', 'm', 'box', 'set', 'sets', 'unit', 'units', 'each', 'hrs', 'hours', 'days'}
+SERIAL = re.compile(r'^\d{1,3}[.)]?$')
+HSN = re.compile(r'^\d{4,8}$')
+HSN_LABEL = re.compile(r'^(?:hsn|sac|hsn/sac)[:.]?$', re.IGNORECASE)
+
+ROW_TOLERANCE = 0.01      # share of the amount allowed for rounding in quantity x rate
+MAX_NUMBER_COLUMNS = 10   # lines with more numbers than this are not item rows (and would make the search slow)
+
+
+# Line-item stage switch, read lazily so a .env loaded after import still applies.
+def line_items_enabled():
+
+    return os.getenv("LINE_ITEMS", "1").lower() in ("1", "true", "yes")  # bool: Whether items are parsed.
+
+
+
+###################################################################
+# 2.  Row Parsing
+
+def _number(token):
+
+    match = NUMBER.match(token)
+    return float(match.group(1).replace(",", "")) if match else None
+
+
+def _close(quantity, rate, amount):
+
+    return abs(quantity * rate - amount) <= max(1.0, ROW_TOLERANCE * abs(amount))
+
+
+# Unit columns between the numbers: a known unit, or a short word right after a number ("3 Bags").
+def _is_unit(tokens, position):
+
+    token = tokens[position].lower().rstrip(".")
+    if token in UNITS:
+        return True
+    return token.isalpha() and len(token) <= 5 and not HSN_LABEL.match(token) and position > 0 and _number(tokens[position - 1]) is not None
+
+
+# Parses one table line into a row, or None. The numeric columns are read from the right; the amount and
+# quantity/rate are the rightmost numbers where quantity x rate = amount, so tax-rate, tax and line-total
+# columns after the amount are skipped. Without such numbers, the last three are taken as they stand.
+def parse_row(line, require_match=False):  # line (str): One line of text.  require_match (bool): Only accept rows whose quantity x rate equals the amount.
+
+    tokens = line.split()
+    numbers = []  # (token position, value) from the right
+    position = len(tokens) - 1
+    while position >= 0:
+        value = _number(tokens[position].rstrip(","))
+        if value is not None:
+            numbers.append((position, value))
+        elif not tokens[position].endswith("%") and not _is_unit(tokens, position):
+            break
+        position -= 1
+    numbers.reverse()
+    if not 2 <= len(numbers) <= MAX_NUMBER_COLUMNS or position < 0:
+        return None  # no description, or not an item row's numbers
+
+    found = None
+    for last in range(len(numbers) - 1, 1, -1):
+        for first in range(last - 1, 0, -1):
+            for second in range(first - 1, -1, -1):
+                if _close(numbers[second][1], numbers[first][1], numbers[last][1]):
+                    found = (numbers[second], numbers[first], numbers[last])
+                    break
+            if found:
+                break
+        if found:
+            break
+    if found is None:
+        if require_match:
+            return None
+        found = tuple(numbers[-3:]) if len(numbers) >= 3 else (None,) + tuple(numbers[-2:])
+    quantity, rate, amount = found
+
+    start = (quantity or rate)[0]
+    hsn = next((index for index, _ in reversed(numbers) if index < start and HSN.match(tokens[index])), None)
+    words = [token for token in tokens[:start if hsn is None else hsn] if not HSN_LABEL.match(token)]
+    serial = words.pop(0).rstrip(".)") if len(words) > 1 and SERIAL.match(words[0]) else ""
+    description = " ".join(words)
+    if not re.search(r'[A-Za-z]', description):
+        return None
+    unit = next((token for token in tokens[start:amount[0]] if _number(token.rstrip(",")) is None and not token.endswith("%")), "")
+    return {
+        'Line': serial, 'Description': description, 'HSN': tokens[hsn] if hsn is not None else "",
+        'Quantity': tokens[quantity[0]].rstrip(",") if quantity else "", 'Unit': unit,
+        'Rate': tokens[rate[0]].rstrip(","), 'Amount': tokens[amount[0]].rstrip(","),
+    }  # dict or None: Raw strings keyed by LINE_ITEM_COLUMNS.
+
+
+def _is_header(line):
+
+    return bool(HEADER_DESCRIPTION.search(line)) and sum(bool(pattern.search(line)) for pattern in HEADER_NUMBERS) >= 2
+
+
+# Finds the item rows of one document. Inside a table (after a header line, until a totals line) any line
+# with a description and trailing numbers is a row and number-free lines continue the previous description;
+# a header repeated on later pages restarts the table. Without any header, only lines whose
+# quantity x rate matches the amount are taken.
+def parse_line_items(text):  # text (str): Extracted text, pages separated by PAGE_BREAK.
+
+    lines = [line for page in text.split(PAGE_BREAK) for line in page.splitlines()]
+    has_header = any(_is_header(line) for line in lines)
+    rows = []
+    in_table = not has_header
+    for line in lines:
+        if not line.strip():
+            continue
+        if has_header and _is_header(line):
+            in_table = True
+            continue
+        if not in_table:
+            continue
+        if TABLE_END.match(line):
+            if has_header:
+                in_table = False
+            continue
+        row = parse_row(line, require_match=not has_header)
+        if row is not None:
+            rows.append(row)
+        elif has_header and rows and not re.search(r'\d', line) and len(line.split()) <= 8:
+            rows[-1]['Description'] += " " + line.strip()
+    return rows  # list: Row dicts in document order.
+
+
+
+###################################################################
+# 3.  Column Checks
+
+# Builds one frame of line items for a run: 'row' links each item to its invoice's position in the
+# invoice frame; Quantity, Rate and Amount are parsed to floats and each item gets a 'Consistent' flag.
+def line_items_frame(items_per_invoice):  # items_per_invoice (list): Row dict lists, one per invoice row.
+
+    import numpy as np
+    import pandas as pd
+    records = [dict(item, row=position) for position, items in enumerate(items_per_invoice) for item in items]
+    items = pd.DataFrame(records, columns=['row'] + LINE_ITEM_COLUMNS)
+    for column in ('Quantity', 'Rate', 'Amount'):
+        items[column] = parse_amounts(items[column])
+    expected = items['Quantity'].fillna(1.0) * items['Rate']
+    tolerance = np.maximum(1.0, ROW_TOLERANCE * items['Amount'].abs())
+    items['Consistent'] = ~((expected - items['Amount']).abs() > tolerance).fillna(False)
+    return items  # pd.DataFrame: One row per line item.
+
+
+# Compares each invoice's item total with its Taxable Value (items before tax) or Final Amount (items
+# including tax). Adds 'Line Items', 'Line Items Total' and 'Line Items Match' (NA when no items were found).
+def check_line_items(df, items):  # df (pd.DataFrame): Invoice rows.  items (pd.DataFrame): From line_items_frame, 'row' indexing df by position.
+
+    import numpy as np
+    import pandas as pd
+    df = df.copy()
+    positions = pd.RangeIndex(len(df))
+    counts = items.groupby('row').size().reindex(positions, fill_value=0)
+    totals = items.groupby('row')['Amount'].sum(min_count=1).reindex(positions)
+    tolerance = RECONCILE_TOLERANCE + 0.5 * counts  # each item may be rounded on the invoice
+
+    def close(field):
+        values = parse_amounts(df[field]).to_numpy() if field in df else np.full(len(df), np.nan)
+        return pd.Series(np.abs(totals.to_numpy() - values) <= tolerance.to_numpy(), index=positions)
+
+    match = (close('Taxable Value') | close('Amount') | close('Final Amount')).astype('boolean')
+    match[counts == 0] = pd.NA
+    df['Line Items'] = counts.to_numpy()
+    df['Line Items Total'] = totals.to_numpy()
+    df['Line Items Match'] = match.to_numpy()
+    return df  # pd.DataFrame: df with the three line-item columns.
@@ -0,0 +1,221 @@
+# Tolerant JSON extraction from model replies. A single-pass scanner finds balanced top-level
+# objects/arrays (ignoring braces inside strings), so it works on prose, code fences and several
+# objects alike, and can be fed a streamed reply chunk by chunk.
+import re
+import ast
+import json
+import logging
+
+###########################################################################
+# 1. Configuration
+
+
+FENCE = re.compile(r'^\s*```[\w-]*\s*$', re.MULTILINE)
+TRAILING_COMMA = re.compile(r',\s*([}\]])')
+SINGLE_QUOTED = re.compile(r"'((?:[^'\\\n]|\\.)*)'")
+PYTHON_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"})
+
+# Spellings the model uses for the canonical columns, keyed by their normalized form (see _key)
+KEY_ALIASES = {
+    'invoicenumber': 'Invoice No.',
+    'invno': 'Invoice No.',
+    'qty': 'Quantity',
+    'emailid': 'Email',
+    'emailaddress': 'Email',
+    'taxableamount': 'Taxable Value',
+    'totaltax': 'Tax Amount',
+    'totaltaxamount': 'Tax Amount',
+    'grandtotal': 'Final Amount',
+    'totalamount': 'Total',
+    'suppliergstin': 'GSTIN Supplier',
+    'sellergstin': 'GSTIN Supplier',
+    'gstinofsupplier': 'GSTIN Supplier',
+    'recipientgstin': 'GSTIN Recipient',
+    'buyergstin': 'GSTIN Recipient',
+    'gstinofrecipient': 'GSTIN Recipient',
+}
+
+
+
+###################################################################
+# 2.  Scanning
+
+# Incremental scanner for top-level JSON values. feed() can be called with any slicing of the text;
+# completed values are appended to .values as raw text. A quote only opens a string where a JSON string
+# can start (after an opener, comma or colon), so an apostrophe in a bracketed aside ("[the buyer's copy]")
+# does not swallow the rest of the reply.
+class JsonStreamScanner:
+
+    def __init__(self):
+        self.values = []
+        self._buffer = []
+        self._stack = []
+        self._quote = None
+        self._escaped = False
+        self._previous = None  # last non-space character outside strings
+        self._commas = []  # (buffer length, stack) at each comma, for closing a cut-off value
+
+    def feed(self, chunk):  # chunk (str): The next piece of the reply; None starts over.
+        if chunk is None:
+            self.__init__()
+            return 0
+        for char in chunk:
+            if not self._stack:
+                if char in "{[":
+                    self._stack.append(char)
+                    self._buffer = [char]
+                    self._commas = []
+                    self._previous = char
+                continue
+            self._buffer.append(char)
+            if self._quote:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == self._quote:
+                    self._quote = None
+            elif char in "\"'" and self._previous in ("{", "[", ",", ":"):
+                self._quote = char
+            elif char in "{[":
+                self._stack.append(char)
+            elif char in "}]":
+                self._stack.pop()
+                if not self._stack:
+                    self.values.append("".join(self._buffer))
+                    self._buffer = []
+            elif char == ",":
+                self._commas.append((len(self._buffer) - 1, tuple(self._stack)))
+            if not self._quote and not char.isspace():
+                self._previous = char
+        return len(self.values)  # int: Completed values so far.
+
+    # First completed value that decodes to a dict, or None.
+    def first_object(self):
+        for text in self.values:
+            value = loads_tolerant(text)
+            if isinstance(value, dict):
+                return value
+        return None
+
+    # The value still open when the reply ended (e.g. cut off by max_tokens), closed after its last
+    # complete member. None when nothing is open.
+    def truncated_value(self):
+        if not self._stack or not self._commas:
+            return None
+        cut, stack = self._commas[-1]
+        closers = "".join("}" if opener == "{" else "]" for opener in reversed(stack))
+        return "".join(self._buffer[:cut]) + closers  # str: Repaired JSON text.
+
+
+# Removes markdown code fences (```json ... ```), keeping their content.
+def strip_fences(text):
+
+    return FENCE.sub("", text)
+
+
+def _replace_outside_strings(text, words):
+
+    return re.sub(r'"(?:[^"\\]|\\.)*"|\b(' + "|".join(words) + r')\b',
+                  lambda match: words[match.group(1)] if match.group(1) else match.group(0), text)
+
+
+# Fixes the usual defects: smart quotes, single-quoted strings, Python literals and trailing commas.
+def repair_json(text):
+
+    text = text.translate(SMART_QUOTES)
+    if re.search(r"[{,\[]\s*'", text):
+        text = SINGLE_QUOTED.sub(lambda match: json.dumps(match.group(1).replace("\\'", "'")), text)
+    text = _replace_outside_strings(text, PYTHON_LITERALS)
+    return TRAILING_COMMA.sub(r'\1', text)  # str: Repaired JSON text.
+
+
+# json.loads, then json.loads on the repaired text, then a Python literal. Returns None if all fail.
+def loads_tolerant(text):
+
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    repaired = repair_json(text)
+    try:
+        return json.loads(repaired)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None  # object or None: The decoded value.
+
+
+
+###################################################################
+# 3.  Normalization and Parsing
+
+def _key(name):
+
+    return re.sub(r'[^a-z0-9]', '', str(name).lower())
+
+
+# Maps key spellings ("invoice_no", "Invoice Number", "supplier gstin") to the canonical field names.
+# Exact matches win over aliases; unknown keys are kept as they are; null values become "".
+def normalize_keys(data, fields):  # data (dict): Decoded object.  fields (list): Canonical field names.
+
+    canonical = {_key(field): field for field in fields}
+    normalized = {}
+    aliased = []
+    for key, value in data.items():
+        value = "" if value is None else value
+        if _key(key) in canonical:
+            normalized[canonical[_key(key)]] = value
+        elif KEY_ALIASES.get(_key(key)) in fields:
+            aliased.append((KEY_ALIASES[_key(key)], value))
+        else:
+            normalized[key] = value
+    for field, value in aliased:
+        normalized.setdefault(field, value)
+    return normalized  # dict: Data keyed by canonical names where recognised.
+
+
+# Scans a complete reply and returns every top-level value as raw text (plus a repaired cut-off value).
+def scan_values(raw_text):
+
+    scanner = JsonStreamScanner()
+    scanner.feed(strip_fences(raw_text or ""))
+    truncated = scanner.truncated_value()
+    return scanner.values + ([truncated] if truncated else [])  # list: Raw JSON texts in reply order.
+
+
+# The invoice object in a reply: the first decodable object holding any canonical field (a single
+# wrapper key such as {"invoice": {...}} is unwrapped), else the first decodable object.
+def parse_object(raw_text, fields):  # raw_text (str): The reply.  fields (list): Canonical field names.
+
+    canonical = {_key(field) for field in fields} | set(KEY_ALIASES)
+    fallback = None
+    for text in scan_values(raw_text):
+        value = loads_tolerant(text)
+        if isinstance(value, dict) and len(value) == 1 and isinstance(next(iter(value.values())), dict):
+            value = next(iter(value.values()))
+        if not isinstance(value, dict):
+            continue
+        if any(_key(key) in canonical for key in value):
+            return normalize_keys(value, fields)
+        fallback = fallback or value
+    if fallback is None:
+        logging.error("No JSON object could be recovered from the model response.")
+        return None
+    return normalize_keys(fallback, fields)  # dict or None: The decoded fields.
+
+
+# The list of objects in a batched reply: the first decodable array, or else every top-level object.
+def parse_array(raw_text):  # raw_text (str): The reply.
+
+    objects = []
+    for text in scan_values(raw_text):
+        value = loads_tolerant(text)
+        if isinstance(value, list):
+            return value
+        if isinstance(value, dict):
+            objects.append(value)
+    return objects or None  # list or None: Decoded objects.
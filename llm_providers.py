@@ -0,0 +1,306 @@
+# LLM providers behind one interface, so the GPT pipeline and the Gemini experiment share request
+# building, model/client reuse and async batching. Requests are chat-completions payloads
+# ({"messages": [...], "max_tokens": ..., "temperature": ...}); each provider translates them.
+import os
+import io
+import re
+import json
+import time
+import base64
+import asyncio
+import logging
+import threading
+from api_client import client_from_env
+from text_backends import PAGE_SCANNED, PAGE_TEXT, get_backend
+from stage_metrics import COMPLETION_TOKENS, LLM_REQUEST, PROMPT_TOKENS, observe
+
+###########################################################################
+# 1. Configuration
+
+
+DEFAULT_PROVIDER = 'azure'
+DEFAULT_GEMINI_MODEL = 'gemini-1.5-pro'
+IMAGE_DPI = 150  # scanned pages sent as images; enough for the model to read invoice print
+DATA_URL = re.compile(r'^data:([\w/+.-]+);base64,(.*)$', re.DOTALL)
+BATCH_MARKER = re.compile(r'=== INVOICE (\S+) START ===')  # see prompt_batching.INVOICE_BLOCK
+
+_providers = {}
+_providers_lock = threading.Lock()
+_loop_lock = threading.Lock()
+
+
+# Provider used when none is named (LLM_PROVIDER), read lazily so a .env loaded after import still applies.
+def provider_name():
+
+    return os.getenv("LLM_PROVIDER", DEFAULT_PROVIDER).lower()  # str: 'azure', 'gemini' or 'fake'.
+
+
+# Requests sent concurrently by complete_many when no limit is given.
+def default_concurrency():
+
+    return int(os.getenv("LLM_MAX_IN_FLIGHT", os.getenv("API_MAX_IN_FLIGHT", 4)))  # int: Concurrent requests.
+
+
+
+###################################################################
+# 2.  Request Building
+
+# Encodes a PIL image as an image_url content part (a PNG data URL).
+def image_part(image):  # image (PIL.Image): A rendered page or uploaded picture.
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return {"type": "image_url", "image_url": {"url": "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")}}
+
+
+# Content parts for a PDF, one kind per page type: text pages send their text layer only, scanned pages
+# their image only (no OCR, the model reads it), and mixed pages both. Pages are rendered one at a time.
+def document_parts(pdf_bytes, backend=None, dpi=IMAGE_DPI):  # pdf_bytes (bytes): The PDF content.  backend (TextBackend): Defaults to get_backend().
+
+    backend = backend or get_backend()
+    doc = backend.open(pdf_bytes)
+    parts = []
+    try:
+        for page_number in range(1, backend.page_count(doc) + 1):
+            text, kind = backend.page_text(doc, page_number)
+            if kind != PAGE_SCANNED and text.strip():
+                parts.append({"type": "text", "text": text})
+            if kind != PAGE_TEXT:
+                image = backend.render_pages(doc, [page_number], dpi=dpi)[0]
+                if image is not None:
+                    parts.append(image_part(image))
+                del image
+    finally:
+        backend.close(doc)
+    return parts  # list: Chat-completions content parts in page order.
+
+
+# Builds a chat-completions payload from a prompt and optional content parts (text and images).
+def chat_payload(prompt, parts=None, system=None, **params):  # prompt (str): The instructions.  parts (list): Content parts, e.g. from document_parts.  params: max_tokens, temperature, ...
+
+    messages = [{"role": "system", "content": system}] if system else []
+    content = [{"type": "text", "text": prompt}] + list(parts) if parts else prompt
+    messages.append({"role": "user", "content": content})
+    return {"messages": messages, **params}  # dict: The request body.
+
+
+
+###################################################################
+# 3.  Providers
+
+# Interface every provider implements. complete() returns the reply text, or None on failure.
+class LLMProvider:
+
+    name = None
+    _loop = None       # event loop running on a daemon thread, shared by every complete_many call
+    _loop_pid = None
+
+    # What identifies the provider's replies in the response cache (endpoint or model name).
+    @property
+    def identity(self):
+        return self.name
+
+    def complete(self, payload, stream=False, on_delta=None):  # payload (dict): Chat-completions body.  on_delta (callable): Streaming only; called with each delta (None on a restart), return True to stop reading.
+        raise NotImplementedError
+
+    # Async variant; providers without a native async client run complete() on a worker thread.
+    async def acomplete(self, payload):
+        return await asyncio.to_thread(self.complete, payload)
+
+    async def _complete_many(self, payloads, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(payload):
+            async with semaphore:
+                try:
+                    return await self.acomplete(payload)
+                except Exception as e:
+                    logging.error(f"{self.name} request failed: {e}")
+                    return None
+
+        return await asyncio.gather(*(one(payload) for payload in payloads))
+
+    # The provider's long-lived event loop. Async clients (Gemini's models) are bound to the loop they were
+    # first used on, so every batch runs on this one instead of a fresh asyncio.run loop. A forked child
+    # starts its own, as the parent's loop thread does not exist there.
+    def _event_loop(self):
+        with _loop_lock:
+            if self._loop is None or self._loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name=f"{self.name}-llm-loop", daemon=True).start()
+                self._loop, self._loop_pid = loop, os.getpid()
+            return self._loop
+
+    # Sends many requests concurrently (at most `concurrency` at once) and returns the replies in input order.
+    def complete_many(self, payloads, concurrency=None):  # payloads (list): Chat-completions bodies.
+
+        future = asyncio.run_coroutine_threadsafe(self._complete_many(payloads, concurrency or default_concurrency()), self._event_loop())
+        return list(future.result())  # list: Reply text or None per payload.
+
+
+# Azure OpenAI chat completions through the shared keep-alive client (rate limiting, retries, streaming).
+class AzureOpenAIProvider(LLMProvider):
+
+    name = 'azure'
+
+    def __init__(self, client=None):  # client (ChatCompletionClient): Defaults to one built from GPT4V_ENDPOINT / GPT4V_KEY.
+        self.client = client or client_from_env(os.getenv("GPT4V_ENDPOINT"), os.getenv("GPT4V_KEY"))
+
+    @property
+    def identity(self):
+        return self.client.endpoint
+
+    def complete(self, payload, stream=False, on_delta=None):
+        return self.client.complete(payload, stream=stream, on_delta=on_delta)
+
+
+# Google Gemini. One GenerativeModel per system instruction is created and reused; async batches use
+# the SDK's native generate_content_async.
+class GeminiProvider(LLMProvider):
+
+    name = 'gemini'
+
+    def __init__(self, model_name=None, api_key=None):
+        import google.generativeai as genai  # optional dependency, only needed for this provider
+        self._genai = genai
+        genai.configure(api_key=api_key or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY"))
+        self.model_name = model_name or os.getenv("GEMINI_MODEL", DEFAULT_GEMINI_MODEL)
+        self._models = {}
+        self._lock = threading.Lock()
+
+    @property
+    def identity(self):
+        return self.model_name
+
+    def _model(self, system):
+        with self._lock:
+            if system not in self._models:
+                self._models[system] = self._genai.GenerativeModel(self.model_name, system_instruction=system)
+            return self._models[system]
+
+    # Translates a chat-completions payload into (model, contents, generation config).
+    def _request(self, payload):
+        system, contents = None, []
+        for message in payload.get("messages", []):
+            content = message.get("content")
+            if message.get("role") == "system":
+                system = content
+                continue
+            for part in (content if isinstance(content, list) else [{"type": "text", "text": content}]):
+                if part.get("type") == "image_url":
+                    mime_type, data = DATA_URL.match(part["image_url"]["url"]).groups()
+                    contents.append({"mime_type": mime_type, "data": base64.b64decode(data)})
+                else:
+                    contents.append(part.get("text", ""))
+        config = {}
+        if "max_tokens" in payload:
+            config["max_output_tokens"] = payload["max_tokens"]
+        if "temperature" in payload:
+            config["temperature"] = payload["temperature"]
+        return self._model(system), contents, config
+
+    def _observe(self, response, started):
+        observe(LLM_REQUEST, time.perf_counter() - started)
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            observe(PROMPT_TOKENS, usage.prompt_token_count)
+            observe(COMPLETION_TOKENS, usage.candidates_token_count)
+
+    def complete(self, payload, stream=False, on_delta=None):
+        model, contents, config = self._request(payload)
+        started = time.perf_counter()
+        try:
+            response = model.generate_content(contents, generation_config=config, stream=stream)
+            if not stream:
+                self._observe(response, started)
+                return response.text
+            parts = []
+            if on_delta:
+                on_delta(None)
+            for chunk in response:
+                parts.append(chunk.text)
+                if on_delta and on_delta(chunk.text):
+                    break
+            observe(LLM_REQUEST, time.perf_counter() - started)
+            return "".join(parts)
+        except Exception as e:
+            logging.error(f"Gemini request failed: {e}")
+            return None     # str or None: The reply text if successful; otherwise, None.
+
+    async def acomplete(self, payload):
+        model, contents, config = self._request(payload)
+        started = time.perf_counter()
+        response = await model.generate_content_async(contents, generation_config=config)
+        self._observe(response, started)
+        return response.text
+
+
+# Offline stand-in for tests and demos: records every payload and answers with a fixed reply.
+# The default reply is an empty JSON object, or an array with one {"invoice_id": ...} per batched invoice.
+class FakeProvider(LLMProvider):
+
+    name = 'fake'
+
+    def __init__(self, reply=None, latency=0.0):  # reply (str, dict or callable): Reply text, an object to serialise, or reply(payload) -> str.  latency (float): Seconds per request.
+        self.reply = reply
+        self.latency = latency
+        self.payloads = []
+        self._lock = threading.Lock()
+
+    def _reply(self, payload):
+        if callable(self.reply):
+            return self.reply(payload)
+        if isinstance(self.reply, str):
+            return self.reply
+        prompt = json.dumps(payload.get("messages", []))
+        invoice_ids = BATCH_MARKER.findall(prompt)
+        if invoice_ids:
+            return json.dumps([dict(self.reply or {}, invoice_id=invoice_id) for invoice_id in invoice_ids])
+        return json.dumps(self.reply or {})
+
+    def complete(self, payload, stream=False, on_delta=None):
+        with self._lock:
+            self.payloads.append(payload)
+        if self.latency:
+            time.sleep(self.latency)
+        content = self._reply(payload)
+        if stream and on_delta:
+            on_delta(None)
+            for start in range(0, len(content), 16):
+                if on_delta(content[start:start + 16]):
+                    break
+        return content
+
+    async def acomplete(self, payload):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        with self._lock:
+            self.payloads.append(payload)
+        return self._reply(payload)
+
+
+PROVIDERS = {
+    AzureOpenAIProvider.name: AzureOpenAIProvider,
+    GeminiProvider.name: GeminiProvider,
+    FakeProvider.name: FakeProvider,
+}
+
+
+# Returns the process-wide provider instance for a name (default LLM_PROVIDER), creating it on first use
+# so clients and models are reused across calls.
+def get_provider(name=None):  # name (str): 'azure', 'gemini' or 'fake'.
+
+    name = (name or provider_name()).lower()
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider '{name}'. Choose from: {', '.join(PROVIDERS)}.")
+    with _providers_lock:
+        if name not in _providers:
+            _providers[name] = PROVIDERS[name]()
+        return _providers[name]  # LLMProvider: The shared provider.
+
+
+# Replaces the shared instance for a provider's name, e.g. a FakeProvider with a custom reply in tests.
+def set_provider(provider):  # provider (LLMProvider): The instance to use.
+
+    with _providers_lock:
+        _providers[provider.name] = provider
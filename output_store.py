@@ -0,0 +1,315 @@
+# Typed, append-only store for extracted invoices (SQLite). Amounts and rates are stored as numbers and
+# dates as ISO dates, so a store that grows across runs can be filtered and summed in SQL. Line items go to
+# a child table linked to their invoice row. Values that do not parse are kept as text in 'Raw Values'.
+# Excel, CSV and Parquet files are produced from it only when an export is requested.
+import os
+import io
+import re
+import json
+import time
+import uuid
+import sqlite3
+import logging
+from contextlib import contextmanager
+import pandas as pd
+from invoice_core import INVOICE_FIELDS
+from invoice_validation import RULES, RATE_PATTERN, parse_amounts, parse_dates, parse_rates
+
+###########################################################################
+# 1. Configuration
+
+
+DEFAULT_STORE_PATH = "extracted_invoices.sqlite"
+TABLE = "invoices"
+ITEMS_TABLE = "line_items"
+
+AMOUNT_FIELDS = [field for field, (kind, _) in RULES.items() if kind == 'amount']
+RATE_FIELDS = [field for field, (kind, pattern) in RULES.items() if pattern == RATE_PATTERN]
+DATE_FIELDS = [field for field, (kind, _) in RULES.items() if kind == 'date']
+
+# Columns stored alongside the fields: display name -> SQL type
+META_COLUMNS = {
+    'File': 'TEXT',
+    'Document Hash': 'TEXT',
+    'Confidence': 'TEXT',
+    'Trust': 'TEXT',
+    'Reconciled': 'INTEGER',
+    'Reconciliation Issues': 'TEXT',
+    'Line Items Total': 'REAL',
+    'Line Items Match': 'INTEGER',
+    'Raw Values': 'TEXT',  # JSON {field: extracted text} for values that did not parse as their type
+}
+
+# Line item columns (see line_items.line_items_frame): display name -> SQL type
+ITEM_COLUMNS = {
+    'Line': 'TEXT',
+    'Description': 'TEXT',
+    'HSN': 'TEXT',
+    'Quantity': 'REAL',
+    'Unit': 'TEXT',
+    'Rate': 'REAL',
+    'Amount': 'REAL',
+    'Consistent': 'INTEGER',
+}
+
+EXPORT_FORMATS = {
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    'csv': "text/csv",
+    'parquet': "application/octet-stream",
+}
+
+
+# SQL column name for a display name: "Invoice No." -> invoice_no, "GSTIN Supplier" -> gstin_supplier.
+def column_name(field):
+
+    return re.sub(r'[^0-9a-z]+', '_', field.lower()).strip('_')
+
+
+# SQL type of a field column.
+def column_type(field):
+
+    if field in AMOUNT_FIELDS or field in RATE_FIELDS:
+        return 'REAL'
+    if field in DATE_FIELDS:
+        return 'DATE'  # ISO YYYY-MM-DD text, which sorts and compares as a date
+    return 'TEXT'
+
+
+STORED_COLUMNS = INVOICE_FIELDS + list(META_COLUMNS)
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {TABLE} (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    {", ".join(f"{column_name(field)} {column_type(field)}" for field in INVOICE_FIELDS)},
+    {", ".join(f"{column_name(column)} {sql_type}" for column, sql_type in META_COLUMNS.items())}
+);
+CREATE INDEX IF NOT EXISTS {TABLE}_invoice_no ON {TABLE} (invoice_no);
+CREATE INDEX IF NOT EXISTS {TABLE}_gstin_supplier ON {TABLE} (gstin_supplier, invoice_no);
+CREATE INDEX IF NOT EXISTS {TABLE}_gstin_recipient ON {TABLE} (gstin_recipient);
+CREATE INDEX IF NOT EXISTS {TABLE}_invoice_date ON {TABLE} (invoice_date);
+CREATE INDEX IF NOT EXISTS {TABLE}_document_hash ON {TABLE} (document_hash);
+CREATE INDEX IF NOT EXISTS {TABLE}_run ON {TABLE} (run_id);
+CREATE TABLE IF NOT EXISTS {ITEMS_TABLE} (
+    id INTEGER PRIMARY KEY,
+    invoice_id INTEGER NOT NULL REFERENCES {TABLE} (id),
+    {", ".join(f"{column_name(column)} {sql_type}" for column, sql_type in ITEM_COLUMNS.items())}
+);
+CREATE INDEX IF NOT EXISTS {ITEMS_TABLE}_invoice ON {ITEMS_TABLE} (invoice_id);
+CREATE INDEX IF NOT EXISTS {ITEMS_TABLE}_hsn ON {ITEMS_TABLE} (hsn);
+'''
+
+
+
+###################################################################
+# 2.  Typed Columns
+
+# Converts extracted string fields to typed columns: amounts and rates to floats ("15,000.00" -> 15000.0,
+# "9%" -> 9.0), dates to datetimes, everything else to stripped strings. Unparseable values become missing
+# in their typed column and are kept, as extracted, in the 'Raw Values' JSON column.
+def typed_frame(df):  # df (pd.DataFrame): Rows keyed by INVOICE_FIELDS (and optionally META_COLUMNS).
+
+    typed = pd.DataFrame(index=df.index)
+    unparsed = {}
+    for field in INVOICE_FIELDS:
+        values = df[field] if field in df else pd.Series("", index=df.index)
+        text = values.fillna("").astype(str).str.strip()
+        if field in AMOUNT_FIELDS:
+            typed[field] = parse_amounts(values)
+        elif field in RATE_FIELDS:
+            typed[field] = parse_rates(values)
+        elif field in DATE_FIELDS:
+            typed[field] = parse_dates(values)
+        else:
+            typed[field] = text
+            continue
+        failed = (text != "") & typed[field].isna()
+        if failed.any():
+            unparsed[field] = text[failed].to_dict()  # index -> value as extracted
+    raw = [{field: values[index] for field, values in unparsed.items() if index in values} for index in df.index]
+    typed['Raw Values'] = [json.dumps(values, ensure_ascii=False) if values else None for values in raw]
+    for column in META_COLUMNS:
+        if column in df:
+            typed[column] = df[column].astype(bool) if column == 'Reconciled' else df[column]
+    return typed  # pd.DataFrame: Typed columns in STORED_COLUMNS order.
+
+
+# Python values for one SQLite row: NaN/NaT become NULL, dates ISO strings, booleans integers.
+def _sql_values(typed):
+
+    columns = []
+    for column in STORED_COLUMNS:
+        if column not in typed:
+            columns.append([None] * len(typed))
+        elif column in DATE_FIELDS:
+            columns.append([value.date().isoformat() if not pd.isna(value) else None for value in typed[column]])
+        elif column == 'Reconciled':
+            columns.append([int(value) for value in typed[column]])
+        else:
+            columns.append([None if pd.isna(value) else value for value in typed[column].astype(object)])
+    return list(zip(*columns))
+
+
+# Python values for the line item rows, each led by the id of its invoice row.
+def _item_values(items, invoice_ids):  # items (pd.DataFrame): From line_items_frame.  invoice_ids (list): Stored id per invoice position.
+
+    columns = [[invoice_ids[row] for row in items['row']]]
+    for column in ITEM_COLUMNS:
+        values = items[column].astype(object) if column in items else [None] * len(items)
+        columns.append([None if pd.isna(value) else (int(value) if column == 'Consistent' else value) for value in values])
+    return list(zip(*columns))
+
+
+# Subquery selecting the latest row id of each of `count` document hashes.
+def _latest_ids_sql(count):
+
+    return f"SELECT MAX(id) FROM {TABLE} WHERE document_hash IN ({', '.join('?' * count)}) GROUP BY document_hash"
+
+
+
+###################################################################
+# 3.  Store
+
+class InvoiceStore:
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("OUTPUT_STORE_PATH", DEFAULT_STORE_PATH)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            self._add_missing_columns(conn)
+
+    # Stores created before a column was added to META_COLUMNS get it as an empty column.
+    @staticmethod
+    def _add_missing_columns(conn):
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE})")}
+        for column, sql_type in META_COLUMNS.items():
+            if column_name(column) not in existing:
+                conn.execute(f"ALTER TABLE {TABLE} ADD COLUMN {column_name(column)} {sql_type}")
+
+    # Opens a short-lived connection that commits on success and is always closed.
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # Appends one run's rows (and their line items) in a single transaction and returns the run id. Files
+    # and hashes can be given separately or as 'File' / 'Document Hash' columns of df.
+    def append(self, df, files=None, doc_hashes=None, run_id=None, line_items=None):  # df (pd.DataFrame): Output rows (strings as extracted).  files (list): File name per row.  doc_hashes (list): Document hash per row.  line_items (pd.DataFrame): From line_items.line_items_frame, 'row' giving the position in df.
+
+        run_id = run_id or uuid.uuid4().hex
+        df = df.copy()
+        if files is not None:
+            df['File'] = list(files)
+        if doc_hashes is not None:
+            df['Document Hash'] = list(doc_hashes)
+        rows = _sql_values(typed_frame(df))
+        stored_at = time.time()
+        names = ["run_id", "stored_at"] + [column_name(column) for column in STORED_COLUMNS]
+        items = line_items if line_items is not None and len(line_items) else None
+        with self._connect() as conn:
+            sql = f"INSERT INTO {TABLE} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})"
+            if items is None:
+                conn.executemany(sql, [(run_id, stored_at) + row for row in rows])
+            else:
+                # Row ids are needed to link the items, so invoice rows are inserted one at a time
+                invoice_ids = [conn.execute(sql, (run_id, stored_at) + row).lastrowid for row in rows]
+                item_names = ["invoice_id"] + [column_name(column) for column in ITEM_COLUMNS]
+                conn.executemany(
+                    f"INSERT INTO {ITEMS_TABLE} ({', '.join(item_names)}) VALUES ({', '.join('?' * len(item_names))})",
+                    _item_values(items, invoice_ids),
+                )
+        logging.info(f"Stored {len(rows)} invoice(s) and {0 if items is None else len(items)} line item(s) in {self.path} (run {run_id}).")
+        return run_id  # str: Identifies the rows appended by this call.
+
+    # Rows as a typed DataFrame with display column names; where is an SQL condition on the SQL column names.
+    def query(self, where=None, params=(), limit=None):  # where (str): e.g. "gstin_supplier = ? AND invoice_date >= ?".
+
+        sql = f"SELECT {', '.join(column_name(column) for column in STORED_COLUMNS)} FROM {TABLE}"
+        if where:
+            sql += f" WHERE {where}"
+        sql += " ORDER BY id"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self._connect() as conn:
+            df = pd.read_sql_query(sql, conn, params=params)
+        df.columns = STORED_COLUMNS
+        for field in DATE_FIELDS:
+            df[field] = pd.to_datetime(df[field], errors='coerce')
+        df['Reconciled'] = df['Reconciled'].astype('boolean')
+        df['Line Items Match'] = df['Line Items Match'].astype('boolean')
+        return df  # pd.DataFrame: Matching rows in insertion order.
+
+    # Line items with the file and invoice number of their invoice, for one run, the latest rows of some
+    # documents (see latest) or the whole store.
+    def line_items(self, run_id=None, doc_hashes=None):  # run_id (str): Only this run's items.  doc_hashes (list): Only the items of these documents' latest rows.
+
+        sql = (f"SELECT i.file, i.invoice_no, {', '.join(f'li.{column_name(column)}' for column in ITEM_COLUMNS)}"
+               f" FROM {ITEMS_TABLE} li JOIN {TABLE} i ON i.id = li.invoice_id")
+        params = ()
+        if run_id:
+            sql += " WHERE i.run_id = ?"
+            params = (run_id,)
+        elif doc_hashes is not None:
+            sql += f" WHERE i.id IN ({_latest_ids_sql(len(doc_hashes))})"
+            params = tuple(doc_hashes)
+        sql += " ORDER BY li.id"
+        with self._connect() as conn:
+            df = pd.read_sql_query(sql, conn, params=params)
+        df.columns = ['File', 'Invoice No.'] + list(ITEM_COLUMNS)
+        df['Consistent'] = df['Consistent'].astype('boolean')
+        return df  # pd.DataFrame: One row per stored line item.
+
+    def run(self, run_id):
+        return self.query("run_id = ?", (run_id,))
+
+    # The most recently stored row of each document, e.g. the result a copy of it reused.
+    def latest(self, doc_hashes):  # doc_hashes (list): Document hashes.
+
+        return self.query(f"id IN ({_latest_ids_sql(len(doc_hashes))})", tuple(doc_hashes))  # pd.DataFrame: At most one row per hash.
+
+    def count(self):
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {TABLE}").fetchone()[0]
+
+    # Document hashes already stored, for resuming batch runs.
+    def doc_hashes(self):
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute(f"SELECT DISTINCT document_hash FROM {TABLE} WHERE document_hash IS NOT NULL")}
+
+    # Serialises rows (one run, or the whole store) to xlsx, csv or parquet bytes. Call it when the user
+    # asks for a download, not after every run. Excel files get the line items on a second sheet.
+    def export(self, fmt, run_id=None):  # fmt (str): 'xlsx', 'csv' or 'parquet'.  run_id (str): Only this run's rows.
+
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format '{fmt}'. Use {', '.join(EXPORT_FORMATS)}.")
+        df = self.run(run_id) if run_id else self.query()
+        if fmt == "csv":
+            return df.to_csv(index=False).encode("utf-8")
+        buffer = io.BytesIO()
+        if fmt == "xlsx":
+            items = self.line_items(run_id)
+            with pd.ExcelWriter(buffer) as writer:
+                df.to_excel(writer, sheet_name="Invoices", index=False)
+                if len(items):
+                    items.to_excel(writer, sheet_name="Line Items", index=False)
+        else:
+            df.to_parquet(buffer, index=False)
+        return buffer.getvalue()  # bytes: The exported file.
+
+
+_default_store = None
+
+
+# Shared store at OUTPUT_STORE_PATH.
+def get_default_store():
+
+    global _default_store
+    if _default_store is None:
+        _default_store = InvoiceStore()
+    return _default_store  # InvoiceStore: The process-wide store.
@@ -0,0 +1,138 @@
+# Packs several invoices into one chat-completion request to amortize the fixed prompt and round-trip.
+import os
+import re
+import json
+import logging
+from invoice_core import INVOICE_FIELDS, SYSTEM_MESSAGE, MODEL_PARAMS, call_openai_api
+from llm_providers import get_provider
+from llm_json import normalize_keys, parse_array
+
+###########################################################################
+# 1. Configuration
+
+
+BATCH_PROMPT_TEMPLATE = '''You are an expert and have best knowledge of invoices .Extract the following fields from EACH of the invoices below:
+{fields}
+
+Each invoice is enclosed between "=== INVOICE <id> START ===" and "=== INVOICE <id> END ===".
+
+**Provide the output strictly as a valid JSON array with exactly one object per invoice, in the same order as the invoices. Each object must have an "invoice_id" key holding the invoice's id, plus the field names above spelled exactly as listed. No additional text, explanations, or comments. Do not include any trailing commas or syntax errors.**
+
+{invoices}
+'''
+
+BATCH_ID_KEY = re.compile(r'^invoice[\s_-]?id$', re.IGNORECASE)  # "invoice_id", "Invoice ID", "invoiceId"
+
+INVOICE_BLOCK = '''=== INVOICE {invoice_id} START ===
+{text}
+=== INVOICE {invoice_id} END ===
+'''
+
+
+# Batch limits, read lazily so a .env loaded after import still applies.
+def batch_settings():
+
+    return {
+        'token_budget': int(os.getenv("API_BATCH_TOKEN_BUDGET", 6000)),   # prompt tokens per request
+        'max_invoices': int(os.getenv("API_BATCH_MAX_INVOICES", 8)),
+        'max_output_tokens': int(os.getenv("API_BATCH_MAX_OUTPUT_TOKENS", 4096)),
+    }  # dict: Batch packing limits.
+
+
+
+###################################################################
+# 2.  Functions
+
+# Rough token count (~4 characters per token); good enough for packing decisions.
+def estimate_tokens(text):
+
+    return len(text) // 4 + 1
+
+
+# Greedily groups (invoice_id, text) pairs into batches that fit the prompt token budget.
+# An invoice larger than the budget on its own still gets a batch of one.
+def pack_batches(items, token_budget, max_invoices):  # items (list): (invoice_id, text) pairs in input order.
+
+    overhead = estimate_tokens(BATCH_PROMPT_TEMPLATE) + len(INVOICE_FIELDS) * 4
+    batches, current, used = [], [], overhead
+    for invoice_id, text in items:
+        cost = estimate_tokens(text) + 20  # delimiters and id
+        if current and (used + cost > token_budget or len(current) >= max_invoices):
+            batches.append(current)
+            current, used = [], overhead
+        current.append((invoice_id, text))
+        used += cost
+    if current:
+        batches.append(current)
+    return batches  # list: Lists of (invoice_id, text) pairs.
+
+
+# Builds the request body for one batch.
+def build_batch_payload(batch, max_output_tokens):  # batch (list): (invoice_id, text) pairs.
+
+    fields = "\n".join(f"- {field}" for field in INVOICE_FIELDS)
+    invoices = "\n".join(INVOICE_BLOCK.format(invoice_id=invoice_id, text=text) for invoice_id, text in batch)
+    prompt = BATCH_PROMPT_TEMPLATE.format(fields=fields, invoices=invoices)
+    return {
+        "messages": [
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            {"role": "user", "content": prompt}
+        ],
+        **dict(MODEL_PARAMS, max_tokens=min(MODEL_PARAMS["max_tokens"] * len(batch), max_output_tokens)),
+    }
+
+
+# Splits a JSON-array reply into {invoice_id: object}. Returns None when nothing can be parsed.
+# A reply cut off mid-array still yields the invoices that were complete.
+def split_batch_response(raw_text, expected_ids):  # expected_ids (list): Ids sent in the batch, in order.
+
+    objects = parse_array(raw_text)
+    if objects is None:
+        logging.error("Batch response holds no JSON array or objects.")
+        return None
+
+    by_id = {}
+    unmatched = []
+    for position, obj in enumerate(objects):
+        if not isinstance(obj, dict):
+            continue
+        # The id is taken out before normalizing, so no field alias can claim it
+        id_keys = [key for key in obj if BATCH_ID_KEY.match(str(key).strip())]
+        invoice_id = str(obj.pop(id_keys[0], "")).strip() if id_keys else ""
+        obj = normalize_keys(obj, INVOICE_FIELDS)
+        if invoice_id in expected_ids and invoice_id not in by_id:
+            by_id[invoice_id] = obj
+        else:
+            unmatched.append((position, obj))
+    # Fall back to position only when the model dropped or mangled ids but kept one object per invoice
+    if len(objects) == len(expected_ids):
+        for position, obj in unmatched:
+            if expected_ids[position] not in by_id:
+                by_id[expected_ids[position]] = obj
+    return by_id  # dict: invoice_id -> field dict.
+
+
+# Extracts several invoices with one request. Invoices missing from the reply (or all of them, if
+# the array is malformed) are retried with individual call_openai_api calls.
+def call_openai_api_batch(batch, max_output_tokens=None):  # batch (list): (invoice_id, text) pairs.
+
+    max_output_tokens = max_output_tokens or batch_settings()['max_output_tokens']
+    expected_ids = [invoice_id for invoice_id, _ in batch]
+    by_id = None
+    if len(batch) > 1:
+        try:
+            raw_text = get_provider().complete(build_batch_payload(batch, max_output_tokens))
+            by_id = split_batch_response(raw_text, expected_ids)
+        except Exception as e:
+            logging.error(f"Exception during batched API call: {e}")
+    by_id = by_id or {}
+
+    responses = {}
+    for invoice_id, text in batch:
+        if invoice_id in by_id:
+            responses[invoice_id] = json.dumps(by_id[invoice_id], ensure_ascii=False)
+        else:
+            if len(batch) > 1:
+                logging.warning(f"Invoice {invoice_id} missing from batch response; calling the API for it alone.")
+            responses[invoice_id] = call_openai_api(text)
+    return responses  # dict: invoice_id -> raw JSON text (or None if the per-invoice call failed too).
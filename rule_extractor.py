@@ -0,0 +1,199 @@
+# Local, deterministic field extraction that runs before the LLM. Known suppliers (looked up by the
+# supplier GSTIN on the page, never the recipient's) get their template's patterns and fixed values; everything else goes through
+# generic label-anchored patterns. The API is only called when a required field is missing or invalid.
+import os
+import re
+import json
+import logging
+from invoice_core import INVOICE_FIELDS
+from invoice_validation import GSTIN_CHARSET, RECONCILE_TOLERANCE, gstin_checksum_ok_scalar, validate_value
+
+###########################################################################
+# 1. Configuration
+
+
+DEFAULT_TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "supplier_templates.json")
+
+# Fields that must be found (and pass validation) before the LLM can be skipped
+DEFAULT_REQUIRED_FIELDS = ['Invoice No.', 'Invoice Date', 'Taxable Value', 'Tax Amount', 'Final Amount', 'GSTIN Supplier']
+
+AMOUNT = r'(?:₹|Rs\.?|INR)?\s*(\d{1,3}(?:,\d{2,3})+(?:\.\d+)?|\d+\.\d{2})'
+RATE = r'(\d{1,2}(?:\.\d+)?\s*%)'
+DATE = r'(\d{1,2}[/.\-](?:\d{1,2}|[A-Za-z]{3})[/.\-]\d{2,4}|\d{4}-\d{2}-\d{2})'
+GSTIN = r'\b(\d{2}[A-Z]{5}\d{4}[A-Z][A-Z0-9]Z[A-Z0-9])\b'
+SEP = r'\s*[:\-]?\s*'
+
+# field -> (pattern, occurrence); the first capture group is the value. 'last' is used for totals,
+# which follow the line items.
+GENERIC_PATTERNS = {
+    'Invoice No.': (r'invoice\s*(?:no|number|#)\.?' + SEP + r'([A-Za-z0-9][A-Za-z0-9\-/]*)', 'first'),
+    'Invoice Date': (r'invoice\s*date' + SEP + DATE, 'first'),
+    'Date': (r'\bdated?\b' + SEP + DATE, 'first'),
+    'Email': (r'([\w\.-]+@[\w\.-]+\.\w+)', 'first'),
+    'Quantity': (r'\b(?:total\s+)?(?:qty|quantity)\b' + SEP + r'(\d+(?:\.\d+)?)', 'first'),
+    'Taxable Value': (r'taxable\s*(?:value|amount)' + SEP + AMOUNT, 'last'),
+    'SGST Rate': (r'\bsgst\b\s*@?\s*' + RATE, 'first'),
+    'CGST Rate': (r'\bcgst\b\s*@?\s*' + RATE, 'first'),
+    'IGST Rate': (r'\bigst\b\s*@?\s*' + RATE, 'first'),
+    'SGST Amount': (r'\bsgst\b[^\n]*?' + AMOUNT + r'\s*$', 'last'),
+    'CGST Amount': (r'\bcgst\b[^\n]*?' + AMOUNT + r'\s*$', 'last'),
+    'IGST Amount': (r'\bigst\b[^\n]*?' + AMOUNT + r'\s*$', 'last'),
+    'Tax Amount': (r'total\s*tax(?:\s*amount)?' + SEP + AMOUNT, 'last'),
+    'Final Amount': (r'(?:grand\s+total|final\s+amount|total\s+amount|invoice\s+total|amount\s+payable|total)' + SEP + AMOUNT, 'last'),
+    'Place of Supply': (r'place\s+of\s+supply' + SEP + r'([^\n]+?)\s*$', 'first'),
+}
+COMPILED_PATTERNS = {field: (re.compile(pattern, re.IGNORECASE | re.MULTILINE), occurrence) for field, (pattern, occurrence) in GENERIC_PATTERNS.items()}
+
+GSTIN_RE = re.compile(GSTIN)
+RECIPIENT_LABEL = re.compile(r'bill(?:ed)?\s+to|buyer|recipient|consignee|ship(?:ped)?\s+to', re.IGNORECASE)
+
+_templates = {}  # path -> (mtime, templates)
+
+
+# Rule extraction switch, read lazily so a .env loaded after import still applies.
+def rules_enabled():
+
+    return os.getenv("RULE_EXTRACTOR", "1").lower() in ("1", "true", "yes")  # bool: Whether rules run before the LLM.
+
+
+
+###################################################################
+# 2.  Supplier Templates
+
+# Loads supplier templates (GSTIN -> template) from JSON, recompiling only when the file changes.
+# A template may hold 'patterns' (field -> regex with one group), 'constants' (field -> fixed value)
+# and 'required' (fields that must be found for this supplier; the supplier GSTIN always is).
+def load_templates(path=None):  # path (str): Defaults to SUPPLIER_TEMPLATES_PATH or supplier_templates.json.
+
+    path = path or os.getenv("SUPPLIER_TEMPLATES_PATH", DEFAULT_TEMPLATES_PATH)
+    if not os.path.exists(path):
+        return {}
+    mtime = os.path.getmtime(path)
+    if path not in _templates or _templates[path][0] != mtime:
+        with open(path, encoding="utf-8") as f:
+            raw = json.load(f)
+        templates = {}
+        for gstin, template in raw.items():
+            templates[gstin.upper()] = {
+                'name': template.get('name', gstin),
+                'patterns': {field: re.compile(pattern, re.IGNORECASE | re.MULTILINE) for field, pattern in template.get('patterns', {}).items()},
+                'constants': dict(template.get('constants', {}), **{'GSTIN Supplier': gstin.upper()}),
+                'required': list(dict.fromkeys(template.get('required', DEFAULT_REQUIRED_FIELDS) + ['GSTIN Supplier'])),
+            }
+        _templates[path] = (mtime, templates)
+        logging.info(f"Loaded {len(templates)} supplier template(s) from {path}.")
+    return _templates[path][1]  # dict: GSTIN -> compiled template.
+
+
+
+###################################################################
+# 3.  Extraction
+
+def _search(pattern, occurrence, text):
+
+    matches = list(pattern.finditer(text)) if occurrence == 'last' else [pattern.search(text)]
+    match = matches[-1] if matches and matches[-1] else None
+    return match.group(1).strip() if match else ""
+
+
+# GSTINs on the page in reading order, keeping only those with a valid check digit.
+def find_gstins(text):
+
+    seen = []
+    for gstin in GSTIN_RE.findall(text):
+        if gstin not in seen and all(char in GSTIN_CHARSET for char in gstin) and gstin_checksum_ok_scalar(gstin):
+            seen.append(gstin)
+    return seen  # list: Unique valid GSTINs.
+
+
+# Supplier and recipient GSTINs: a GSTIN on a bill-to/buyer line (or the line after it) is the recipient,
+# the first other GSTIN is the supplier.
+def split_gstins(text, gstins):
+
+    recipient = ""
+    lines = text.splitlines()
+    for position, line in enumerate(lines):
+        if RECIPIENT_LABEL.search(line):
+            window = " ".join(lines[position:position + 3])
+            found = [gstin for gstin in gstins if gstin in window]
+            if found:
+                recipient = found[0]
+                break
+    others = [gstin for gstin in gstins if gstin != recipient]
+    return (others[0] if others else ""), recipient  # tuple: (supplier GSTIN, recipient GSTIN).
+
+
+def _amount(value):
+
+    try:
+        return float(re.sub(r'[^\d.]', '', value)) if value else None
+    except ValueError:
+        return None
+
+
+# Fills fields that follow from others: the tax total from its components, the tax rate from the
+# component rates, and the date from the invoice date.
+def derive_fields(data):
+
+    components = [_amount(data.get(field)) for field in ('SGST Amount', 'CGST Amount', 'IGST Amount')]
+    if not data.get('Tax Amount') and any(value is not None for value in components):
+        data['Tax Amount'] = f"{sum(value or 0 for value in components):,.2f}"
+    if not data.get('Tax Rate'):
+        rates = [_amount(data.get(field)) for field in ('SGST Rate', 'CGST Rate', 'IGST Rate')]
+        if any(rate is not None for rate in rates):
+            data['Tax Rate'] = f"{sum(rate or 0 for rate in rates):g}%"
+    if not data.get('Date') and data.get('Invoice Date'):
+        data['Date'] = data['Invoice Date']
+    if not data.get('Invoice Date') and data.get('Date'):
+        data['Invoice Date'] = data['Date']
+    if not data.get('Total') and data.get('Final Amount'):
+        data['Total'] = data['Final Amount']
+    return data
+
+
+# Extracts every field the rules can find. Returns (data, template name or None, required fields).
+def rule_extract(text, templates=None):  # text (str): Extracted invoice text.  templates (dict): Defaults to load_templates().
+
+    templates = load_templates() if templates is None else templates
+    gstins = find_gstins(text)
+    supplier, recipient = split_gstins(text, gstins)
+    # Only the supplier picks the template: a known supplier billed as the recipient is someone else's invoice
+    template = templates.get(supplier) if supplier else None
+
+    data = {field: "" for field in INVOICE_FIELDS}
+    for field, (pattern, occurrence) in COMPILED_PATTERNS.items():
+        data[field] = _search(pattern, occurrence, text)
+    data['GSTIN Supplier'], data['GSTIN Recipient'] = supplier, recipient
+
+    if template:
+        # Template patterns and fixed values take precedence over the generic ones
+        for field, pattern in template['patterns'].items():
+            value = _search(pattern, 'first', text)
+            if value:
+                data[field] = value
+        data.update(template['constants'])
+
+    derive_fields(data)
+    required = template['required'] if template else DEFAULT_REQUIRED_FIELDS
+    return data, (template['name'] if template else None), required  # tuple: (field dict, template name, required fields).
+
+
+# Required fields that are missing or fail validation; an empty list means the LLM can be skipped.
+def missing_fields(data, required):
+
+    return [field for field in required if not data.get(field) or not validate_value(field, data[field])[0]]  # list: Field names.
+
+
+# Runs the rules and decides whether they are enough. Returns the data when they are, otherwise None.
+def try_rules(text, name=None):  # name (str): Used in the log line.
+
+    data, template_name, required = rule_extract(text)
+    missing = missing_fields(data, required)
+    taxable, tax, final = (_amount(data.get(field)) for field in ('Taxable Value', 'Tax Amount', 'Final Amount'))
+    if None not in (taxable, tax, final) and abs(taxable + tax - final) > RECONCILE_TOLERANCE:
+        missing.append('Final Amount (does not add up)')  # a wrong match somewhere; let the model read it
+    if missing:
+        logging.info(f"{name or 'document'}: rules missed {', '.join(missing)}; calling the API.")
+        return None
+    logging.info(f"{name or 'document'}: extracted locally ({template_name or 'generic rules'}); API call skipped.")
+    return data  # dict or None: Field values when every required field was found and valid.
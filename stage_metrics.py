@@ -0,0 +1,265 @@
+# Per-run stage metrics: latency/size histograms and counters, exported as JSON or Prometheus text,
+# plus an optional cProfile/pyinstrument hook for slow batches.
+# Work done in worker processes is captured there and merged into the run in the parent.
+import os
+import io
+import json
+import time
+import pstats
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+
+###########################################################################
+# 1. Configuration
+
+
+# Histogram buckets (upper bounds) for durations and for sizes such as token counts
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (10, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+METRIC_PREFIX = "invoice_"
+
+# Stage names used across the pipeline ("_seconds" histograms get duration buckets)
+PDF_PARSE = 'pdf_parse_seconds'              # text layer + page classification, per document
+RASTERIZE = 'rasterize_seconds'              # rendering pages for OCR, per document
+OCR_PAGE = 'ocr_page_seconds'                # per page
+TEXT_EXTRACTION = 'text_extraction_seconds'  # whole get_pdf_text step, per document
+COMPACTION = 'compaction_seconds'
+RULES = 'rules_seconds'
+LLM_REQUEST = 'llm_request_seconds'          # per successful API call, retries included
+PROMPT_TOKENS = 'prompt_tokens'
+COMPLETION_TOKENS = 'completion_tokens'
+JSON_PARSE = 'json_parse_seconds'
+VALIDATION_FRAME = 'validation_frame_seconds'  # column-wise validation of a run or a CLI flush
+RECONCILIATION = 'reconciliation_seconds'
+LINE_ITEMS = 'line_items_seconds'            # item table parsing, per document
+
+_local = threading.local()
+_current = None
+_current_lock = threading.Lock()
+
+
+
+###################################################################
+# 2.  Registry
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.samples = []
+
+    def observe(self, value):
+        self.samples.append(value)
+
+    def quantile(self, q):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self):
+        count = len(self.samples)
+        total = sum(self.samples)
+        return {
+            'count': count,
+            'sum': total,
+            'mean': total / count if count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': max(self.samples) if self.samples else 0.0,
+        }
+
+
+# Thread-safe histograms and counters for one run.
+class StageMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, value):  # name (str): Stage name, e.g. OCR_PAGE.  value (float): Seconds or size.
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(SECONDS_BUCKETS if name.endswith("_seconds") else SIZE_BUCKETS)
+            self.histograms[name].observe(value)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Times the with-block into the named histogram.
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    # Raw samples and counters, small enough to return from a worker process.
+    def export(self):
+        with self._lock:
+            return {'histograms': {name: list(histogram.samples) for name, histogram in self.histograms.items()},
+                    'counters': dict(self.counters)}
+
+    # Adds samples and counters exported by another registry (e.g. from a worker process).
+    def merge(self, exported):
+        for name, samples in exported.get('histograms', {}).items():
+            for value in samples:
+                self.observe(name, value)
+        for name, amount in exported.get('counters', {}).items():
+            self.count(name, amount)
+
+    # Summary per histogram plus counters.
+    def snapshot(self):
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'elapsed_seconds': time.time() - self.started_at,
+                'counters': dict(self.counters),
+                'stages': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+            }  # dict: JSON-serialisable metrics.
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    # Prometheus text exposition: one histogram family per stage, one counter per count.
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            for name, histogram in sorted(self.histograms.items()):
+                metric = METRIC_PREFIX + name
+                lines.append(f"# TYPE {metric} histogram")
+                for bound in histogram.buckets:
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {sum(1 for value in histogram.samples if value <= bound)}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {len(histogram.samples)}')
+                lines.append(f"{metric}_sum {sum(histogram.samples)}")
+                lines.append(f"{metric}_count {len(histogram.samples)}")
+            for name, amount in sorted(self.counters.items()):
+                metric = METRIC_PREFIX + name + "_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {amount}")
+        return "\n".join(lines) + "\n"
+
+    # Rows for a table: one per stage.
+    def table(self):
+        return [dict(stage=name, **summary) for name, summary in self.snapshot()['stages'].items()]
+
+
+
+###################################################################
+# 3.  Current Run
+
+# Starts a new run; later observations go to the returned registry.
+def start_run():
+
+    global _current
+    with _current_lock:
+        _current = StageMetrics()
+    return _current  # StageMetrics: The new run's registry.
+
+
+# The registry observations go to: a capture() in progress on this thread, else the current run.
+def get_metrics():
+
+    global _current
+    captured = getattr(_local, 'registry', None)
+    if captured is not None:
+        return captured
+    with _current_lock:
+        if _current is None:
+            _current = StageMetrics()
+        return _current  # StageMetrics: The active registry.
+
+
+def observe(name, value):
+
+    get_metrics().observe(name, value)
+
+
+def timer(name):
+
+    return get_metrics().timer(name)
+
+
+# Collects this thread's observations into a private registry, e.g. inside a worker process whose
+# results are merged by the parent with get_metrics().merge(registry.export()).
+@contextmanager
+def capture():
+
+    previous = getattr(_local, 'registry', None)
+    _local.registry = StageMetrics()
+    try:
+        yield _local.registry
+    finally:
+        _local.registry = previous
+
+
+
+###################################################################
+# 4.  Profiling
+
+# Profiler requested by EXTRACTION_PROFILE ('cprofile' or 'pyinstrument'), or None.
+def profiler_from_env():
+
+    return os.getenv("EXTRACTION_PROFILE") or None  # str or None: Profiler name.
+
+
+# Profiles the with-block when a profiler is named. cProfile writes a .prof file (open it with snakeviz
+# or pstats) and logs the top functions; pyinstrument writes an HTML report. Yields the report path.
+# cProfile also profiles threads started inside the block (the pipeline's API and reconciliation pools)
+# and merges them into one report; pyinstrument only sees the calling thread. Neither sees worker
+# processes, so text extraction and OCR in a process pool show up only as waiting.
+@contextmanager
+def profiling(profiler=None, output_path=None):  # profiler (str): 'cprofile', 'pyinstrument' or None for no profiling.
+
+    if not profiler:
+        yield None
+        return
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler  # optional dependency
+        output_path = output_path or f"extraction_profile_{stamp}.html"
+        session = Profiler()
+        session.start()
+        try:
+            yield output_path
+        finally:
+            session.stop()
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(session.output_html())
+            logging.info(f"pyinstrument report written to {output_path}.")
+        return
+    if profiler != "cprofile":
+        raise ValueError(f"Unknown profiler '{profiler}'. Use cprofile or pyinstrument.")
+
+    output_path = output_path or f"extraction_profile_{stamp}.prof"
+    thread_sessions = []
+
+    # Runs once in each new thread: its own profiler replaces this hook for the rest of the thread
+    def profile_thread(frame, event, arg):
+        thread_session = cProfile.Profile()
+        thread_sessions.append(thread_session)
+        thread_session.enable()
+
+    session = cProfile.Profile()
+    threading.setprofile(profile_thread)
+    session.enable()
+    try:
+        yield output_path
+    finally:
+        session.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(session)
+        for thread_session in list(thread_sessions):
+            stats.add(thread_session)
+        stats.dump_stats(output_path)
+        report = io.StringIO()
+        stats.stream = report
+        stats.sort_stats("cumulative").print_stats(25)
+        logging.info(f"cProfile stats written to {output_path} ({len(thread_sessions)} worker thread(s) included); top functions:\n{report.getvalue()}")
@@ -0,0 +1,61 @@
+import json
+
+from api_client import ChatCompletionClient
+
+
+class Response:
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.text = body
+        self.headers = {}
+        self.closed = False
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self.text.splitlines())
+
+    def close(self):
+        self.closed = True
+
+
+class Session:
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def post(self, endpoint, json=None, timeout=None, stream=False):
+        self.sent.append(json)
+        return self.responses.pop(0)
+
+
+def client(responses):
+    api = ChatCompletionClient("http://mock", "key", max_retries=2, backoff_base=0.0, backoff_max=0.0)
+    api.session = Session(responses)
+    return api
+
+
+def reply(content):
+    return Response(200, json.dumps({'choices': [{'message': {'content': content}}]}))
+
+
+def test_malformed_bodies_are_retried():
+    api = client([Response(200, ""), Response(200, '{"choices": []}'), reply("{}")])
+    assert api.complete({'messages': []}) == "{}"
+    assert api.metrics.snapshot()['retries'] == 2
+
+
+def test_malformed_bodies_fail_once_retries_run_out():
+    api = client([Response(200, "{}")] * 3)
+    assert api.complete({'messages': []}) is None
+    assert api.metrics.snapshot()['failures'] == 1
+
+
+def test_streamed_responses_are_closed_before_a_retry():
+    busy = Response(503, "busy")
+    api = client([busy, Response(200, 'data: {"choices": [{"delta": {"content": "{}"}}]}\ndata: [DONE]')])
+    assert api.complete({'messages': []}, stream=True) == "{}"
+    assert busy.closed
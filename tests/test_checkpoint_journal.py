@@ -0,0 +1,46 @@
+from checkpoint_journal import STAGE_DONE, STAGE_FAILED, STAGE_TEXT, CheckpointJournal
+
+
+def test_text_is_read_from_disk_not_kept_in_memory(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    with CheckpointJournal(path) as journal:
+        journal.write("h1", "a.pdf", STAGE_TEXT, text="Invoice ₹ text")
+        assert 'text' not in journal.states["h1"]
+        assert journal.state("h1")['text'] == "Invoice ₹ text"
+        journal.write("h1", "a.pdf", STAGE_DONE, raw_response="{}", data={'Invoice No.': "1"})
+        state = journal.state("h1")
+        assert (state['stage'], state['text'], state['raw_response'], state['data']) == (STAGE_DONE, "Invoice ₹ text", "{}", {'Invoice No.': "1"})
+        assert journal.is_done("h1")
+
+
+def test_replay_and_compact_keep_the_latest_state(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    with CheckpointJournal(path) as journal:
+        journal.write("h1", "a.pdf", STAGE_TEXT, text="first")
+        journal.write("h1", "a.pdf", STAGE_TEXT, text="second")
+        journal.write("h2", "b.pdf", STAGE_DONE, raw_response="{}", data={'x': 1})
+        journal.write("h2", "b.pdf", STAGE_FAILED, status='error', error="boom")
+
+    journal = CheckpointJournal(path)
+    assert journal.state("h1")['text'] == "second"
+    assert 'data' not in journal.state("h2") and journal.state("h2")['stage'] == STAGE_FAILED
+    journal.compact()
+    journal.write("h3", "c.pdf", STAGE_TEXT, text="third")
+    assert journal.state("h1")['text'] == "second"
+    assert journal.state("h3")['text'] == "third"
+    journal.close()
+    with open(path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 3
+
+
+def test_a_line_cut_off_by_a_crash_is_skipped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    with CheckpointJournal(str(path)) as journal:
+        journal.write("h1", "a.pdf", STAGE_TEXT, text="kept")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"doc_hash": "h2", "stage": "te')
+    with CheckpointJournal(str(path)) as journal:
+        assert "h2" not in journal.states
+        journal.write("h3", "c.pdf", STAGE_TEXT, text="after")
+    with CheckpointJournal(str(path)) as journal:
+        assert journal.state("h3")['text'] == "after"
@@ -0,0 +1,67 @@
+from duplicate_index import DUPLICATE_NEAR, DUPLICATE_SIMILAR, DuplicateIndex, business_key, same_invoice
+
+
+# An item table long enough that a few changed words move only a few SimHash bits
+ITEMS = "\n".join(f"{n} Item {n * 7} HSN 9983 {n} Nos 1,000.00 {n},000.00" for n in range(1, 30))
+
+
+def invoice_text(number, date, items=ITEMS):
+    return f"""TAX INVOICE
+Supplier: Example Traders Pvt Ltd, 12 MG Road, Pune
+GSTIN Supplier: 27AAPFU0939F1ZV
+Invoice No.: INV-{number}
+Invoice Date: {date}
+Bill To: Example Buyer LLP, Bengaluru
+GSTIN Recipient: 29AABCT1332L1ZA
+{items}
+Taxable Value: 28,000.00
+CGST @ 9%: 2,520.00
+SGST @ 9%: 2,520.00
+Final Amount: 33,040.00
+Goods once sold will not be taken back. Subject to Pune jurisdiction."""
+
+
+def fields(number, date):
+    return {'GSTIN Supplier': '27AAPFU0939F1ZV', 'Invoice No.': f'INV-{number}', 'Invoice Date': date, 'Final Amount': '33,040.00'}
+
+
+def test_business_key_normalises_spelling():
+    assert business_key(fields(1501, '01/01/2024')) == business_key({**fields(1501, '01/01/2024'), 'Invoice No.': 'inv 1501', 'Final Amount': '₹33040'})
+    assert business_key({'GSTIN Supplier': '27AAPFU0939F1ZV', 'Final Amount': '1.00'}) is None
+
+
+def test_same_invoice_needs_supplier_number_and_date():
+    text = invoice_text(1501, '01/01/2024')
+    assert same_invoice(fields(1501, '01-01-2024'), text)
+    assert not same_invoice(fields(1502, '01/01/2024'), text)
+    assert not same_invoice(fields(1501, '01/02/2024'), text)
+    assert not same_invoice({'Invoice No.': 'INV-1501'}, text)
+
+
+def test_rescan_is_a_near_copy(tmp_path):
+    index = DuplicateIndex(str(tmp_path / "index.sqlite"))
+    index.add("h1", "jan.pdf", invoice_text(1501, '01/01/2024'), "{}", fields(1501, '01/01/2024'))
+    rescan = invoice_text(1501, '01/01/2024').replace("Goods once sold", "Goods onee sold")
+    match = index.find_near(rescan, exclude_hash="h2")
+    assert match is not None and match['kind'] == DUPLICATE_NEAR and match['name'] == "jan.pdf"
+
+
+def test_next_months_invoice_is_only_similar(tmp_path):
+    index = DuplicateIndex(str(tmp_path / "index.sqlite"))
+    index.add("h1", "jan.pdf", invoice_text(1501, '01/01/2024'), "{}", fields(1501, '01/01/2024'))
+    match = index.find_near(invoice_text(1502, '01/02/2024'), exclude_hash="h2")
+    assert match is not None and match['kind'] == DUPLICATE_SIMILAR
+
+
+def test_unrelated_invoice_is_not_found(tmp_path):
+    index = DuplicateIndex(str(tmp_path / "index.sqlite"))
+    index.add("h1", "jan.pdf", invoice_text(1501, '01/01/2024'), "{}", fields(1501, '01/01/2024'))
+    other = invoice_text(9, '05/05/2024', items="1 Consulting services 998311 1 28,000.00 28,000.00")
+    assert index.find_near(other.replace("Example Traders", "Other Supplier"), exclude_hash="h2") is None
+
+
+def test_find_key_flags_a_different_file_with_the_same_invoice(tmp_path):
+    index = DuplicateIndex(str(tmp_path / "index.sqlite"))
+    index.add("h1", "jan.pdf", invoice_text(1501, '01/01/2024'), "{}", fields(1501, '01/01/2024'))
+    assert index.find_key(fields(1501, '01/01/2024'), exclude_hash="h2")['name'] == "jan.pdf"
+    assert index.find_key(fields(1501, '01/01/2024'), exclude_hash="h1") is None
@@ -0,0 +1,49 @@
+import fitz
+import pytest
+
+import duplicate_index
+import extraction_cache
+from invoice_cli import main
+from llm_providers import FakeProvider, set_provider
+from output_store import InvoiceStore
+
+
+def write_invoice(path, number):
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 100), "TAX INVOICE", fontsize=18)
+    page.insert_text((72, 140), f"Invoice No.: INV-{number}   Date: 16/07/2024   Supplier: Acme Traders", fontsize=11)
+    page.insert_text((72, 170), "Taxable Value: 1,000.00   Tax Amount: 180.00   Total: 1,180.00", fontsize=11)
+    doc.save(str(path))
+    doc.close()
+
+
+@pytest.fixture
+def invoices(tmp_path, monkeypatch):
+    for name, value in {'EXTRACTION_CACHE_PATH': "cache.sqlite", 'DUPLICATE_INDEX_PATH': "duplicates.sqlite",
+                        'LLM_PROVIDER': "fake", 'RULE_EXTRACTOR': "0", 'OCR_MAX_WORKERS': "1"}.items():
+        monkeypatch.setenv(name, str(tmp_path / value) if value.endswith(".sqlite") else value)
+    monkeypatch.setattr(extraction_cache, '_default_cache', None)
+    monkeypatch.setattr(duplicate_index, '_default_index', None)
+    set_provider(FakeProvider(reply={'Invoice No.': "INV-1", 'Final Amount': "1,180.00"}))
+    folder = tmp_path / "invoices"
+    folder.mkdir()
+    for number in (1, 2):
+        write_invoice(folder / f"{number}.pdf", number)
+    return folder
+
+
+def test_rerunning_into_a_store_does_not_duplicate_rows(invoices, tmp_path):
+    output = str(tmp_path / "out.sqlite")
+    log = str(tmp_path / "run.log")
+    assert main([str(invoices), "-o", output, "--log-file", log]) == 0
+    assert main([str(invoices), "-o", output, "--log-file", log]) == 0
+    assert InvoiceStore(output).count() == 2
+
+
+def test_a_new_csv_gets_every_file_including_copies(invoices, tmp_path):
+    log = str(tmp_path / "run.log")
+    assert main([str(invoices), "-o", str(tmp_path / "first.csv"), "--log-file", log]) == 0
+    assert main([str(invoices), "-o", str(tmp_path / "second.csv"), "--log-file", log]) == 0
+    with open(tmp_path / "second.csv", encoding="utf-8") as f:
+        assert len(f.readlines()) == 3
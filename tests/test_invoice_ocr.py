@@ -0,0 +1,64 @@
+import fitz
+
+import invoice_ocr
+from invoice_ocr import find_text_regions, ocr_image_regions, render_region
+from text_backends import PyMuPDFBackend
+
+
+def scanned_page_pdf():
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((72, 100), "TAX INVOICE", fontsize=18)
+    page.insert_text((72, 160), "Invoice No.: INV-1001   Date: 16/07/2024", fontsize=11)
+    page.insert_text((72, 700), "Total: 1,180.00", fontsize=11)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def first_pass(dpi=100):
+    backend = PyMuPDFBackend()
+    doc = backend.open(scanned_page_pdf())
+    try:
+        return backend.render_pages(doc, [1], dpi=dpi)[0], backend.page_source(doc, 1, dpi)
+    finally:
+        backend.close(doc)
+
+
+def test_regions_are_rerendered_at_the_high_dpi():
+    image, source = first_pass(dpi=100)
+    box = find_text_regions(image)[0]
+    region = render_region(source, box, 300)
+    assert abs(region.width - 3 * (box[2] - box[0])) <= 3
+    assert abs(region.height - 3 * (box[3] - box[1])) <= 3
+
+
+def test_low_confidence_regions_are_read_again_from_the_pdf(monkeypatch):
+    image, source = first_pass(dpi=100)
+    reads = []
+
+    def ocr(region):
+        reads.append(region.size)
+        return f"text {len(reads)}", (40.0 if len(reads) % 2 else 90.0)
+
+    monkeypatch.setattr(invoice_ocr, '_ocr_with_confidence', ocr)
+    monkeypatch.setenv("OCR_ROI_HIGH_DPI", "300")
+    text = ocr_image_regions(image, source)
+    regions = find_text_regions(image)
+    assert len(reads) == 2 * len(regions)  # every first read was low, so every region was re-rendered
+    assert reads[1][0] > 2 * reads[0][0]
+    assert text.splitlines() == [f"text {2 * n}" for n in range(1, len(regions) + 1)]
+
+
+def test_without_a_source_the_first_read_is_kept(monkeypatch):
+    image, _ = first_pass(dpi=100)
+    monkeypatch.setattr(invoice_ocr, '_ocr_with_confidence', lambda region: ("low", 10.0))
+    assert set(ocr_image_regions(image).splitlines()) == {"low"}
+
+
+def test_pools_are_shared_per_size_and_never_replaced(monkeypatch):
+    monkeypatch.setattr(invoice_ocr, '_pools', {})
+    monkeypatch.setattr(invoice_ocr, 'ProcessPoolExecutor', lambda max_workers: object())
+    two = invoice_ocr._get_pool(2)
+    assert invoice_ocr._get_pool(3) is not two
+    assert invoice_ocr._get_pool(2) is two
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+from invoice_validation import HIGH, LOW, MEDIUM, apply_validation, validate_frame, validate_value
+
+FIELDS = ['Invoice No.', 'Final Amount', 'Invoice Date', 'GSTIN Supplier', 'Address']
+
+
+def frame():
+    return pd.DataFrame({
+        'Invoice No.': ["INV-1", "INV 2", ""],
+        'Final Amount': ["₹ 2,00,000.50", "1,180.00", "12a"],
+        'Invoice Date': ["05/01/2024", "05-Jan-2024", "2024/01/05"],
+        'GSTIN Supplier': ["27AAPFU0939F1ZV", "27AAPFU0939F1ZX", "27aapfu0939f1zv"],
+        'Address': ["Pune", "", "  "],
+    })
+
+
+def test_validate_frame_matches_the_scalar_rules():
+    df = frame()
+    valid, confidence = validate_frame(df, FIELDS)
+    for position, row in df.iterrows():
+        for field in FIELDS:
+            assert (valid.at[position, field], confidence.at[position, field]) == validate_value(field, row[field])
+
+
+def test_validate_frame_labels():
+    valid, confidence = validate_frame(frame(), FIELDS)
+    assert valid.iloc[0].tolist() == [True, True, True, True, True]
+    assert confidence.iloc[0].tolist() == [HIGH, HIGH, HIGH, HIGH, MEDIUM]
+    assert valid.iloc[2].tolist() == [False, False, False, False, False]
+    assert confidence.at[1, 'GSTIN Supplier'] == LOW  # check digit
+
+
+def test_missing_columns_are_invalid():
+    valid, _ = validate_frame(pd.DataFrame({'Invoice No.': ["INV-1"]}), ['Invoice No.', 'Final Amount'])
+    assert valid.iloc[0].tolist() == [True, False]
+
+
+def test_apply_validation_adds_confidence_and_trust():
+    df, valid = apply_validation(frame(), FIELDS)
+    assert df['Trust'].tolist() == ["Trusted", "Untrusted", "Untrusted"]
+    assert df.at[0, 'Confidence'] == "; ".join([HIGH, HIGH, HIGH, HIGH, MEDIUM])
+    assert valid.shape == (3, len(FIELDS))
+
+
+def test_importing_the_cli_does_not_load_pandas():
+    code = "import sys, invoice_cli; print('pandas' in sys.modules)"
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=repo, capture_output=True, text=True, check=True)
+    assert result.stdout.splitlines()[-1] == "False"
@@ -0,0 +1,135 @@
+import os
+import time
+import uuid
+
+import fitz
+import pytest
+
+import duplicate_index
+import extraction_cache
+import job_queue
+import output_store
+from job_queue import DONE, QUEUED, JobQueue, run_job
+from llm_providers import FakeProvider, set_provider
+
+
+class Upload:
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def seek(self, offset):
+        pass
+
+    def read(self):
+        return self.data
+
+
+FILES = [Upload("a.pdf", b"%PDF-1.4 a"), Upload("b.pdf", b"%PDF-1.4 b")]
+
+
+@pytest.fixture
+def make_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(JobQueue, '_start', lambda self, job_id: None)  # no job processes in tests
+    return lambda: JobQueue(str(tmp_path / "jobs.sqlite"), str(tmp_path / "spool"))
+
+
+def test_the_same_files_reuse_the_active_job(make_queue):
+    queue = make_queue()
+    job_id = queue.submit(FILES)
+    assert queue.submit(list(reversed(FILES))) == job_id
+    assert queue.submit(FILES, force=True) == job_id  # never two active jobs for the same files
+    assert os.path.exists(queue.spool_path(job_id, 1))
+
+
+def test_a_concurrent_submit_wins_and_is_reused(make_queue, monkeypatch):
+    queue, other = make_queue(), make_queue()
+    winner, calls = [], []
+
+    # The other server submits the same files after this one looked for a job, but before it claims one
+    def racing_uuid4():
+        calls.append(1)
+        number = len(calls)
+        if number == 1:
+            winner.append(other.submit(FILES))
+        return uuid.UUID(int=number)
+
+    monkeypatch.setattr(job_queue.uuid, 'uuid4', racing_uuid4)
+    assert queue.submit(FILES) == winner[0]
+    with queue._connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 1
+    assert winner[0] == uuid.UUID(int=2).hex
+    assert not os.path.exists(queue.job_dir(uuid.UUID(int=1).hex))
+
+
+def test_finished_jobs_are_purged_after_the_retention_period(make_queue):
+    queue = make_queue()
+    old, recent = queue.submit(FILES), queue.submit(FILES[:1])
+    queue._update_job(old, status=DONE, finished_at=time.time() - 8 * 86400)
+    queue._update_job(recent, status=DONE, finished_at=time.time())
+    assert queue.purge() == 1
+    assert queue.job(old) is None and queue.files(old) == []
+    assert not os.path.exists(queue.job_dir(old))
+    assert queue.job(recent)['status'] == DONE
+
+
+def test_active_jobs_are_never_purged(make_queue):
+    queue = make_queue()
+    job_id = queue.submit(FILES)
+    queue._update_job(job_id, created_at=time.time() - 30 * 86400)
+    assert queue.purge() == 0
+    assert queue.job(job_id)['status'] == QUEUED
+
+
+def invoice_pdf(number):
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 100), "TAX INVOICE", fontsize=18)
+    page.insert_text((72, 140), f"Invoice No.: INV-{number}   Date: 16/07/2024   Supplier: Acme Traders", fontsize=11)
+    page.insert_text((72, 170), "Taxable Value: 1,000.00   Tax Amount: 180.00   Total: 1,180.00", fontsize=11)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+@pytest.fixture
+def run_jobs(tmp_path, monkeypatch, make_queue):
+    for name, value in {'EXTRACTION_CACHE_PATH': "cache.sqlite", 'DUPLICATE_INDEX_PATH': "duplicates.sqlite",
+                        'OUTPUT_STORE_PATH': "store.sqlite", 'LLM_PROVIDER': "fake", 'RULE_EXTRACTOR': "0"}.items():
+        monkeypatch.setenv(name, str(tmp_path / value) if value.endswith(".sqlite") else value)
+    for module, name in [(extraction_cache, '_default_cache'), (duplicate_index, '_default_index'), (output_store, '_default_store')]:
+        monkeypatch.setattr(module, name, None)
+    provider = FakeProvider(reply={'Invoice No.': "INV-1", 'Final Amount': "1,180.00"})
+    set_provider(provider)
+    queue = make_queue()
+
+    def submit_and_run(files, force=False):
+        job_id = queue.submit(files, force=force)
+        run_job(job_id, queue.path, queue.spool_dir, ocr_workers=1, api_in_flight=1)
+        return job_id
+
+    return queue, provider, submit_and_run
+
+
+def test_forced_jobs_process_the_files_again(run_jobs):
+    queue, provider, submit_and_run = run_jobs
+    files = [Upload("a.pdf", invoice_pdf(1))]
+    first = submit_and_run(files)
+    forced = submit_and_run(files, force=True)
+    assert forced != first and queue.job(forced)['status'] == DONE
+    assert len(provider.payloads) == 2
+    assert len(queue.results(forced)[0]) == 1
+    assert queue.files(forced)[0]['status'] == 'ok'
+
+
+def test_copies_show_the_reused_rows(run_jobs):
+    queue, provider, submit_and_run = run_jobs
+    first = Upload("a.pdf", invoice_pdf(1))
+    submit_and_run([first])
+    job_id = submit_and_run([first, Upload("b.pdf", invoice_pdf(2))])
+    assert len(provider.payloads) == 2  # a.pdf was not sent again
+    assert queue.files(job_id)[0]['status'] == 'copy'
+    df, _ = queue.results(job_id)
+    assert sorted(df['File']) == ["a.pdf", "b.pdf"]
+    assert output_store.get_default_store().count() == 2  # the copy is shown, not stored again
@@ -0,0 +1,66 @@
+import json
+
+from llm_json import JsonStreamScanner, normalize_keys, parse_array, parse_object, repair_json
+
+FIELDS = ['Invoice No.', 'GSTIN Supplier', 'Final Amount']
+
+
+def test_parse_object_skips_prose_fences_and_unrelated_objects():
+    reply = 'Sure! {"note": "a } in a string"}\n```json\n{"invoice_no": "INV-1", "Grand Total": "1,180.00"}\n```'
+    assert parse_object(reply, FIELDS) == {'Invoice No.': "INV-1", 'Final Amount': "1,180.00"}
+
+
+def test_parse_object_unwraps_a_single_key_and_repairs_python_style():
+    reply = "{'invoice': {'Invoice No.': 'INV-2', 'Supplier GSTIN': None, 'Final Amount': '90',}}"
+    assert parse_object(reply, FIELDS) == {'Invoice No.': "INV-2", 'GSTIN Supplier': "", 'Final Amount': "90"}
+
+
+def test_parse_object_falls_back_and_gives_up():
+    assert parse_object('{"vendor": "Acme"}', FIELDS) == {'vendor': "Acme"}
+    assert parse_object("no json here", FIELDS) is None
+
+
+def test_scanner_fed_in_chunks_matches_one_pass():
+    reply = 'a {"x": "[{\\"", "y": [1, {"z": 2}]} b [3, 4] {"w": 5}'
+    whole = JsonStreamScanner()
+    whole.feed(reply)
+    chunked = JsonStreamScanner()
+    for start in range(0, len(reply), 3):
+        chunked.feed(reply[start:start + 3])
+    assert chunked.values == whole.values
+    assert [json.loads(value) for value in chunked.values] == [{'x': '[{"', 'y': [1, {'z': 2}]}, [3, 4], {'w': 5}]
+    assert chunked.first_object() == {'x': '[{"', 'y': [1, {'z': 2}]}
+
+
+def test_truncated_value_is_closed_after_the_last_complete_member():
+    scanner = JsonStreamScanner()
+    scanner.feed('[{"a": 1}, {"b": [2, 3], "c": "cut off')
+    assert scanner.values == []
+    assert json.loads(scanner.truncated_value()) == [{'a': 1}, {'b': [2, 3]}]
+    scanner.feed(None)
+    assert scanner.truncated_value() is None and scanner.first_object() is None
+
+
+def test_parse_array_prefers_an_array_else_collects_objects():
+    assert parse_array('Here: [{"a": 1}, {"a": 2},]') == [{'a': 1}, {'a': 2}]
+    assert parse_array('{"a": 1}\n{"a": 2}') == [{'a': 1}, {'a': 2}]
+    assert parse_array('[{"a": 1}, {"a": 2}, {"a": 3') == [{'a': 1}, {'a': 2}]
+    assert parse_array("nothing") is None
+
+
+def test_repair_json():
+    assert json.loads(repair_json("{“a”: True, 'b': 'it\\'s', 'c': None, 'd': \"None\",}")) == {'a': True, 'b': "it's", 'c': None, 'd': "None"}
+
+
+def test_normalize_keys_prefers_exact_names_over_aliases():
+    data = {'Grand Total': "1", 'final_amount': "2", 'Seller GSTIN': "X", 'Other': None}
+    assert normalize_keys(data, FIELDS) == {'Final Amount': "2", 'GSTIN Supplier': "X", 'Other': ""}
+
+
+def test_apostrophes_in_prose_brackets_do_not_open_strings():
+    reply = 'Result (note: [the buyer\'s copy]):\n{"Invoice No.": "INV-3", \'Final Amount\': \'5,900.00\'}'
+    assert parse_object(reply, FIELDS) == {'Invoice No.': "INV-3", 'Final Amount': "5,900.00"}
+    scanner = JsonStreamScanner()
+    for char in reply:
+        scanner.feed(char)
+    assert scanner.values[0] == "[the buyer's copy]"
@@ -0,0 +1,24 @@
+import asyncio
+
+from llm_providers import FakeProvider
+
+
+class LoopBoundProvider(FakeProvider):
+
+    # Like an async SDK client: fails when used from a loop other than the one it was first used on
+    async def acomplete(self, payload):
+        loop = asyncio.get_running_loop()
+        self.bound_loop = getattr(self, 'bound_loop', None) or loop
+        assert loop is self.bound_loop, "client used from a different event loop"
+        return await super().acomplete(payload)
+
+
+def test_complete_many_keeps_input_order():
+    provider = FakeProvider(reply=lambda payload: payload["id"])
+    assert provider.complete_many([{"id": str(n)} for n in range(10)], concurrency=3) == [str(n) for n in range(10)]
+
+
+def test_complete_many_reuses_one_event_loop():
+    provider = LoopBoundProvider(reply="{}")
+    assert provider.complete_many([{}, {}]) == ["{}", "{}"]
+    assert provider.complete_many([{}]) == ["{}"]
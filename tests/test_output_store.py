@@ -0,0 +1,38 @@
+import json
+
+import pandas as pd
+
+from output_store import InvoiceStore, typed_frame
+
+
+def frame():
+    return pd.DataFrame({
+        'Invoice No.': ["INV-1", "INV-2"],
+        'Final Amount': ["₹ 1,180.00", "approx. 1180"],
+        'Tax Rate': ["18%", ""],
+        'Invoice Date': ["05/01/2024", "5th Jan"],
+    })
+
+
+def test_unparseable_values_are_kept_raw():
+    typed = typed_frame(frame())
+    assert typed['Final Amount'].iloc[0] == 1180.0 and pd.isna(typed['Final Amount'].iloc[1])
+    assert pd.isna(typed['Raw Values'].iloc[0])
+    assert json.loads(typed['Raw Values'].iloc[1]) == {'Final Amount': "approx. 1180", 'Invoice Date': "5th Jan"}
+
+
+def test_raw_values_are_stored_and_exported(tmp_path):
+    store = InvoiceStore(str(tmp_path / "store.sqlite"))
+    run_id = store.append(frame(), files=["a.pdf", "b.pdf"], doc_hashes=["h1", "h2"])
+    stored = store.run(run_id)
+    assert pd.isna(stored['Raw Values'].iloc[0])
+    assert json.loads(stored['Raw Values'].iloc[1])['Final Amount'] == "approx. 1180"
+    assert "approx. 1180" in store.export('csv').decode("utf-8")
+
+
+def test_a_frame_where_everything_parses_has_no_raw_values(tmp_path):
+    clean = frame().iloc[:1]
+    assert typed_frame(clean)['Raw Values'].isna().all()
+    store = InvoiceStore(str(tmp_path / "store.sqlite"))
+    run_id = store.append(clean, files=["a.pdf"], doc_hashes=["h1"])
+    assert len(store.run(run_id)) == 1
@@ -0,0 +1,87 @@
+import io
+import json
+
+import pytest
+
+import duplicate_index
+import invoice_pipeline
+import prompt_batching
+from extraction_cache import ExtractionCache
+from invoice_pipeline import run_pipeline
+from llm_providers import FakeProvider, set_provider
+from prompt_batching import split_batch_response
+
+
+class Upload(io.BytesIO):
+
+    def __init__(self, name):
+        super().__init__(name.encode())
+        self.name = name
+
+
+def test_ids_survive_key_normalization():
+    reply = json.dumps([{'invoice_id': '0', 'Invoice No.': 'A'}, {'invoice_id': '1', 'Invoice No.': 'B'}])
+    assert split_batch_response(reply, ['0', '1']) == {'0': {'Invoice No.': 'A'}, '1': {'Invoice No.': 'B'}}
+
+
+def test_reordered_array_is_matched_by_id():
+    reply = json.dumps([{'invoice_id': '1', 'Invoice No.': 'B'}, {'invoice_id': '0', 'Invoice No.': 'A'}])
+    assert split_batch_response(reply, ['0', '1']) == {'0': {'Invoice No.': 'A'}, '1': {'Invoice No.': 'B'}}
+
+
+def test_partial_array_keeps_the_invoices_it_has():
+    reply = json.dumps([{'invoice_id': '2', 'Invoice No.': 'C'}])
+    assert split_batch_response(reply, ['0', '1', '2']) == {'2': {'Invoice No.': 'C'}}
+
+
+def test_id_spellings_and_numeric_ids():
+    reply = json.dumps([{'Invoice ID': 1, 'Invoice No.': 'B'}, {'invoiceId': '0', 'Invoice No.': 'A'}])
+    assert split_batch_response(reply, ['0', '1']) == {'0': {'Invoice No.': 'A'}, '1': {'Invoice No.': 'B'}}
+
+
+def test_position_fallback_only_for_complete_arrays():
+    reply = json.dumps([{'Invoice No.': 'A'}, {'Invoice No.': 'B'}])
+    assert split_batch_response(reply, ['0', '1']) == {'0': {'Invoice No.': 'A'}, '1': {'Invoice No.': 'B'}}
+    assert split_batch_response(json.dumps([{'Invoice No.': 'A'}]), ['0', '1']) == {}
+
+
+def test_missing_invoices_fall_back_to_single_calls(monkeypatch):
+    class Provider:
+        def complete(self, payload):
+            return json.dumps([{'invoice_id': 'b', 'Invoice No.': 'B'}])
+
+    monkeypatch.setattr(prompt_batching, 'get_provider', lambda: Provider())
+    monkeypatch.setattr(prompt_batching, 'call_openai_api', lambda text: json.dumps({'Invoice No.': text}))
+    responses = prompt_batching.call_openai_api_batch([('a', 'A'), ('b', 'text b')])
+    assert json.loads(responses['a']) == {'Invoice No.': 'A'}
+    assert json.loads(responses['b']) == {'Invoice No.': 'B'}
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    for name, value in {'DUPLICATE_INDEX': "0", 'RULE_EXTRACTOR': "0", 'LLM_PROVIDER': "fake", 'API_BATCH_MAX_INVOICES': "2"}.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(duplicate_index, '_default_index', None)
+    monkeypatch.setattr(invoice_pipeline, '_extract_text_worker', lambda pdf_bytes: (f"Invoice text of {pdf_bytes.decode()}", {}))
+    provider = FakeProvider()
+    set_provider(provider)
+    cache = ExtractionCache(str(tmp_path / "cache.sqlite"))
+    files = [Upload(f"{number}.pdf") for number in range(5)]
+    return provider, lambda batch_prompts: run_pipeline(files, max_ocr_workers=1, cache=cache, batch_prompts=batch_prompts)
+
+
+def test_the_pipeline_packs_batches_with_pack_batches(pipeline, monkeypatch):
+    provider, run = pipeline
+    packed = []
+    monkeypatch.setattr(invoice_pipeline, 'pack_batches', lambda *args: packed.append(args) or prompt_batching.pack_batches(*args))
+    assert all(result['status'] == 'ok' for result in run(batch_prompts=True))
+    assert packed and len(provider.payloads) == 3  # five invoices, at most two per request
+
+
+def test_batched_results_are_not_reused_for_single_prompts(pipeline):
+    provider, run = pipeline
+    run(batch_prompts=True)
+    run(batch_prompts=True)
+    assert len(provider.payloads) == 3  # the second batched run came from the cache
+    run(batch_prompts=False)
+    assert len(provider.payloads) == 3 + 5
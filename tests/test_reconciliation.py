@@ -0,0 +1,28 @@
+import pandas as pd
+
+import invoice_pipeline
+from invoice_pipeline import reconcile_and_reextract
+
+
+def frame():
+    return pd.DataFrame({
+        'Taxable Value': ["1,000.00", "1,000.00", "1,000.00"],
+        'Tax Amount': ["180.00", "180.00", "180.00"],
+        'Final Amount': ["1,180.00", "1,280.00", "1,280.00"],
+    })
+
+
+def test_only_inconsistent_rows_with_text_are_reextracted(monkeypatch):
+    calls = []
+
+    def reextract_row(text, values, issues):
+        calls.append(text)
+        return {'Final Amount': "1,180.00"}
+
+    monkeypatch.setattr(invoice_pipeline, '_reextract_row', reextract_row)
+    df, reextracted = reconcile_and_reextract(frame(), ["first", "second", ""], max_api_in_flight=2)
+    assert calls == ["second"]
+    assert reextracted == 1
+    assert df['Final Amount'].tolist() == ["1,180.00", "1,180.00", "1,280.00"]
+    assert df['Reconciled'].tolist() == [True, True, False]
+    assert df.at[2, 'Reconciliation Issues'] == "Taxable Value + Tax Amount != Final Amount"
@@ -0,0 +1,98 @@
+import io
+import json
+
+import duplicate_index
+import invoice_pipeline
+from extraction_cache import ExtractionCache
+from invoice_pipeline import run_pipeline
+from llm_providers import FakeProvider, set_provider
+from rule_extractor import load_templates, missing_fields, rule_extract
+
+KNOWN = "29CITPK3346L2ZG"
+OTHER = "27AAPFU0939F1ZV"
+
+
+def invoice_text(supplier, recipient):
+    return f"""TAX INVOICE
+Seller GSTIN: {supplier}
+Invoice No.: IN1-A77
+Invoice Date: 05/01/2024
+Bill To: Buyer Pvt Ltd
+GSTIN: {recipient}
+Taxable Value: 1,000.00
+Total Tax: 180.00
+Grand Total: 1,180.00"""
+
+
+class Upload(io.BytesIO):
+
+    def __init__(self, name):
+        super().__init__(name.encode())
+        self.name = name
+
+
+def templates(tmp_path, required=None):
+    template = {'name': "Known", 'patterns': {'Invoice No.': r"\b(IN\d-[A-Z0-9]+)\b"}, 'constants': {'Place of Origin': "Karnataka"}}
+    if required is not None:
+        template['required'] = required
+    path = tmp_path / "templates.json"
+    path.write_text(json.dumps({KNOWN: template}))
+    return load_templates(str(path))
+
+
+def test_generic_rules_split_supplier_and_recipient():
+    data, name, required = rule_extract(invoice_text(OTHER, KNOWN), templates={})
+    assert name is None
+    assert (data['GSTIN Supplier'], data['GSTIN Recipient']) == (OTHER, KNOWN)
+    assert data['Invoice No.'] == "IN1-A77" and data['Final Amount'] == "1,180.00"
+    assert missing_fields(data, required) == []
+
+
+def test_template_is_picked_by_the_supplier_gstin(tmp_path):
+    data, name, _ = rule_extract(invoice_text(KNOWN, OTHER), templates=templates(tmp_path))
+    assert name == "Known"
+    assert data['Place of Origin'] == "Karnataka"
+    assert (data['GSTIN Supplier'], data['GSTIN Recipient']) == (KNOWN, OTHER)
+
+
+def test_template_is_not_picked_by_the_recipient_gstin(tmp_path):
+    data, name, _ = rule_extract(invoice_text(OTHER, KNOWN), templates=templates(tmp_path))
+    assert name is None
+    assert data['Place of Origin'] == ""
+    assert data['GSTIN Supplier'] == OTHER
+
+
+def test_template_always_requires_the_supplier_gstin(tmp_path):
+    _, _, required = rule_extract(invoice_text(KNOWN, OTHER), templates=templates(tmp_path, required=['Invoice No.']))
+    assert required == ['Invoice No.', 'GSTIN Supplier']
+
+
+# Laid out like the benchmark corpus (benchmarks/corpus.py)
+CORPUS_TEXT = f"""TAX INVOICE
+Supplier: Example Traders Pvt Ltd, 12 MG Road, Pune, Maharashtra
+GSTIN Supplier: {OTHER}
+Invoice No.: INV-4821
+Invoice Date: 14/03/2024
+Bill To: Example Buyer LLP, 4 Residency Road, Bengaluru, Karnataka
+GSTIN Recipient: {KNOWN}
+Place of Supply: Karnataka (29)
+  1  Item 5120  HSN 9983  4 Nos  1,250.00  5,000.00
+Taxable Value: 5,000.00
+CGST @ 9%: 450.00
+SGST @ 9%: 450.00
+Tax Amount: 900.00
+Final Amount: 5,900.00
+Terms and conditions
+Page 1 of 1"""
+
+
+def test_corpus_invoices_are_read_without_an_api_call(monkeypatch):
+    monkeypatch.setenv("DUPLICATE_INDEX", "0")
+    monkeypatch.setattr(duplicate_index, '_default_index', None)
+    monkeypatch.setattr(invoice_pipeline, '_extract_text_worker', lambda pdf_bytes: (CORPUS_TEXT, {}))
+    provider = FakeProvider()
+    set_provider(provider)
+    monkeypatch.setenv("LLM_PROVIDER", "fake")
+    [result] = run_pipeline([Upload("a.pdf")], max_ocr_workers=1, cache=ExtractionCache(enabled=False))
+    assert result['rule_based'] and result['data']['Final Amount'] == "5,900.00"
+    assert provider.payloads == []
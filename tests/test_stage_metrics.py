@@ -0,0 +1,18 @@
+import pstats
+import threading
+
+from stage_metrics import profiling
+
+
+def busy_worker():
+    return sum(number * number for number in range(20000))
+
+
+def test_cprofile_includes_worker_threads(tmp_path):
+    path = str(tmp_path / "run.prof")
+    with profiling("cprofile", path) as output_path:
+        thread = threading.Thread(target=busy_worker)
+        thread.start()
+        thread.join()
+    assert output_path == path
+    assert any(name == "busy_worker" for _, _, name in pstats.Stats(path).stats)
@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+import text_compaction
+from text_compaction import count_tokens
+
+
+def test_importing_the_cli_does_not_load_tiktoken():
+    code = "import sys, invoice_cli; print('tiktoken' in sys.modules)"
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=repo, capture_output=True, text=True, check=True)
+    assert result.stdout.splitlines()[-1] == "False"
+
+
+def test_without_tiktoken_tokens_are_estimated_from_length(monkeypatch):
+    monkeypatch.setattr(text_compaction, '_encoding', text_compaction._NO_ENCODING)
+    assert count_tokens("x" * 40) == 11
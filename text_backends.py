@@ -0,0 +1,248 @@
+# Pluggable PDF text-extraction backends shared by the GPT app and the Gemini experiment.
+# Each page is classified as text / scanned / mixed from cheap signals, and only pages that
+# need it are rendered and sent to OCR.
+import os
+import time
+import logging
+import tempfile
+from io import BytesIO
+from invoice_ocr import PageSource, ocr_dpi, ocr_images, ocr_mode, rasterize_pages
+from stage_metrics import PDF_PARSE, RASTERIZE, observe
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+###########################################################################
+# 1. Configuration
+
+
+MIN_TEXT_CHARS = 50          # below this the text layer is treated as missing (same threshold as before)
+MIN_OCR_CHARS = 10           # OCR output shorter than this is discarded
+MIXED_IMAGE_COVERAGE = 0.5   # text pages whose images cover this much of the page are 'mixed'
+DEFAULT_DPI = 200
+
+PAGE_TEXT, PAGE_SCANNED, PAGE_MIXED = 'text', 'scanned', 'mixed'
+PAGE_BREAK = "\f"  # between pages in extracted text, so later stages can tell pages apart
+
+# Memory ceiling for rendered pages per document; pages are classified, rendered and OCR'd in windows
+# that fit under it. Page bitmaps are estimated as A4 grayscale (one byte per pixel), counted twice for
+# the renderer's buffer and the PIL copy.
+DEFAULT_MEMORY_LIMIT_MB = 256
+PAGE_INCHES = (8.27, 11.69)
+
+
+# Shared classification rule: text length first, then how much of the page is covered by images.
+def classify(text, image_coverage):  # text (str): Text layer.  image_coverage (float): Image area / page area, or None if unknown.
+
+    if len(text.strip()) <= MIN_TEXT_CHARS:
+        return PAGE_SCANNED
+    if image_coverage is not None and image_coverage >= MIXED_IMAGE_COVERAGE:
+        return PAGE_MIXED
+    return PAGE_TEXT  # str: One of PAGE_TEXT, PAGE_SCANNED, PAGE_MIXED.
+
+
+# Per-document memory ceiling for rendered pages (PDF_MEMORY_LIMIT_MB), read lazily.
+def memory_limit_mb():
+
+    return float(os.getenv("PDF_MEMORY_LIMIT_MB", DEFAULT_MEMORY_LIMIT_MB))  # float: Megabytes.
+
+
+# Number of pages rendered at once so their bitmaps stay under the memory ceiling. Always at least one.
+def page_window(dpi, limit_mb=None):  # dpi (int): Render DPI.  limit_mb (float): Defaults to memory_limit_mb().
+
+    limit_mb = memory_limit_mb() if limit_mb is None else limit_mb
+    page_bytes = 2 * (PAGE_INCHES[0] * dpi) * (PAGE_INCHES[1] * dpi)
+    return max(1, int(limit_mb * 1024 * 1024 // page_bytes))  # int: Pages per window.
+
+
+
+###################################################################
+# 2.  Backends
+
+# Interface every backend implements. Page numbers are 1-based.
+class TextBackend:
+
+    name = None
+
+    def open(self, pdf_bytes):
+        raise NotImplementedError
+
+    def page_count(self, doc):
+        raise NotImplementedError
+
+    # Returns (text layer, page kind) for one page.
+    def page_text(self, doc, page_number):
+        raise NotImplementedError
+
+    # Returns PIL images for the given pages, in the given order.
+    def render_pages(self, doc, page_numbers, dpi=DEFAULT_DPI):
+        raise NotImplementedError
+
+    # A PageSource that OCR workers can re-render regions of, or None if the backend cannot.
+    def page_source(self, doc, page_number, dpi):
+        return None
+
+    def close(self, doc):
+        pass
+
+
+# pypdf text layer; scanned pages are rasterized through poppler (pdf2image).
+class PypdfBackend(TextBackend):
+
+    name = 'pypdf'
+
+    def open(self, pdf_bytes):
+        from pypdf import PdfReader  # optional: the Gemini app only needs PyMuPDF
+        return {'bytes': pdf_bytes, 'reader': PdfReader(BytesIO(pdf_bytes)), 'path': None}
+
+    def page_count(self, doc):
+        return len(doc['reader'].pages)
+
+    def page_text(self, doc, page_number):
+        page = doc['reader'].pages[page_number - 1]
+        text = page.extract_text() or ""
+        # pypdf cannot measure image placement cheaply; a page with image XObjects and only a
+        # little text is treated as fully covered (mixed), otherwise coverage is unknown
+        has_images = False
+        try:
+            xobjects = page.get("/Resources", {}).get("/XObject", {})
+            has_images = any(xobject.get_object().get("/Subtype") == "/Image" for xobject in xobjects.values())
+        except Exception:
+            pass
+        return text, classify(text, 1.0 if has_images and len(text.strip()) < 4 * MIN_TEXT_CHARS else None)
+
+    # poppler reads from a file; it is written once per document rather than once per window
+    def render_pages(self, doc, page_numbers, dpi=DEFAULT_DPI):
+        if doc['path'] is None:
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+                f.write(doc['bytes'])
+            doc['path'] = f.name
+        return rasterize_pages(doc['path'], page_numbers, dpi=dpi)
+
+    def close(self, doc):
+        if doc['path'] is not None:
+            os.remove(doc['path'])
+            doc['path'] = None
+
+
+# PyMuPDF: fast text layer, image coverage from image bounding boxes, and in-memory pixmaps for OCR.
+class PyMuPDFBackend(TextBackend):
+
+    name = 'pymupdf'
+
+    def __init__(self):
+        if fitz is None:
+            raise ImportError("PyMuPDF is not installed; install it with `pip install PyMuPDF`.")
+
+    def open(self, pdf_bytes):
+        return fitz.open(stream=pdf_bytes, filetype="pdf")
+
+    def page_count(self, doc):
+        return doc.page_count
+
+    def page_text(self, doc, page_number):
+        page = doc.load_page(page_number - 1)
+        text = page.get_text()
+        page_area = abs(page.rect) or 1.0
+        image_area = 0.0
+        for info in page.get_image_info():
+            image_area += abs(fitz.Rect(info["bbox"]) & page.rect)
+        return text, classify(text, min(image_area / page_area, 1.0))
+
+    def render_pages(self, doc, page_numbers, dpi=DEFAULT_DPI):
+        from PIL import Image
+        images = []
+        for page_number in page_numbers:
+            pixmap = doc.load_page(page_number - 1).get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+            images.append(Image.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples))
+            pixmap = None  # release the native buffer before rendering the next page
+        return images
+
+    # The page copied into a one-page PDF, so workers do not receive the whole document.
+    def page_source(self, doc, page_number, dpi):
+        page_doc = fitz.open()
+        try:
+            page_doc.insert_pdf(doc, from_page=page_number - 1, to_page=page_number - 1)
+            return PageSource(page_doc.tobytes(), 0, dpi)
+        finally:
+            page_doc.close()
+
+    def close(self, doc):
+        doc.close()
+
+
+BACKENDS = {
+    PypdfBackend.name: PypdfBackend,
+    PyMuPDFBackend.name: PyMuPDFBackend,
+}
+
+
+# Returns a backend by name; defaults to PDF_TEXT_BACKEND, or PyMuPDF when it is installed.
+def get_backend(name=None):  # name (str): 'pymupdf' or 'pypdf'.
+
+    name = name or os.getenv("PDF_TEXT_BACKEND") or ('pymupdf' if fitz is not None else 'pypdf')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown PDF text backend '{name}'. Choose from: {', '.join(BACKENDS)}.")
+    return BACKENDS[name]()  # TextBackend: A backend instance.
+
+
+
+###################################################################
+# 3.  Extraction
+
+# Yields (page number, text) in document order, OCRing only scanned and mixed pages. Pages are handled
+# in windows sized to the memory ceiling: each window is classified, its OCR pages rendered and read, and
+# the images dropped before the next window, so peak memory follows the window rather than the document.
+# For mixed pages the longer of the text layer and the OCR text is kept. The render DPI follows OCR_MODE by default.
+def iter_page_texts(pdf_bytes, backend=None, ocr_workers=None, ocr=True, dpi=None, window=None):  # pdf_bytes (bytes): The PDF content.  ocr (bool): False skips OCR entirely.  window (int): Pages per window, defaults to page_window().
+
+    backend = backend or get_backend()
+    dpi = dpi or ocr_dpi()
+    window = window or page_window(dpi)
+    parse_seconds = rasterize_seconds = 0.0
+    rasterized = False
+    doc = backend.open(pdf_bytes)
+    try:
+        page_count = backend.page_count(doc)
+        for first in range(1, page_count + 1, window):
+            started = time.perf_counter()
+            page_texts = {}
+            ocr_page_numbers = []
+            for page_number in range(first, min(first + window, page_count + 1)):
+                text, kind = backend.page_text(doc, page_number)
+                logging.debug(f"Page {page_number} classified as {kind} by {backend.name}.")
+                page_texts[page_number] = text if kind != PAGE_SCANNED else ""
+                if kind != PAGE_TEXT:
+                    ocr_page_numbers.append(page_number)
+            parse_seconds += time.perf_counter() - started
+
+            if ocr and ocr_page_numbers:
+                started = time.perf_counter()
+                images = backend.render_pages(doc, ocr_page_numbers, dpi=dpi)
+                rasterize_seconds += time.perf_counter() - started
+                rasterized = True
+                sources = [backend.page_source(doc, page_number, dpi) for page_number in ocr_page_numbers] if ocr_mode() == "roi" else None
+                ocr_texts = ocr_images(images, max_workers=ocr_workers, sources=sources)
+                del images
+                for page_number, ocr_text in zip(ocr_page_numbers, ocr_texts):
+                    if ocr_text and len(ocr_text.strip()) > MIN_OCR_CHARS and len(ocr_text.strip()) > len(page_texts[page_number].strip()):
+                        page_texts[page_number] = ocr_text
+                        logging.debug(f"OCR text extracted from page {page_number}.")
+
+            for page_number, text in page_texts.items():
+                yield page_number, text
+    finally:
+        backend.close(doc)
+        # One sample per document, however many windows it took
+        observe(PDF_PARSE, parse_seconds)
+        if rasterized:
+            observe(RASTERIZE, rasterize_seconds)
+
+
+# Extracts the text of a whole document: pages from iter_page_texts, collected in a list and joined once.
+def extract_text(pdf_bytes, backend=None, ocr_workers=None, ocr=True, dpi=None):  # pdf_bytes (bytes): The PDF content.  ocr (bool): False skips OCR entirely.
+
+    parts = [text + "\n" for _, text in iter_page_texts(pdf_bytes, backend, ocr_workers, ocr, dpi) if text]
+    return PAGE_BREAK.join(parts)  # str: The extracted text, in page order.
@@ -0,0 +1,190 @@
+# Shrinks extracted invoice text before it is pasted into the prompt: repeated page headers/footers,
+# OCR noise and legal boilerplate are dropped, and the rest is cut to a token budget keeping the lines
+# most likely to hold the requested fields.
+import os
+import re
+import logging
+import threading
+from text_backends import PAGE_BREAK
+
+###########################################################################
+# 1. Configuration
+
+
+EDGE_LINES = 3  # lines at the top and bottom of a page checked for repeated headers/footers
+
+# Lines naming a requested field; they and their neighbours are kept first
+FIELD_KEYWORDS = re.compile(
+    r'gstin|\bgst\b|sgst|cgst|igst|\btax|total|amount|invoice|\binv\b|\bdate|dated|\bqty|quantity|\brate'
+    r'|hsn|\bsac\b|place of supply|\bstate\b|address|bill(?:ed)? to|ship(?:ped)? to|buyer|seller|supplier'
+    r'|recipient|consignee|e-?mail|@|₹|\brs\.?\s|\binr\b',
+    re.IGNORECASE,
+)
+KEYWORD_CONTEXT = 2  # lines kept on either side of a keyword line (addresses follow "Bill To:")
+
+NUMBER = re.compile(r'\d[\d,]*(?:\.\d+)?')
+LEGAL_MARKERS = re.compile(
+    r'terms\s*(?:and|&)\s*conditions|declaration|jurisdiction|subject to|e\.?\s*&\s*o\.?\s*e|computer generated',
+    re.IGNORECASE,
+)
+
+# Line scores: higher survives the budget first; 0 is always dropped
+SCORE_KEYWORD, SCORE_TABLE, SCORE_CONTEXT, SCORE_OTHER, SCORE_LEGAL = 4, 3, 2, 1, 0
+
+_NO_ENCODING = object()  # tiktoken was tried and is unavailable
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+# Compaction settings, read lazily so a .env loaded after import still applies.
+def compaction_settings():
+
+    return {
+        'enabled': os.getenv("TEXT_COMPACTION", "1").lower() in ("1", "true", "yes"),
+        'token_budget': int(os.getenv("TEXT_COMPACTION_TOKEN_BUDGET", 3000)),  # invoice text tokens per prompt
+    }  # dict: Compaction settings.
+
+
+
+###################################################################
+# 2.  Functions
+
+# The GPT-4 tokenizer, loaded on first use so importing the pipeline does not pay for tiktoken.
+def _get_encoding():
+
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:  # not installed, or the encoding file cannot be fetched offline
+                _encoding = _NO_ENCODING
+    return None if _encoding is _NO_ENCODING else _encoding  # Encoding: The tokenizer, or None.
+
+
+# Token count with the local GPT-4 tokenizer, or ~4 characters per token without tiktoken.
+def count_tokens(text):
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+# Header/footer key: page numbers and dates change from page to page, so digits are masked.
+def _edge_key(line):
+
+    return re.sub(r'\d+', '#', " ".join(line.lower().split()))
+
+
+# Drops header/footer lines that repeat on at least half of the pages, keeping them on the first page.
+def dedupe_page_edges(pages):  # pages (list): Lists of lines, one per page.
+
+    if len(pages) < 2:
+        return pages
+    seen_on = {}
+    for page_number, lines in enumerate(pages):
+        content = [line for line in lines if line.strip()]
+        for line in content[:EDGE_LINES] + content[-EDGE_LINES:]:
+            seen_on.setdefault(_edge_key(line), set()).add(page_number)
+    repeated = {key for key, page_numbers in seen_on.items() if len(page_numbers) >= max(2, len(pages) / 2)}
+
+    deduped = [pages[0]]
+    for lines in pages[1:]:
+        content = [index for index, line in enumerate(lines) if line.strip()]
+        edges = set(content[:EDGE_LINES] + content[-EDGE_LINES:])
+        deduped.append([line for index, line in enumerate(lines) if index not in edges or _edge_key(line) not in repeated])
+    return deduped  # list: Pages with repeated edges removed.
+
+
+# True for lines that carry no extractable information: OCR specks, rules and punctuation runs.
+def is_noise(line):
+
+    text = line.strip()
+    if len(text) < 2:
+        return True
+    if sum(char.isalnum() for char in text) / len(text) < 0.4:
+        return True
+    words = text.split()
+    return not any(char.isdigit() for char in text) and sum(len(word) for word in words) / len(words) < 1.5
+
+
+# Scores every line; keyword lines, their neighbours and line-item rows rank above the rest, and
+# legal blocks (from a marker to the next blank line) score 0 unless they name a field.
+def score_lines(lines):
+
+    scores = []
+    in_legal = False
+    for line in lines:
+        if not line.strip():
+            in_legal = False
+            scores.append(None)
+        elif FIELD_KEYWORDS.search(line):
+            scores.append(SCORE_KEYWORD)
+        elif len(NUMBER.findall(line)) >= 2:
+            scores.append(SCORE_TABLE)  # line-item rows: quantity, rate, amount ...
+        elif in_legal or LEGAL_MARKERS.search(line):
+            in_legal = True
+            scores.append(SCORE_LEGAL)
+        else:
+            scores.append(SCORE_OTHER)
+
+    # Context spreads from keyword lines but not across blank lines
+    for index, score in enumerate(list(scores)):
+        if score != SCORE_KEYWORD:
+            continue
+        for step in (-1, 1):
+            neighbour = index + step
+            while 0 <= neighbour < len(scores) and abs(neighbour - index) <= KEYWORD_CONTEXT and scores[neighbour] is not None:
+                if scores[neighbour] in (SCORE_OTHER, SCORE_LEGAL):
+                    scores[neighbour] = SCORE_CONTEXT
+                neighbour += step
+    return scores  # list: Score per line, None for blank lines.
+
+
+# Compacts one document's text to the token budget. Kept lines stay in their original order.
+def compact_text(text, token_budget=None):  # text (str): Extracted text, pages separated by PAGE_BREAK.  token_budget (int): Defaults to TEXT_COMPACTION_TOKEN_BUDGET.
+
+    token_budget = token_budget or compaction_settings()['token_budget']
+    pages = dedupe_page_edges([page.splitlines() for page in text.split(PAGE_BREAK)])
+    # Blank lines are kept for now: they end legal blocks in score_lines
+    lines = [line.rstrip() for page in pages for line in page if not line.strip() or not is_noise(line)]
+    scores = score_lines(lines)
+
+    candidates = [(index, line) for index, (line, score) in enumerate(zip(lines, scores)) if score]
+    costs = {index: count_tokens(line) + 1 for index, line in candidates}
+    if sum(costs.values()) > token_budget:
+        # Highest score first, earlier lines first within a score
+        kept, used = set(), 0
+        for index, _ in sorted(candidates, key=lambda item: (-scores[item[0]], item[0])):
+            if used + costs[index] <= token_budget:
+                kept.add(index)
+                used += costs[index]
+        candidates = [(index, line) for index, line in candidates if index in kept]
+
+    compacted = "\n".join(line for _, line in candidates)
+    stats = {
+        'tokens_before': count_tokens(text),
+        'tokens_after': count_tokens(compacted),
+        'lines_before': len(text.splitlines()),
+        'lines_after': len(candidates),
+    }
+    stats['tokens_saved'] = max(0, stats['tokens_before'] - stats['tokens_after'])
+    return compacted, stats  # tuple: (compacted text, token/line counts).
+
+
+# Prompt text for a document under the current settings; the raw text is returned when compaction is off.
+def prompt_text(text, name=None):  # name (str): Used in the log line.
+
+    settings = compaction_settings()
+    if not settings['enabled']:
+        tokens = count_tokens(text)
+        return text, {'tokens_before': tokens, 'tokens_after': tokens, 'tokens_saved': 0}
+    compacted, stats = compact_text(text, settings['token_budget'])
+    if not compacted.strip():
+        tokens = count_tokens(text)
+        return text, {'tokens_before': tokens, 'tokens_after': tokens, 'tokens_saved': 0}  # nothing recognisable was left
+    logging.info(f"{name or 'document'}: compacted {stats['tokens_before']} -> {stats['tokens_after']} tokens "
+                 f"({stats['lines_before'] - stats['lines_after']} line(s) dropped).")
+    return compacted, stats  # tuple: (text for the prompt, token counts).